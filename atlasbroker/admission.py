@@ -0,0 +1,163 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""admission module
+
+Admission control of the broker operations
+"""
+
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from . import deadline, metrics
+from .errors import ErrBrokerOverloaded
+
+# Operations calling Atlas, the other ones only read the broker state
+WRITE_OPERATIONS = ("provision", "update", "deprovision", "bind", "unbind")
+
+def lane(operation):
+    """Lane of an operation
+    
+    Args:
+        operation (str): The operation (provision, catalog, ...)
+    
+    Returns:
+        str: "write" or "read"
+    """
+    return "write" if operation in WRITE_OPERATIONS else "read"
+
+def lanes(options, cls=None):
+    """Admission controls from the "admission" section of the configuration options
+    
+    Args:
+        options (dict): eg: {"write": {"limit": 10, "queue": 20}, "read": {"limit": 50}}
+    
+    Keyword Arguments:
+        cls (type): AdmissionControl (default) or AsyncAdmissionControl
+    
+    Returns:
+        dict: Admission control per lane. A lane not set is not limited.
+    """
+    cls = cls or AdmissionControl
+    return { name:cls(name, **lane_options) for name, lane_options in (options or {}).items() }
+
+class AdmissionControl:
+    """Admission Control
+    
+    At most "limit" operations of a lane are in progress at once in the process. Other operations
+    wait in a bounded queue up to "wait" seconds. An operation is rejected at once with
+    ErrBrokerOverloaded when the queue is full, so a burst of requests is answered quickly
+    instead of timing out together on Atlas.
+    
+    Constructor
+    
+    Args:
+        name (str): Name of the lane (write, read)
+    
+    Keyword Arguments:
+        limit (int): Operations in progress at once
+        queue (int): Operations waiting at once
+        wait (float): Maximum seconds waiting (bounded by the deadline of the request)
+        retry_after (int): Seconds sent to the platform in Retry-After
+    """
+    def __init__(self, name, limit=10, queue=20, wait=1, retry_after=1):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.wait = wait
+        self.retry_after = retry_after
+        self.waiting = 0
+        self._slots = threading.Semaphore(limit)
+        self._lock = threading.Lock()
+    
+    def _reject(self):
+        metrics.ADMISSION_REJECTED.labels(self.name).inc()
+        raise ErrBrokerOverloaded(self.name, self.retry_after)
+    
+    def enter(self):
+        """Take a slot, waiting in the queue if needed
+        
+        Raises:
+            ErrBrokerOverloaded: The queue is full or no slot in time
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.waiting >= self.queue:
+                    self._reject()
+                self.waiting += 1
+            
+            try:
+                acquired = self._slots.acquire(timeout=deadline.timeout(self.wait))
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+            
+            if not acquired:
+                self._reject()
+        
+        metrics.ADMISSION_IN_FLIGHT.labels(self.name).inc()
+    
+    def exit(self):
+        """Release the slot taken by enter"""
+        metrics.ADMISSION_IN_FLIGHT.labels(self.name).dec()
+        self._slots.release()
+    
+    @contextmanager
+    def admit(self):
+        """Do an operation in a slot (see enter)
+        
+        Raises:
+            ErrBrokerOverloaded: The queue is full or no slot in time
+        """
+        self.enter()
+        try:
+            yield
+        finally:
+            self.exit()
+
+class AsyncAdmissionControl(AdmissionControl):
+    """Async Admission Control
+    
+    Same than AdmissionControl for the asyncio broker. Operations wait without blocking the event loop.
+    """
+    def __init__(self, name, limit=10, queue=20, wait=1, retry_after=1):
+        super().__init__(name, limit=limit, queue=queue, wait=wait, retry_after=retry_after)
+        self._slots = asyncio.Semaphore(limit)
+    
+    @asynccontextmanager
+    async def admit(self):
+        """Do an operation in a slot (see AdmissionControl.enter)
+        
+        Raises:
+            ErrBrokerOverloaded: The queue is full or no slot in time
+        """
+        if self._slots.locked():
+            if self.waiting >= self.queue:
+                self._reject()
+            
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), deadline.timeout(self.wait))
+            except asyncio.TimeoutError:
+                self._reject()
+            finally:
+                self.waiting -= 1
+        else:
+            await self._slots.acquire()
+        
+        metrics.ADMISSION_IN_FLIGHT.labels(self.name).inc()
+        try:
+            yield
+        finally:
+            self.exit()
@@ -0,0 +1,160 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""aioatlas module
+
+Atlas client for the asyncio broker (needs httpx: pip3 install atlasbroker[asgi])
+"""
+
+import asyncio
+import httpx
+from atlasapi.network import Network
+from atlasapi.settings import Settings
+from . import steps
+from .atlasclient import AtlasCalls
+from .ratelimit import RetryPolicy, background
+
+class AsyncAtlas(AtlasCalls):
+    """Async Atlas
+    
+    Atlas endpoints used by the broker with non-blocking I/O.
+    
+    Connections are kept alive and the digest authentication is reused between calls like
+    AtlasNetwork. Errors are the same than atlasapi (ErrAtlasNotFound, ErrAtlasConflict, ...).
+    Calls are rate limited, retried and bounded by the deadline of the request with the steps
+    of AtlasNetwork (see AtlasCalls).
+    
+    Constructor
+    
+    Args:
+        user (str): Atlas user
+        password (str): Atlas password
+        group (str): Atlas group
+    
+    Keyword Arguments:
+        max_connections (int): Maximum number of connections to Atlas
+        max_keepalive_connections (int): Maximum number of connections kept alive
+        timeout (float): Requests timeout in seconds
+        limiter (TokenBucket): Rate limiter (no limit if None)
+        retry (dict): RetryPolicy options eg: {"max_retries": 3, "backoff": 0.5}
+        breaker (CircuitBreaker): Circuit breaker (none if None)
+    """
+    
+    # Errors of httpx counted as failures by the circuit breaker
+    TRANSPORT_ERRORS = (httpx.HTTPError,)
+    
+    def __init__(self, user, password, group, max_connections=100, max_keepalive_connections=20, timeout=None, limiter=None, retry=None, breaker=None):
+        self.group = group
+        self.timeout = timeout if timeout is not None else Settings.requests_timeout
+        self.limiter = limiter
+        self.breaker = breaker
+        self.retry = RetryPolicy(**(retry or {}))
+        self.client = httpx.AsyncClient(auth=httpx.DigestAuth(user, password),
+                                        limits=httpx.Limits(max_connections=max_connections,
+                                                            max_keepalive_connections=max_keepalive_connections),
+                                        timeout=self.timeout,
+                                        follow_redirects=True)
+        
+        # Atlas answers are checked like the synchronous client
+        self.network = Network(user, password)
+    
+    async def request(self, method, uri, payload=None):
+        """Send a request
+        
+        Args:
+            method (str): HTTP method
+            uri (str): URI relative to Settings.BASE_URL
+        
+        Keyword Arguments:
+            payload (dict): JSON payload
+        
+        Returns:
+            dict: Response payload
+        
+        Raises:
+            ErrAtlasGeneric: Atlas error (see atlasapi.errors)
+            ErrAtlasRateLimited: No token of the rate limiter in time
+            ErrDependencyUnavailable: The circuit breaker is open
+            ErrDeadlineExceeded: The deadline of the request is over
+        """
+        r = await steps.run_async(self.request_steps(method, Settings.BASE_URL + uri, { "json" : payload }))
+        
+        try:
+            details = r.json()
+        except ValueError:
+            details = {}
+        
+        return self.network.answer(r.status_code, details)
+    
+    async def _acquire(self):
+        await self.limiter.acquire_async()
+    
+    async def _send(self, method, uri, timeout, kwargs):
+        return await self.client.request(method, uri, timeout=timeout, **kwargs)
+    
+    async def _sleep(self, seconds):
+        await asyncio.sleep(seconds)
+    
+    async def get_single_cluster(self, cluster):
+        """Get a Single Cluster
+        
+        Args:
+            cluster (str): The cluster name
+        
+        Returns:
+            dict: The Atlas cluster
+        
+        Raises:
+            ErrAtlasNotFound: The cluster does not exist
+        """
+        uri = Settings.api_resources["Clusters"]["Get a Single Cluster"] % (self.group, cluster)
+        return await self.request("GET", uri)
+    
+    async def create_a_database_user(self, permissions):
+        """Create a Database User
+        
+        Args:
+            permissions (DatabaseUsersPermissionsSpecs): Permissions to apply
+        
+        Returns:
+            dict: Response payload
+        """
+        uri = Settings.api_resources["Database Users"]["Create a Database User"] % self.group
+        return await self.request("POST", uri, permissions.getSpecs())
+    
+    async def delete_a_database_user(self, user):
+        """Delete a Database User
+        
+        Args:
+            user (str): User to delete
+        
+        Returns:
+            dict: Response payload
+        """
+        uri = Settings.api_resources["Database Users"]["Delete a Database User"] % (self.group, user)
+        return await self.request("DELETE", uri)
+    
+    async def ping(self):
+        """Check Atlas is reachable with the credentials (first cluster of the group)
+        
+        Raises:
+            ErrAtlasGeneric: Atlas error (see atlasapi.errors)
+        """
+        uri = Settings.api_resources["Clusters"]["Get All Clusters"] % (self.group, 1, 1)
+        with background():
+            await self.request("GET", uri)
+    
+    async def close(self):
+        """Close connections"""
+        await self.client.aclose()
@@ -0,0 +1,334 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""aioservice module
+
+Core of the asyncio Atlas broker
+"""
+
+import asyncio
+from .aioatlas import AsyncAtlas
+from .aiostorage import AsyncAtlasBrokerStorage, AsyncStorageAdapter
+from .atlasclient import create_atlas
+from .brokersteps import BrokerSteps
+from .catalog import CatalogCache, create_service
+from .clusters import ClusterRegistry
+from . import logs, metrics, steps, tracing
+from .memorystorage import AtlasBrokerMemoryStorage
+from .breaker import CircuitBreaker
+from .operations import EventLoopOperations
+from .ratelimit import TokenBucket
+from .readiness import AsyncReadinessProbe
+from .singleflight import AsyncSingleFlight, request_key
+from .servicebinding import AtlasServiceBinding
+from .serviceinstance import AtlasServiceInstance
+from .sqlitestorage import AtlasBrokerSQLiteStorage
+from .errors import ErrStorageDriverUnsupported, ErrWatchUnsupported
+
+class AsyncAtlasBroker(BrokerSteps):
+    """Async Atlas Broker
+    
+    Same operations than AtlasBroker as coroutines. Storage and Atlas calls are done with
+    non-blocking I/O so one process can serve a lot of requests in flight (see asgi module).
+    
+    The logic of the operations, instances and bindings is the one of AtlasBroker, AtlasServiceInstance
+    and AtlasServiceBinding (see BrokerSteps and steps module). The broker is their backend like
+    AtlasBrokerBackend for AtlasBroker.
+    
+    Constructor
+    
+    Args:
+        config (Config): Configuration of the broker
+    """
+    def __init__(self, config):
+        self.config = config
+        logs.configure(self.config.options.get("logging", None))
+        if "tracing" in self.config.options:
+            tracing.configure(self.config.options["tracing"])
+        self.storage = self._create_storage()
+        client_options = dict(self.config.atlas.get("client", None) or {})
+        rate_limit = client_options.pop("rate_limit", None)
+        breaker = client_options.pop("breaker", None)
+        
+        # Calls of both clients share the rate limit and the circuit breaker
+        limiter = TokenBucket(**rate_limit) if rate_limit else None
+        breaker = CircuitBreaker("atlas", **breaker) if breaker else None
+        self.atlas = AsyncAtlas(self.config.atlas["user"],
+                                self.config.atlas["password"],
+                                self.config.atlas["group"],
+                                timeout=client_options.get("timeout", None),
+                                limiter=limiter,
+                                retry=client_options.get("retry", None),
+                                breaker=breaker)
+        
+        # The list of clusters is refreshed in a background thread with the synchronous client
+        clusters_options = self.config.options.get("clusters", {})
+        self.cluster_registry = ClusterRegistry(create_atlas(self.config.atlas, client_options, limiter, breaker),
+                                                refresh_interval=clusters_options.get("refresh_interval", 300),
+                                                timeout=clusters_options.get("timeout", 60),
+                                                negative_ttl=clusters_options.get("negative_ttl", 5),
+                                                on_refresh=self.config.update_clusters if self.config.clusters_from_atlas else None)
+        
+        self.service_instance = AtlasServiceInstance(self)
+        self.service_binding = AtlasServiceBinding(self)
+        # The broker is the backend of its operations (see BrokerSteps)
+        self._backend = self
+        
+        # Asynchronous operations (disabled by default)
+        async_options = dict(self.config.options.get("async", {}))
+        if async_options.pop("enabled", False):
+            self.operations = EventLoopOperations(self.storage, **async_options)
+        else:
+            self.operations = None
+        
+        # Retries of the platform for the same request are served once
+        self._flights = AsyncSingleFlight()
+        
+        # Catalog built and serialized once. Credentials of an asynchronous binding are
+        # fetched with get_binding
+        self.catalog_cache = CatalogCache(lambda: create_service(self.config, self.operations is not None))
+        
+        # Dependencies are checked in the background for the readiness
+        self.readiness = AsyncReadinessProbe({ "storage" : self.storage.ping,
+                                               "atlas" : self.atlas.ping },
+                                             interval=self.config.options.get("readiness", {}).get("interval", 10))
+    
+    def _create_storage(self):
+        """Create the storage
+        
+        The driver is selected with the "storage" section of the configuration options.
+        
+        Returns:
+            AsyncAtlasBrokerStorageBase: The storage
+        
+        Raises:
+            ErrStorageDriverUnsupported: Unknown storage driver
+            ErrWatchUnsupported: The change stream of the storage is enabled
+        """
+        options = self.config.storage_options()
+        driver = options["driver"]
+        
+        if driver == "mongo":
+            if self.config.mongo.get("watch", False):
+                # Not silently ignored, the cache would serve stale documents of other replicas
+                raise ErrWatchUnsupported()
+            return AsyncAtlasBrokerStorage(self.config.mongo["uri"],
+                                           self.config.mongo["timeoutms"],
+                                           self.config.mongo["db"],
+                                           self.config.mongo["collection"],
+                                           cache=options["cache"],
+                                           upsert=options["upsert"],
+                                           client_options=self.config.mongo.get("client", None),
+                                           lease=self.config.mongo.get("lease", None),
+                                           breaker=self.config.mongo.get("breaker", None))
+        elif driver == "memory":
+            return AsyncStorageAdapter(AtlasBrokerMemoryStorage(upsert=options["upsert"]),
+                                       cache=options["cache"])
+        elif driver == "sqlite":
+            return AsyncStorageAdapter(AtlasBrokerSQLiteStorage(options["path"],
+                                                                upsert=options["upsert"]),
+                                       cache=options["cache"])
+        
+        raise ErrStorageDriverUnsupported(driver)
+    
+    async def open(self):
+        """Prepare the broker (called once the event loop is running)"""
+        await self.storage.open()
+        
+        if self.config.clusters_from_atlas:
+            # Bindings need the clusters configuration
+            await asyncio.get_event_loop().run_in_executor(None, self.cluster_registry.refresh)
+        self.cluster_registry.start()
+        self.readiness.start()
+    
+    async def close(self):
+        """Release the broker"""
+        self.cluster_registry.stop()
+        self.readiness.stop()
+        if self.operations is not None:
+            await self.operations.close()
+        await self.atlas.close()
+        await self.storage.close()
+    
+    def catalog(self):
+        return self.catalog_cache.service
+    
+    async def is_existing_cluster(self, cluster):
+        """Check if the cluster exists (see ClusterRegistry.is_existing_cluster)
+        
+        Args:
+            cluster (str): The cluster name
+        
+        Returns:
+            bool: The cluster exists or not
+        """
+        return await steps.run_async(self.cluster_registry.is_existing_cluster_steps(cluster, self.atlas.get_single_cluster))
+    
+    async def create_database_user(self, permissions):
+        """Create a database user on Atlas (see AtlasBrokerBackend.create_database_user)
+        
+        Args:
+            permissions (DatabaseUsersPermissionsSpecs): The user and its permissions
+        """
+        await self.atlas.create_a_database_user(permissions)
+    
+    async def delete_database_user(self, username):
+        """Delete a database user on Atlas (see AtlasBrokerBackend.delete_database_user)
+        
+        Args:
+            username (str): The user name
+        """
+        await self.atlas.delete_a_database_user(username)
+    
+    async def _leased(self, instance_id, binding_id, fn, *args):
+        """Await fn with the lease of the instance or the binding (see AsyncAtlasBrokerStorageBase.lease)
+        
+        Args:
+            instance_id (str): UUID of the instance
+            binding_id (str): UUID of the binding or None
+            fn (callable): The coroutine function
+            *args: Arguments of the call
+        """
+        async with self.storage.lease(instance_id, binding_id):
+            return await fn(*args)
+    
+    # Tasks of the asynchronous operations await the steps
+    _run_steps = staticmethod(steps.run_async)
+    
+    @tracing.traced("service.provision")
+    async def provision(self, instance_id, details, async_allowed=False):
+        """Provision the new instance
+        
+        see AtlasBroker.provision
+        
+        Returns:
+            ProvisionedServiceSpec
+        
+        Raises:
+            ErrPlanUnsupported: Plan not supported
+            ErrInstanceAlreadyExists: If instance exists but with different parameters
+            ErrClusterNotFound: Cluster does not exist
+        """
+        with metrics.observe_operation("provision"):
+            return await self._flights.do(request_key("provision", instance_id, None, details.parameters, async_allowed, details.plan_id),
+                                          self._leased, instance_id, None, steps.run_async, self._provision_steps(instance_id, details, async_allowed))
+    
+    @tracing.traced("service.get_instance")
+    async def get_instance(self, instance_id):
+        """Fetch an instance
+        
+        see AtlasBroker.get_instance
+        
+        Returns:
+            GetInstanceDetailsSpec
+        
+        Raises:
+            ErrInstanceDoesNotExist: Instance does not exist.
+        """
+        with metrics.observe_operation("get_instance"):
+            return await steps.run_async(self._get_instance_steps(instance_id))
+    
+    @tracing.traced("service.deprovision")
+    async def deprovision(self, instance_id, details, async_allowed=False):
+        """Deprovision an instance
+        
+        see AtlasBroker.deprovision
+        
+        Returns:
+            DeprovisionServiceSpec
+        
+        Raises:
+            ErrInstanceDoesNotExist: Instance does not exist.
+        """
+        with metrics.observe_operation("deprovision"):
+            return await self._flights.do(request_key("deprovision", instance_id, None, None, async_allowed),
+                                          self._leased, instance_id, None, steps.run_async, self._deprovision_steps(instance_id, async_allowed))
+    
+    @tracing.traced("service.bind")
+    async def bind(self, instance_id, binding_id, details, async_allowed=False):
+        """Binding the instance
+        
+        see AtlasBroker.bind
+        
+        Returns:
+            Binding
+        
+        Raises:
+            ErrBindingAlreadyExists: If binding exists but with different parameters
+        """
+        with metrics.observe_operation("bind"):
+            return await self._flights.do(request_key("bind", instance_id, binding_id, details.parameters, async_allowed),
+                                          self._leased, instance_id, binding_id, steps.run_async, self._bind_steps(instance_id, binding_id, details, async_allowed))
+    
+    @tracing.traced("service.get_binding")
+    async def get_binding(self, instance_id, binding_id):
+        """Fetch a binding
+        
+        see AtlasBroker.get_binding
+        
+        Returns:
+            GetBindingSpec
+        
+        Raises:
+            ErrBindingDoesNotExist: Binding does not exist.
+            NotImplementedError: Credentials generation is not predictible
+        """
+        with metrics.observe_operation("get_binding"):
+            return await steps.run_async(self._get_binding_steps(instance_id, binding_id))
+    
+    @tracing.traced("service.unbind")
+    async def unbind(self, instance_id, binding_id, details, async_allowed=False):
+        """Unbinding the instance
+        
+        see AtlasBroker.unbind
+        
+        Returns:
+            UnbindSpec
+        
+        Raises:
+            ErrBindingDoesNotExist: Binding does not exist.
+        """
+        with metrics.observe_operation("unbind"):
+            return await self._flights.do(request_key("unbind", instance_id, binding_id, None, async_allowed),
+                                          self._leased, instance_id, binding_id, steps.run_async, self._unbind_steps(instance_id, binding_id, async_allowed))
+    
+    @tracing.traced("service.last_operation")
+    async def last_operation(self, instance_id, operation_data):
+        """Last Operation
+        
+        see AtlasBroker.last_operation
+        
+        Returns:
+            LastOperation
+        
+        Raises:
+            NotImplementedError: Asynchronous operations are disabled
+        """
+        with metrics.observe_operation("last_operation"):
+            return await steps.run_async(self._last_operation_steps(instance_id, None, operation_data))
+    
+    @tracing.traced("service.last_binding_operation")
+    async def last_binding_operation(self, instance_id, binding_id, operation_data):
+        """Last Binding Operation
+        
+        see AtlasBroker.last_binding_operation
+        
+        Returns:
+            LastOperation
+        
+        Raises:
+            NotImplementedError: Asynchronous operations are disabled
+        """
+        with metrics.observe_operation("last_binding_operation"):
+            return await steps.run_async(self._last_operation_steps(instance_id, binding_id, operation_data))
@@ -0,0 +1,436 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""aiostorage module
+
+Storage for the asyncio broker (see asgi module)
+"""
+
+import asyncio
+import datetime
+import logging
+import pymongo
+from contextlib import asynccontextmanager
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+from . import metrics, steps, tracing
+from .breaker import CircuitBreaker, guarded
+from .storage import AtlasBrokerStorageBase, AtlasBrokerStorage, bounded
+from .errors import ErrStorageConnection, ErrStorageMongoConnection
+
+logger = logging.getLogger("atlasbroker.storage")
+
+class AsyncAtlasBrokerStorageBase(AtlasBrokerStorageBase):
+    """ Async Storage interface
+    
+    Same interface than AtlasBrokerStorageBase but populate, populate_binding, store,
+    upsert, complete_claim, remove, save_operation, find_operation and ping are coroutines and lease is an
+    asynchronous context manager. A driver implements the documents primitives as coroutines,
+    the logic around them is the one of AtlasBrokerStorageBase (see steps module).
+    
+    Constructor
+    
+    Keyword Arguments:
+        cache (dict): Enable the read-through cache eg: {"maxsize": 1024, "ttl": 30, "negative_ttl": 5}
+        upsert (bool): Create instances and bindings with an atomic upsert (see upsert)
+    """
+    
+    # Steps of the storage wait with the event loop
+    _sleep = staticmethod(asyncio.sleep)
+    
+    @metrics.timed(metrics.STORAGE_SECONDS, "populate")
+    @tracing.traced("storage.populate")
+    @bounded
+    @guarded((ErrStorageConnection,))
+    async def populate(self, obj):
+        return await steps.run_async(self._populate_steps(obj))
+    
+    @metrics.timed(metrics.STORAGE_SECONDS, "populate_binding")
+    @tracing.traced("storage.populate_binding")
+    @bounded
+    @guarded((ErrStorageConnection,))
+    async def populate_binding(self, binding):
+        return await steps.run_async(self._populate_binding_steps(binding))
+    
+    @metrics.timed(metrics.STORAGE_SECONDS, "store")
+    @tracing.traced("storage.store")
+    @bounded
+    @guarded((ErrStorageConnection,))
+    async def store(self, obj):
+        return await steps.run_async(self._store_steps(obj))
+    
+    @metrics.timed(metrics.STORAGE_SECONDS, "upsert")
+    @tracing.traced("storage.upsert")
+    @bounded
+    @guarded((ErrStorageConnection,))
+    async def upsert(self, obj):
+        return await steps.run_async(self._upsert_steps(obj))
+    
+    @metrics.timed(metrics.STORAGE_SECONDS, "complete_claim")
+    @tracing.traced("storage.complete_claim")
+    @bounded
+    @guarded((ErrStorageConnection,))
+    async def complete_claim(self, binding):
+        return await steps.run_async(self._complete_claim_steps(binding))
+    
+    @metrics.timed(metrics.STORAGE_SECONDS, "remove")
+    @tracing.traced("storage.remove")
+    @bounded
+    @guarded((ErrStorageConnection,))
+    async def remove(self, obj):
+        return await steps.run_async(self._remove_steps(obj))
+    
+    async def remove_instance(self, instance):
+        return await steps.run_async(self._remove_steps(instance))
+    
+    async def remove_binding(self, binding):
+        return await steps.run_async(self._remove_steps(binding))
+    
+    async def _find_pair(self, instance_id, binding_id):
+        return await self._find_one(instance_id), await self._find_one(instance_id, binding_id)
+    
+    @asynccontextmanager
+    async def lease(self, instance_id, binding_id=None):
+        """ Lease (see AtlasBrokerStorageBase.lease)
+        
+        Args:
+            instance_id (str): UUID of the instance
+        
+        Keyword Arguments:
+            binding_id (str): UUID of the binding
+        """
+        yield
+    
+    async def ping(self):
+        """ Check the storage backend is reachable (nothing to check by default)
+        
+        Raises:
+            ErrStorageConnection: The backend is not reachable
+        """
+        pass
+    
+    async def open(self):
+        """ Prepare the storage (called once the event loop is running) """
+        pass
+    
+    async def close(self):
+        """ Release the storage """
+        pass
+
+class AsyncAtlasBrokerStorage(AsyncAtlasBrokerStorageBase):
+    """ Async Storage
+    
+    Permit to store ServiceInstance and ServiceBinding into a MongoDB with the asyncio API
+    of pymongo (pymongo.AsyncMongoClient). Documents and indexes are the same than AtlasBrokerStorage.
+    
+    Constructor
+    
+    Args:
+        uri (str): MongoDB connection string
+        timeoutms (int): MongoDB requests timeout in ms
+        db (str): The DB name
+        collection (str): The collection name
+    
+    Keyword Arguments:
+        cache (dict): Enable the read-through cache eg: {"maxsize": 1024, "ttl": 30, "negative_ttl": 5}
+        upsert (bool): Create instances and bindings with an atomic upsert (see upsert)
+        client_options (dict): pymongo.AsyncMongoClient options eg: {"maxPoolSize": 50}
+        lease (dict): Enable leases (see AtlasBrokerStorage.lease) eg: {"ttl": 30, "wait": 10, "retry_interval": 0.1}
+        breaker (dict): CircuitBreaker options eg: {"failure_threshold": 5, "open_seconds": 30}
+    """
+    
+    def __init__(self, uri, timeoutms, db, collection, cache=None, upsert=False, client_options=None, lease=None, breaker=None):
+        super().__init__(cache=cache, upsert=upsert)
+        self.breaker = CircuitBreaker("storage", **breaker) if breaker else None
+        self.timeoutms = timeoutms
+        self.lease_options = lease
+        
+        # Nothing is done on the network before the first operation
+        self.mongo_client = pymongo.AsyncMongoClient(uri, **AtlasBrokerStorage.client_options(timeoutms, client_options))
+        self.db = self.mongo_client[db]
+        self.broker = self.db.get_collection(collection)
+        self.operations = self.db.get_collection(collection + "_operations")
+        self.leases = self.db.get_collection(collection + "_leases")
+    
+    async def open(self):
+        """ Create missing indexes
+        
+        Outdated and legacy indexes are reconciled by AtlasBrokerStorage.ensure_indexes
+        """
+        try:
+            # Operations in progress of an instance or a binding and records of old operations
+            await self.operations.create_index([ ("instance_id", pymongo.ASCENDING), ("binding_id", pymongo.ASCENDING) ],
+                                               name="instance_id_binding_id")
+            await self.operations.create_index("expires", name="expires", expireAfterSeconds=0)
+        except Exception as e:
+            logger.warning("mongo: indexes: operations: %s", str(e))
+        
+        if self.lease_options:
+            try:
+                # Leases of dead brokers are removed by MongoDB
+                await self.leases.create_index("expires", name="expires", expireAfterSeconds=0)
+            except Exception as e:
+                logger.warning("mongo: indexes: expires: %s", str(e))
+        
+        for index in AtlasBrokerStorage.INDEXES:
+            options = { k:v for k,v in index.items() if k != "keys" }
+            try:
+                await self.broker.create_index(index["keys"], **options)
+            except Exception as e:
+                logger.warning("mongo: indexes: %s: %s", index["name"], str(e))
+    
+    async def close(self):
+        await self.mongo_client.close()
+    
+    async def ping(self):
+        try:
+            await self.mongo_client.admin.command("ping")
+        except:
+            raise ErrStorageMongoConnection("Ping")
+    
+    # Same queries, timeouts and leases than AtlasBrokerStorage
+    _query = AtlasBrokerStorage._query
+    _pair_query = AtlasBrokerStorage._pair_query
+    _pending_query = AtlasBrokerStorage._pending_query
+    _to_operation_document = AtlasBrokerStorage._to_operation_document
+    _from_operation_document = AtlasBrokerStorage._from_operation_document
+    deadline_scope = AtlasBrokerStorage.deadline_scope
+    _lease_key = AtlasBrokerStorage._lease_key
+    _lease_ttl = AtlasBrokerStorage._lease_ttl
+    _acquire_lease_steps = AtlasBrokerStorage._acquire_lease_steps
+    
+    async def _find_one(self, instance_id, binding_id=None):
+        try:
+            return await self.broker.find_one(self._query(instance_id, binding_id))
+        except:
+            raise ErrStorageMongoConnection("Populate Instance or Binding")
+    
+    async def _find_pair(self, instance_id, binding_id):
+        query = self._pair_query(instance_id, binding_id)
+        
+        # find
+        try:
+            results = await self.broker.find(query, projection={ "binding_id" : True, "parameters" : True, "credentials_key" : True, "pending" : True }).to_list(None)
+        except:
+            raise ErrStorageMongoConnection("Populate Instance and Binding")
+        
+        instance_result = None
+        binding_result = None
+        for result in results:
+            if "binding_id" in result:
+                binding_result = result
+            else:
+                instance_result = result
+        
+        return instance_result, binding_result
+    
+    async def _insert_one(self, document):
+        try:
+            result = await self.broker.insert_one(document)
+        except:
+            raise ErrStorageMongoConnection("Store Instance or Binding")
+        
+        if result is not None:
+            return result.inserted_id
+        return None
+    
+    async def _insert_if_absent(self, document):
+        query = self._query(document["instance_id"], document.get("binding_id", None))
+        
+        # Fields of the query are set by the upsert itself
+        document = { k:v for k,v in document.items() if k not in ("instance_id", "binding_id") }
+        
+        # Our own _id permits to know if the document returned was inserted by this call
+        _id = ObjectId()
+        document["_id"] = _id
+        
+        try:
+            try:
+                result = await self.broker.find_one_and_update(query,
+                                                               { "$setOnInsert" : document },
+                                                               upsert=True,
+                                                               return_document=pymongo.ReturnDocument.AFTER)
+            except DuplicateKeyError:
+                # A concurrent upsert inserted it first
+                result = await self.broker.find_one(query)
+        except:
+            raise ErrStorageMongoConnection("Upsert Instance or Binding")
+        
+        return result, result is not None and result["_id"] == _id
+    
+    async def _complete_one(self, instance_id, binding_id):
+        try:
+            result = await self.broker.update_one(self._query(instance_id, binding_id), { "$unset" : { "pending" : "" } })
+        except:
+            raise ErrStorageMongoConnection("Store Binding")
+        
+        if result is None:
+            return 0
+        return result.matched_count
+    
+    async def _delete_one(self, instance_id, binding_id=None):
+        try:
+            result = await self.broker.delete_one(self._query(instance_id, binding_id))
+        except:
+            if binding_id is None:
+                raise ErrStorageMongoConnection("Remove Instance")
+            raise ErrStorageMongoConnection("Remove Binding")
+        
+        if result is None:
+            return 0
+        return result.deleted_count
+    
+    async def save_operation(self, operation):
+        try:
+            await self.operations.replace_one({ "_id" : operation["_id"] }, self._to_operation_document(operation), upsert=True)
+        except:
+            raise ErrStorageMongoConnection("Save Operation")
+    
+    async def find_operation(self, operation_id):
+        try:
+            return self._from_operation_document(await self.operations.find_one({ "_id" : operation_id }))
+        except:
+            raise ErrStorageMongoConnection("Find Operation")
+    
+    async def find_pending_operation(self, kind, instance_id, binding_id=None):
+        try:
+            return self._from_operation_document(await self.operations.find_one(self._pending_query(kind, instance_id, binding_id),
+                                                                                 sort=[ ("updated", pymongo.DESCENDING) ]))
+        except:
+            raise ErrStorageMongoConnection("Find Operation")
+    
+    @asynccontextmanager
+    async def lease(self, instance_id, binding_id=None):
+        """ Lease (see AtlasBrokerStorage.lease)
+        
+        Args:
+            instance_id (str): UUID of the instance
+        
+        Keyword Arguments:
+            binding_id (str): UUID of the binding
+        
+        Raises:
+            ErrStorageLeaseTimeout: The lease is held by another broker for too long
+            ErrStorageMongoConnection: Error during MongoDB communication.
+        """
+        if not self.lease_options:
+            yield
+            return
+        
+        key = self._lease_key(instance_id, binding_id)
+        with tracing.span("storage.acquire_lease"):
+            token = await steps.run_async(self._acquire_lease_steps(key))
+        
+        renewal = asyncio.ensure_future(self._renew_lease_loop(key, token))
+        try:
+            yield
+        finally:
+            renewal.cancel()
+            await self._release_lease(key, token)
+    
+    async def _try_lease(self, key, token):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            with self.deadline_scope():
+                await self.leases.find_one_and_update({ "_id" : key, "expires" : { "$lte" : now } },
+                                                      { "$set" : { "owner" : token, "expires" : now + self._lease_ttl() } },
+                                                      upsert=True)
+            return True
+        except DuplicateKeyError:
+            return False
+        except:
+            raise ErrStorageMongoConnection("Acquire Lease")
+    
+    async def _renew_lease_loop(self, key, token):
+        """ Renew a lease until cancelled (see AtlasBrokerStorage._renew_lease_loop)
+        
+        Args:
+            key (str): Key of the lease
+            token (str): Token of the owner
+        """
+        while True:
+            await asyncio.sleep(self._lease_ttl().total_seconds() / 3)
+            if not await self._renew_lease(key, token):
+                logger.warning("mongo: lease: %s: lost", key)
+                return
+    
+    async def _renew_lease(self, key, token):
+        try:
+            result = await self.leases.update_one({ "_id" : key, "owner" : token },
+                                                  { "$set" : { "expires" : datetime.datetime.now(datetime.timezone.utc) + self._lease_ttl() } })
+        except Exception as e:
+            # Retried at the next renewal
+            logger.warning("mongo: lease: %s: %s", key, str(e))
+            return True
+        
+        return result.matched_count == 1
+    
+    async def _release_lease(self, key, token):
+        try:
+            await self.leases.delete_one({ "_id" : key, "owner" : token })
+        except Exception as e:
+            # The lease will expire
+            logger.warning("mongo: lease: %s: %s", key, str(e))
+
+class AsyncStorageAdapter(AsyncAtlasBrokerStorageBase):
+    """ Async Storage Adapter
+    
+    Use a storage driver without asyncio support (memory, sqlite) with the asyncio broker.
+    The documents primitives of the driver are called in the default executor.
+    
+    Constructor
+    
+    Args:
+        storage (AtlasBrokerStorageBase): The storage driver
+    
+    Keyword Arguments:
+        cache (dict): Enable the read-through cache eg: {"maxsize": 1024, "ttl": 30, "negative_ttl": 5}
+    """
+    
+    def __init__(self, storage, cache=None):
+        super().__init__(cache=cache, upsert=storage.use_upsert)
+        self.storage = storage
+    
+    async def _call(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+    
+    async def ping(self):
+        return await self._call(self.storage.ping)
+    
+    async def _find_one(self, instance_id, binding_id=None):
+        return await self._call(self.storage._find_one, instance_id, binding_id)
+    
+    async def _find_pair(self, instance_id, binding_id):
+        return await self._call(self.storage._find_pair, instance_id, binding_id)
+    
+    async def _insert_one(self, document):
+        return await self._call(self.storage._insert_one, document)
+    
+    async def _insert_if_absent(self, document):
+        return await self._call(self.storage._insert_if_absent, document)
+    
+    async def _complete_one(self, instance_id, binding_id):
+        return await self._call(self.storage._complete_one, instance_id, binding_id)
+    
+    async def _delete_one(self, instance_id, binding_id=None):
+        return await self._call(self.storage._delete_one, instance_id, binding_id)
+    
+    async def save_operation(self, operation):
+        return await self._call(self.storage.save_operation, operation)
+    
+    async def find_operation(self, operation_id):
+        return await self._call(self.storage.find_operation, operation_id)
+    
+    async def find_pending_operation(self, kind, instance_id, binding_id=None):
+        return await self._call(self.storage.find_pending_operation, kind, instance_id, binding_id)
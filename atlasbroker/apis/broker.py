@@ -14,16 +14,87 @@
 
 """Broker"""
 
+import logging
 from openbrokerapi.api import *
-from openbrokerapi.log_util import *
 
+from flask import Response, g, request
+from atlasbroker import admission, httperrors, metrics
+from atlasbroker.catalog import CatalogCache
 from atlasbroker.service import AtlasBroker
 
-def getApi(config):
+def getApi(config, service_broker=None):
     """Get Api for the broker
     
+    Args:
+        config (Config): The broker configuration
+    
+    Keyword Arguments:
+        service_broker (AtlasBroker): The broker to serve (created from config if None)
+    
     Returns:
         Blueprint: section for the broker
     """
-    api = get_blueprint([AtlasBroker(config)], None, basic_config())
+    if service_broker is None:
+        service_broker = AtlasBroker(config)
+    # Records of openbrokerapi go through the queue of the broker (see logs module)
+    api = get_blueprint(service_broker, None, logging.getLogger("atlasbroker.api"))
+    controls = admission.lanes(config.options.get("admission", None))
+    
+    @api.before_request
+    def admit():
+        '''Take a slot of the lane of the operation (admission control)
+        
+        Filters of openbrokerapi (version, authentication) are applied before.
+        '''
+        if request.endpoint is None:
+            return None
+        
+        control = controls.get(admission.lane(request.endpoint.split(".")[-1]), None)
+        if control is not None:
+            control.enter()
+            g.admission = control
+        return None
+    
+    @api.teardown_request
+    def release(exc):
+        '''Release the slot taken by admit'''
+        control = g.pop("admission", None)
+        if control is not None:
+            control.exit()
+    
+    @api.before_request
+    def catalog():
+        '''Serve the precomputed catalog with its ETag
+        
+        Filters of openbrokerapi (version, authentication) are applied before.
+        '''
+        if request.endpoint != "open_broker.catalog":
+            return None
+        
+        with metrics.observe_operation("catalog"):
+            body, etag = service_broker.catalog_cache.response
+            if CatalogCache.not_modified(etag, request.headers.get("If-None-Match", None)):
+                return Response(status=304, headers={ "ETag" : etag })
+            return Response(body, mimetype="application/json", headers={ "ETag" : etag })
+    
+    @api.errorhandler(errors.ErrBindingDoesNotExist)
+    def binding_does_not_exist(e):
+        '''Answer 410 Gone to last_binding_operation for an unknown operation
+        
+        Other routes of openbrokerapi handle ErrBindingDoesNotExist themselves.
+        '''
+        return to_json_response(LastOperationResponse(OperationState.SUCCEEDED, "")), HTTPStatus.GONE
+    
+    def broker_error(e):
+        '''Answer the errors of the broker (see httperrors)
+        
+        Routes of openbrokerapi answer ErrConcurrentInstanceAccess themselves, except get_binding
+        and last_binding_operation.
+        '''
+        status, payload, headers = httperrors.answer(e)
+        return to_json_response(payload), status, headers
+    
+    for cls, *_ in httperrors.ERRORS:
+        api.register_error_handler(cls, broker_error)
+    
     return api
@@ -16,8 +16,11 @@
 
 from flask import Blueprint, jsonify
 
-def getApi():
-    """Get Api for /health
+def getApi(readiness=None):
+    """Get Api for /health and /ready
+    
+    Keyword Arguments:
+        readiness (ReadinessProbe): Readiness of the dependencies (/ready is not served if None)
     
     Returns:
         Blueprint: section for healt check
@@ -28,5 +31,12 @@ def getApi():
     def health():
         '''Health check'''
         return jsonify({ "status" : True})
+    
+    if readiness is not None:
+        @api.route('ready', methods=['GET'])
+        def ready():
+            '''Readiness check (last result of the background checks)'''
+            status = readiness.status()
+            return jsonify(status), 200 if status["status"] else 503
 
     return api
@@ -0,0 +1,37 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Metrics"""
+
+from flask import Blueprint, Response
+from atlasbroker import metrics as broker_metrics
+
+def getApi():
+    """Get Api for /metrics
+    
+    Returns:
+        Blueprint: section for Prometheus metrics
+    """
+    api = Blueprint('metrics', __name__, url_prefix='/')
+    
+    @api.route('metrics', methods=['GET'])
+    def metrics():
+        '''Prometheus metrics'''
+        if not broker_metrics.AVAILABLE:
+            return Response("prometheus_client is not installed\n", status=501, mimetype="text/plain")
+        
+        body, content_type = broker_metrics.export()
+        return Response(body, content_type=content_type)
+    
+    return api
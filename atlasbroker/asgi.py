@@ -0,0 +1,447 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""asgi module
+
+ASGI application of the broker (needs uvicorn and httpx: pip3 install atlasbroker[asgi])
+"""
+
+import inspect
+import json
+import logging
+import re
+from contextlib import contextmanager
+from http import HTTPStatus
+from urllib.parse import parse_qs
+from openbrokerapi import constants
+from openbrokerapi.errors import (
+    ErrBadRequest,
+    ErrBindingAlreadyExists,
+    ErrBindingDoesNotExist,
+    ErrInstanceAlreadyExists,
+    ErrInstanceDoesNotExist
+)
+from openbrokerapi.helper import version_tuple
+from openbrokerapi.response import (
+    BindResponse,
+    DeprovisionResponse,
+    EmptyResponse,
+    ErrorResponse,
+    GetBindingResponse,
+    GetInstanceResponse,
+    LastOperationResponse,
+    ProvisioningResponse,
+    UnbindResponse
+)
+from openbrokerapi.service_broker import (
+    BindDetails,
+    BindState,
+    DeprovisionDetails,
+    OperationState,
+    ProvisionDetails,
+    ProvisionState,
+    UnbindDetails
+)
+from openbrokerapi.settings import MIN_VERSION
+from . import admission, deadline, httperrors, logs, metrics
+from .admission import AsyncAdmissionControl
+from .aioservice import AsyncAtlasBroker
+from .catalog import CatalogCache
+
+logger = logging.getLogger("atlasbroker.asgi")
+
+def _json_default(obj):
+    """Serialize openbrokerapi objects like openbrokerapi does"""
+    return { k:v for k,v in vars(obj).items() if v is not None and not k.startswith("_") }
+
+@contextmanager
+def _bad_request():
+    """Errors reading a request are bad requests like with openbrokerapi
+    
+    Raises:
+        ErrBadRequest: TypeError, KeyError or ValueError in the block
+    """
+    try:
+        yield
+    except (TypeError, KeyError, ValueError) as e:
+        raise ErrBadRequest(str(e))
+
+def _json_body(headers, body):
+    """JSON body of a request (see openbrokerapi.request_filter.requires_application_json)
+    
+    Args:
+        headers (dict): Headers of the request (lower case names)
+        body (bytes): Request body
+    
+    Returns:
+        The JSON body
+    
+    Raises:
+        ErrBadRequest: The body is not application/json
+    """
+    mimetype = headers.get("content-type", "").split(";")[0].strip().lower()
+    fields = None
+    if mimetype == "application/json" or (mimetype.startswith("application/") and mimetype.endswith("+json")):
+        try:
+            fields = json.loads(body)
+        except ValueError:
+            pass
+    
+    if fields is None:
+        raise ErrBadRequest('Improper Content-Type header. Expecting "application/json"')
+    return fields
+
+def _details(cls, fields):
+    """Details of a request from its JSON body
+    
+    Fields unknown by cls (added by a newer version of the API) are ignored.
+    
+    Args:
+        cls (type): ProvisionDetails or BindDetails
+        fields: JSON body of the request
+    
+    Returns:
+        The details
+    
+    Raises:
+        TypeError: The body is not a JSON object or a required field is missing
+    """
+    if not isinstance(fields, dict):
+        raise TypeError("The body is not a JSON object.")
+    
+    parameters = inspect.signature(cls).parameters
+    if not any(p.kind is inspect.Parameter.VAR_KEYWORD for p in parameters.values()):
+        fields = { k:v for k,v in fields.items() if k in parameters }
+    
+    return cls(**fields)
+
+def _accepts_incomplete(query):
+    """The platform accepts an asynchronous operation
+    
+    Args:
+        query (dict): Query of the request
+    
+    Returns:
+        bool: accepts_incomplete=true
+    """
+    return query.get("accepts_incomplete", "false") == "true"
+
+class Text:
+    """A response payload that is not JSON
+    
+    Args:
+        content (bytes): The payload
+        content_type (str): The content type
+    
+    Keyword Arguments:
+        headers (dict): Additional headers
+    """
+    def __init__(self, content, content_type, headers=None):
+        self.content = content
+        self.content_type = content_type
+        self.headers = headers or {}
+
+def _error(e):
+    """Answer of an error like the Flask broker (see httperrors)
+    
+    Args:
+        e (Exception): The error
+    
+    Returns:
+        HTTPStatus, object: The status and the payload or None if the error is unexpected
+    """
+    answer = httperrors.answer(e)
+    if answer is None:
+        return None
+    
+    status, payload, headers = answer
+    return status, Text(json.dumps(payload, default=_json_default).encode(), "application/json", headers)
+
+class AsgiBroker:
+    """ASGI Broker
+    
+    Serve the Open Service Broker API, /health, /ready and /metrics with AsyncAtlasBroker on an asyncio
+    server (eg: uvicorn). Routes and responses are the same than the Flask broker (update is not
+    implemented by both).
+    
+    Constructor
+    
+    Args:
+        config (Config): The broker configuration
+    """
+    
+    # method, path, handler name
+    ROUTES = [
+        ("GET", re.compile(r"^/health$"), "health"),
+        ("GET", re.compile(r"^/ready$"), "ready"),
+        ("GET", re.compile(r"^/metrics$"), "metrics"),
+        ("GET", re.compile(r"^/v2/catalog$"), "catalog"),
+        ("PUT", re.compile(r"^/v2/service_instances/(?P<instance_id>[^/]+)$"), "provision"),
+        ("GET", re.compile(r"^/v2/service_instances/(?P<instance_id>[^/]+)$"), "get_instance"),
+        ("DELETE", re.compile(r"^/v2/service_instances/(?P<instance_id>[^/]+)$"), "deprovision"),
+        ("GET", re.compile(r"^/v2/service_instances/(?P<instance_id>[^/]+)/last_operation$"), "last_operation"),
+        ("PUT", re.compile(r"^/v2/service_instances/(?P<instance_id>[^/]+)/service_bindings/(?P<binding_id>[^/]+)$"), "bind"),
+        ("GET", re.compile(r"^/v2/service_instances/(?P<instance_id>[^/]+)/service_bindings/(?P<binding_id>[^/]+)$"), "get_binding"),
+        ("DELETE", re.compile(r"^/v2/service_instances/(?P<instance_id>[^/]+)/service_bindings/(?P<binding_id>[^/]+)$"), "unbind"),
+        ("GET", re.compile(r"^/v2/service_instances/(?P<instance_id>[^/]+)/service_bindings/(?P<binding_id>[^/]+)/last_operation$"), "last_binding_operation"),
+        ]
+    
+    def __init__(self, config):
+        self.broker = AsyncAtlasBroker(config)
+        self.deadline = config.options.get("deadline", None)
+        self.admission = admission.lanes(config.options.get("admission", None), AsyncAdmissionControl)
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            body = b""
+            while True:
+                message = await receive()
+                body += message.get("body", b"")
+                if not message.get("more_body", False):
+                    break
+            
+            headers = { k.decode().lower():v.decode() for k,v in scope.get("headers", []) }
+            request_id = logs.start_request(headers.get("x-request-id", None))
+            if self.deadline is not None:
+                header = self.deadline.get("header", None)
+                deadline.start(deadline.budget(self.deadline, headers.get(header.lower(), None) if header else None))
+            
+            status, payload = await self.dispatch(scope, body)
+            
+            extra_headers = {}
+            if isinstance(payload, Text):
+                content, content_type, extra_headers = payload.content, payload.content_type, payload.headers
+            else:
+                content, content_type = json.dumps(payload, default=_json_default).encode(), "application/json"
+            
+            await send({ "type" : "http.response.start",
+                         "status" : int(status),
+                         "headers" : [ (b"content-type", content_type.encode()),
+                                       (b"content-length", str(len(content)).encode()),
+                                       (b"x-request-id", request_id.encode()) ]
+                                     + [ (k.lower().encode(), v.encode()) for k,v in extra_headers.items() ] })
+            await send({ "type" : "http.response.body", "body" : content })
+    
+    async def lifespan(self, receive, send):
+        """Open the broker at startup and close it at shutdown"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.broker.open()
+                except Exception as e:
+                    logger.error("asgi: startup: %s", str(e))
+                    await send({ "type" : "lifespan.startup.failed", "message" : str(e) })
+                    return
+                await send({ "type" : "lifespan.startup.complete" })
+            elif message["type"] == "lifespan.shutdown":
+                await self.broker.close()
+                await send({ "type" : "lifespan.shutdown.complete" })
+                return
+    
+    async def dispatch(self, scope, body):
+        """Route a request
+        
+        Args:
+            scope (dict): ASGI scope
+            body (bytes): Request body
+        
+        Returns:
+            HTTPStatus, object: The status and the payload
+        """
+        path = scope["path"]
+        allowed = False
+        
+        for method, pattern, name in self.ROUTES:
+            match = pattern.match(path)
+            if match is None:
+                continue
+            if method != scope["method"]:
+                allowed = True
+                continue
+            
+            headers = { k.decode().lower():v.decode() for k,v in scope.get("headers", []) }
+            if path.startswith("/v2/"):
+                version = headers.get("x-broker-api-version", None)
+                if version is None:
+                    return HTTPStatus.BAD_REQUEST, ErrorResponse(description="No X-Broker-Api-Version found.")
+                if version_tuple(version) < MIN_VERSION:
+                    return HTTPStatus.PRECONDITION_FAILED, ErrorResponse(description="Service broker requires version %d.%d+." % MIN_VERSION)
+            
+            query = { k:v[0] for k,v in parse_qs(scope.get("query_string", b"").decode()).items() }
+            
+            control = self.admission.get(admission.lane(name), None) if path.startswith("/v2/") else None
+            
+            try:
+                if control is None:
+                    return await getattr(self, name)(body=body, query=query, headers=headers, **match.groupdict())
+                async with control.admit():
+                    return await getattr(self, name)(body=body, query=query, headers=headers, **match.groupdict())
+            except ErrBadRequest as e:
+                return HTTPStatus.BAD_REQUEST, ErrorResponse(description=str(e))
+            except NotImplementedError:
+                return HTTPStatus.NOT_IMPLEMENTED, ErrorResponse(description=constants.DEFAULT_NOT_IMPLEMENTED_ERROR_MESSAGE)
+            except Exception as e:
+                answer = _error(e)
+                if answer is not None:
+                    return answer
+                logger.exception("asgi: %s %s: %s", scope["method"], path, str(e))
+                return HTTPStatus.INTERNAL_SERVER_ERROR, ErrorResponse(description=constants.DEFAULT_EXCEPTION_ERROR_MESSAGE)
+        
+        if allowed:
+            return HTTPStatus.METHOD_NOT_ALLOWED, ErrorResponse(description="Method not allowed")
+        return HTTPStatus.NOT_FOUND, ErrorResponse(description="Not found")
+    
+    def _check_plan(self, plan_id):
+        """Check that the plan is in the catalog
+        
+        Raises:
+            TypeError: plan_id not found
+        """
+        if plan_id not in [ plan.id for plan in self.broker.catalog().plans ]:
+            raise TypeError("plan_id not found in this service.")
+    
+    async def health(self, body, query, headers):
+        return HTTPStatus.OK, { "status" : True }
+    
+    async def ready(self, body, query, headers):
+        status = self.broker.readiness.status()
+        return HTTPStatus.OK if status["status"] else HTTPStatus.SERVICE_UNAVAILABLE, status
+    
+    async def metrics(self, body, query, headers):
+        if not metrics.AVAILABLE:
+            return HTTPStatus.NOT_IMPLEMENTED, Text(b"prometheus_client is not installed\n", "text/plain")
+        return HTTPStatus.OK, Text(*metrics.export())
+    
+    async def catalog(self, body, query, headers):
+        with metrics.observe_operation("catalog"):
+            body, etag = self.broker.catalog_cache.response
+            if CatalogCache.not_modified(etag, headers.get("if-none-match", None)):
+                return HTTPStatus.NOT_MODIFIED, Text(b"", "application/json", { "ETag" : etag })
+            return HTTPStatus.OK, Text(body, "application/json", { "ETag" : etag })
+    
+    async def provision(self, body, query, headers, instance_id):
+        fields = _json_body(headers, body)
+        with _bad_request():
+            details = _details(ProvisionDetails, fields)
+            self._check_plan(details.plan_id)
+        
+        try:
+            result = await self.broker.provision(instance_id, details, _accepts_incomplete(query))
+        except ErrInstanceAlreadyExists:
+            return HTTPStatus.CONFLICT, EmptyResponse()
+        
+        response = ProvisioningResponse(result.dashboard_url, result.operation)
+        if result.state == ProvisionState.IS_ASYNC:
+            return HTTPStatus.ACCEPTED, response
+        elif result.state == ProvisionState.IDENTICAL_ALREADY_EXISTS:
+            return HTTPStatus.OK, response
+        return HTTPStatus.CREATED, response
+    
+    async def get_instance(self, body, query, headers, instance_id):
+        try:
+            result = await self.broker.get_instance(instance_id)
+        except ErrInstanceDoesNotExist:
+            return HTTPStatus.NOT_FOUND, EmptyResponse()
+        
+        return HTTPStatus.OK, GetInstanceResponse(result.service_id, result.plan_id, result.dashboard_url, result.parameters)
+    
+    async def deprovision(self, body, query, headers, instance_id):
+        with _bad_request():
+            details = DeprovisionDetails(service_id=query["service_id"], plan_id=query["plan_id"])
+            self._check_plan(details.plan_id)
+        
+        try:
+            result = await self.broker.deprovision(instance_id, details, _accepts_incomplete(query))
+        except ErrInstanceDoesNotExist:
+            return HTTPStatus.GONE, EmptyResponse()
+        
+        if result.is_async:
+            return HTTPStatus.ACCEPTED, DeprovisionResponse(result.operation)
+        return HTTPStatus.OK, EmptyResponse()
+    
+    async def last_operation(self, body, query, headers, instance_id):
+        try:
+            result = await self.broker.last_operation(instance_id, query.get("operation", None))
+        except ErrInstanceDoesNotExist:
+            return HTTPStatus.GONE, LastOperationResponse(OperationState.SUCCEEDED, "")
+        
+        return HTTPStatus.OK, LastOperationResponse(result.state, result.description)
+    
+    async def bind(self, body, query, headers, instance_id, binding_id):
+        fields = _json_body(headers, body)
+        with _bad_request():
+            details = _details(BindDetails, fields)
+            self._check_plan(details.plan_id)
+        
+        try:
+            result = await self.broker.bind(instance_id, binding_id, details, _accepts_incomplete(query))
+        except ErrBindingAlreadyExists:
+            return HTTPStatus.CONFLICT, EmptyResponse()
+        
+        if result.state == BindState.IS_ASYNC:
+            return HTTPStatus.ACCEPTED, BindResponse(operation=result.operation)
+        
+        response = BindResponse(credentials=result.credentials)
+        if result.state == BindState.IDENTICAL_ALREADY_EXISTS:
+            return HTTPStatus.OK, response
+        return HTTPStatus.CREATED, response
+    
+    async def get_binding(self, body, query, headers, instance_id, binding_id):
+        try:
+            result = await self.broker.get_binding(instance_id, binding_id)
+        except ErrBindingDoesNotExist:
+            return HTTPStatus.NOT_FOUND, EmptyResponse()
+        
+        return HTTPStatus.OK, GetBindingResponse(credentials=result.credentials)
+    
+    async def unbind(self, body, query, headers, instance_id, binding_id):
+        with _bad_request():
+            details = UnbindDetails(service_id=query["service_id"], plan_id=query["plan_id"])
+            self._check_plan(details.plan_id)
+        
+        try:
+            result = await self.broker.unbind(instance_id, binding_id, details, _accepts_incomplete(query))
+        except ErrBindingDoesNotExist:
+            return HTTPStatus.GONE, EmptyResponse()
+        
+        if result.is_async:
+            return HTTPStatus.ACCEPTED, UnbindResponse(result.operation)
+        return HTTPStatus.OK, EmptyResponse()
+    
+    async def last_binding_operation(self, body, query, headers, instance_id, binding_id):
+        try:
+            result = await self.broker.last_binding_operation(instance_id, binding_id, query.get("operation", None))
+        except ErrBindingDoesNotExist:
+            return HTTPStatus.GONE, LastOperationResponse(OperationState.SUCCEEDED, "")
+        
+        return HTTPStatus.OK, LastOperationResponse(result.state, result.description)
+
+def serve(config, options=None):
+    """Serve the broker with uvicorn
+    
+    Args:
+        config (Config): The broker configuration
+    
+    Keyword Arguments:
+        options (dict): uvicorn settings eg: {"port": 5000, "backlog": 2048, "limit_concurrency": 10000}
+    """
+    import uvicorn
+    
+    settings = { "host" : "0.0.0.0", "port" : 5000 }
+    settings.update(options or {})
+    
+    uvicorn.run(AsgiBroker(config), **settings)
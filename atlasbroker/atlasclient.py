@@ -0,0 +1,246 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""atlasclient module
+
+Atlas client shared by the broker
+"""
+
+import logging
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPDigestAuth
+from atlasapi.atlas import Atlas
+from atlasapi.network import Network
+from atlasapi.settings import Settings
+from . import deadline, metrics, steps, tracing
+from .breaker import CircuitBreaker
+from .ratelimit import TokenBucket, RetryPolicy
+
+logger = logging.getLogger("atlasbroker.atlas")
+
+class AtlasCalls:
+    """Atlas Calls
+    
+    Rate limit, retries and circuit breaker of the Atlas calls, shared by AtlasNetwork and
+    AsyncAtlas (see steps module). Subclasses have limiter, retry, breaker and timeout
+    attributes and implement the I/O steps: _acquire (a token of the limiter), _send (one
+    HTTP request) and _sleep.
+    """
+    
+    # Errors of the HTTP client counted as failures by the circuit breaker
+    TRANSPORT_ERRORS = ()
+    
+    def request_steps(self, method, uri, kwargs):
+        """Steps of a request
+        
+        Args:
+            method (str): HTTP method
+            uri (str): URI
+            kwargs (dict): Options of the HTTP client for the request
+        
+        Returns:
+            The last response
+        
+        Raises:
+            ErrAtlasRateLimited: No token of the rate limiter in time
+            ErrDependencyUnavailable: The circuit breaker is open
+            ErrDeadlineExceeded: The deadline of the request is over
+        """
+        deadline.check("atlas")
+        
+        if self.breaker is None:
+            return (yield from self._retry_steps(method, uri, kwargs))
+        
+        self.breaker.allow()
+        try:
+            r = yield from self._retry_steps(method, uri, kwargs)
+        except self.TRANSPORT_ERRORS:
+            self.breaker.failure()
+            raise
+        except BaseException:
+            # Rate limited, cut by the deadline or cancelled, Atlas was not judged
+            self.breaker.release()
+            raise
+        
+        if r.status_code >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return r
+    
+    def _retry_steps(self, method, uri, kwargs):
+        """Steps of a request with the rate limit and retries
+        
+        Returns:
+            The last response
+        """
+        endpoint = metrics.atlas_endpoint(uri)
+        attempt = 0
+        
+        while True:
+            if self.limiter is not None:
+                yield steps.call(self._acquire)
+            deadline.check("atlas")
+            
+            start = time.perf_counter()
+            with metrics.ATLAS_SECONDS.labels(method, endpoint).time(), \
+                 tracing.span("atlas.request", method=method, endpoint=endpoint, attempt=attempt) as span:
+                r = yield steps.call(self._send, method, uri, deadline.timeout(self.timeout), kwargs)
+                if span is not None:
+                    span.set_attribute("status_code", r.status_code)
+            
+            logger.debug("atlas: %s %s %d", method, endpoint, r.status_code,
+                         extra={ "duration_ms" : round((time.perf_counter() - start) * 1000, 3) })
+            
+            delay = self.retry.delay(attempt, r.status_code, r.headers.get("Retry-After", None))
+            left = deadline.remaining()
+            if delay is None or (left is not None and delay >= left):
+                # No retry after the deadline of the request
+                return r
+            
+            logger.warning("atlas: %s %s %d, retry in %.2fs", method, endpoint, r.status_code, delay)
+            metrics.ATLAS_RETRIES.labels(endpoint, str(r.status_code)).inc()
+            yield steps.call(self._sleep, delay)
+            attempt += 1
+
+class AtlasNetwork(AtlasCalls, Network):
+    """Atlas Network
+    
+    Network calls to Atlas with a persistent HTTP session.
+    
+    Connections are kept alive in a pool and reused by all calls. The digest authentication
+    is shared too: once the first challenge is answered, next requests send the
+    Authorization header directly and skip the extra 401 round trip. The digest
+    state is kept per thread by requests so this is safe for multi-threaded serving.
+    
+    Calls take a token of the rate limiter (see TokenBucket) and 429 or 5xx answers are
+    retried with backoff (see RetryPolicy). Calls fail fast while Atlas is down (see CircuitBreaker).
+    Calls and retries are bounded by the remaining time of the request (see deadline).
+    
+    Constructor
+    
+    Args:
+        user (str): Atlas user
+        password (str): Atlas password
+    
+    Keyword Arguments:
+        pool_connections (int): Number of connection pools (one per host)
+        pool_maxsize (int): Maximum number of connections kept alive per host
+        timeout (float): Requests timeout in seconds
+        rate_limit (dict): TokenBucket options eg: {"rate": 1.5, "burst": 10} (no limit if None)
+        retry (dict): RetryPolicy options eg: {"max_retries": 3, "backoff": 0.5}
+        limiter (TokenBucket): Rate limiter shared with other clients (takes precedence over rate_limit)
+        breaker (CircuitBreaker or dict): Circuit breaker or its options eg: {"failure_threshold": 5, "open_seconds": 30}
+    """
+    
+    # Errors of requests counted as failures by the circuit breaker
+    TRANSPORT_ERRORS = (requests.RequestException,)
+    
+    def __init__(self, user, password, pool_connections=1, pool_maxsize=10, timeout=None, rate_limit=None, retry=None, limiter=None, breaker=None):
+        super().__init__(user, password)
+        self.timeout = timeout if timeout is not None else Settings.requests_timeout
+        self.limiter = limiter if limiter is not None else (TokenBucket(**rate_limit) if rate_limit else None)
+        self.retry = RetryPolicy(**(retry or {}))
+        self.breaker = CircuitBreaker("atlas", **breaker) if isinstance(breaker, dict) else breaker
+        
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.auth = HTTPDigestAuth(user, password)
+    
+    def request(self, method, uri, **kwargs):
+        """Send a request
+        
+        Args:
+            method (str): HTTP method
+            uri (str): URI
+        
+        Returns:
+            requests.Response: The response
+        
+        Raises:
+            ErrAtlasRateLimited: No token of the rate limiter in time
+            ErrDependencyUnavailable: The circuit breaker is open
+            ErrDeadlineExceeded: The deadline of the request is over
+        """
+        return steps.run(self.request_steps(method, uri, kwargs))
+    
+    def _acquire(self):
+        self.limiter.acquire()
+    
+    def _send(self, method, uri, timeout, kwargs):
+        return self.session.request(method, uri, allow_redirects=True, timeout=timeout, **kwargs)
+    
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+    
+    def _json(self, r):
+        """Response payload
+        
+        Args:
+            r (requests.Response): The response
+        
+        Returns:
+            dict: The payload or an empty dict
+        """
+        try:
+            return r.json()
+        except ValueError:
+            return {}
+    
+    def get(self, uri):
+        r = self.request("GET", uri)
+        return self.answer(r.status_code, self._json(r))
+    
+    def post(self, uri, payload):
+        r = self.request("POST", uri, json=payload)
+        return self.answer(r.status_code, self._json(r))
+    
+    def patch(self, uri, payload):
+        r = self.request("PATCH", uri, json=payload)
+        return self.answer(r.status_code, self._json(r))
+    
+    def delete(self, uri):
+        r = self.request("DELETE", uri)
+        return self.answer(r.status_code, self._json(r))
+
+def create_atlas(credentials, options=None, limiter=None, breaker=None):
+    """Create an Atlas client
+    
+    Args:
+        credentials (dict): Atlas credentials eg: {"user" : "", "password": "", "group": ""}
+    
+    Keyword Arguments:
+        options (dict): AtlasNetwork options eg: {"pool_maxsize": 10, "timeout": 10}
+        limiter (TokenBucket): Rate limiter shared with other clients
+        breaker (CircuitBreaker): Circuit breaker shared with other clients
+    
+    Returns:
+        Atlas: Atlas client using an AtlasNetwork
+    """
+    options = dict(options or {})
+    if breaker is not None:
+        options["breaker"] = breaker
+    
+    atlas = Atlas(credentials["user"],
+                  credentials["password"],
+                  credentials["group"])
+    atlas.network = AtlasNetwork(credentials["user"],
+                                 credentials["password"],
+                                 limiter=limiter,
+                                 **options)
+    return atlas
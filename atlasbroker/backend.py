@@ -22,7 +22,15 @@ Used by the broker and all sub-modules to
 from .servicebinding import AtlasServiceBinding
 from .serviceinstance import AtlasServiceInstance
 from .storage import AtlasBrokerStorage
-from atlasapi.atlas import Atlas
+from .memorystorage import AtlasBrokerMemoryStorage
+from .sqlitestorage import AtlasBrokerSQLiteStorage
+from .clusters import ClusterRegistry
+from .operations import AsyncOperations
+from .readiness import ReadinessProbe
+from .errors import ErrStorageDriverUnsupported
+from .atlasclient import create_atlas
+from . import logs, tracing
+from .ratelimit import background
 
 class AtlasBrokerBackend:
     """Backend for the Atlas Broker
@@ -37,17 +45,120 @@ class AtlasBrokerBackend:
     
     def __init__(self, config):
         self.config = config
-        self.storage = AtlasBrokerStorage(self.config.mongo["uri"],
-                                          self.config.mongo["timeoutms"],
-                                          self.config.mongo["db"],
-                                          self.config.mongo["collection"])
-        self.atlas = Atlas(self.config.atlas["user"],
-                           self.config.atlas["password"],
-                           self.config.atlas["group"])
+        logs.configure(self.config.options.get("logging", None))
+        if "tracing" in self.config.options:
+            tracing.configure(self.config.options["tracing"])
+        self.storage = self._create_storage()
+        # Atlas client shared by all sub-modules
+        self.atlas = create_atlas(self.config.atlas, self.config.atlas.get("client", None))
+        
+        clusters_options = self.config.options.get("clusters", {})
+        self.cluster_registry = ClusterRegistry(self.atlas,
+                                                refresh_interval=clusters_options.get("refresh_interval", 300),
+                                                timeout=clusters_options.get("timeout", 60),
+                                                negative_ttl=clusters_options.get("negative_ttl", 5),
+                                                on_refresh=self.config.update_clusters if self.config.clusters_from_atlas else None)
+        if self.config.clusters_from_atlas:
+            # Bindings need the clusters configuration
+            self.cluster_registry.refresh()
+        self.cluster_registry.start()
+        
+        # Asynchronous operations (disabled by default)
+        async_options = dict(self.config.options.get("async", {}))
+        if async_options.pop("enabled", False):
+            self.operations = AsyncOperations(self.storage, **async_options)
+        else:
+            self.operations = None
+        
+        # Dependencies are checked in the background for the readiness
+        readiness_options = self.config.options.get("readiness", {})
+        self.readiness = ReadinessProbe({ "storage" : self.storage.ping,
+                                          "atlas" : self.ping_atlas },
+                                        interval=readiness_options.get("interval", 10))
+        self.readiness.start()
+        
         self.service_instance = AtlasServiceInstance(self)
         self.service_binding = AtlasServiceBinding(self)
         
-    def find(self, _id, instance = None):
+    def ping_atlas(self):
+        """Check Atlas is reachable with the credentials (first cluster of the group)
+        
+        Raises:
+            ErrAtlasGeneric: Atlas error (see atlasapi.errors)
+        """
+        with background():
+            self.atlas.Clusters.get_all_clusters(pageNum=1, itemsPerPage=1)
+        
+    def is_existing_cluster(self, cluster):
+        """Check if the cluster exists (see ClusterRegistry.is_existing_cluster)
+        
+        Args:
+            cluster (str): The cluster name
+        
+        Returns:
+            bool: The cluster exists or not
+        """
+        return self.cluster_registry.is_existing_cluster(cluster)
+    
+    def create_database_user(self, permissions):
+        """Create a database user on Atlas
+        
+        Args:
+            permissions (DatabaseUsersPermissionsSpecs): The user and its permissions
+        
+        Raises:
+            ErrAtlasConflict: The user already exists
+        """
+        self.atlas.DatabaseUsers.create_a_database_user(permissions)
+    
+    def delete_database_user(self, username):
+        """Delete a database user on Atlas
+        
+        Args:
+            username (str): The user name
+        
+        Raises:
+            ErrAtlasNotFound: The user does not exist
+        """
+        self.atlas.DatabaseUsers.delete_a_database_user(username)
+    
+    def _create_storage(self):
+        """Create the storage
+        
+        The driver is selected with the "storage" section of the configuration options.
+        
+        Returns:
+            AtlasBrokerStorageBase: The storage
+        
+        Raises:
+            ErrStorageDriverUnsupported: Unknown storage driver
+        """
+        options = self.config.storage_options()
+        driver = options["driver"]
+        
+        if driver == "mongo":
+            return AtlasBrokerStorage(self.config.mongo["uri"],
+                                      self.config.mongo["timeoutms"],
+                                      self.config.mongo["db"],
+                                      self.config.mongo["collection"],
+                                      cache=options["cache"],
+                                      upsert=options["upsert"],
+                                      client_options=self.config.mongo.get("client", None),
+                                      watch=self.config.mongo.get("watch", False),
+                                      lease=self.config.mongo.get("lease", None),
+                                      breaker=self.config.mongo.get("breaker", None))
+        elif driver == "memory":
+            return AtlasBrokerMemoryStorage(cache=options["cache"],
+                                            upsert=options["upsert"])
+        elif driver == "sqlite":
+            return AtlasBrokerSQLiteStorage(options["path"],
+                                            cache=options["cache"],
+                                            upsert=options["upsert"])
+        
+        raise ErrStorageDriverUnsupported(driver)
+        
+    @tracing.traced("backend.find")
+    def find(self, _id, instance = None, populate = True):
         """ Find
         
         Args:
@@ -55,6 +166,7 @@ class AtlasBrokerBackend:
             
         Keyword Arguments:
             instance (AtlasServiceInstance.Instance): Existing instance
+            populate (bool): Populate from the storage. If False, a new instance or binding is returned.
             
         Returns:
             AtlasServiceInstance.Instance or AtlasServiceBinding.Binding: An instance or binding. 
@@ -62,11 +174,27 @@ class AtlasBrokerBackend:
         
         if instance is None:
             # We are looking for an instance
-            return self.service_instance.find(_id)
+            return self.service_instance.find(_id, populate)
         else:
             # We are looking for a binding
-            return self.service_binding.find(_id, instance)
+            return self.service_binding.find(_id, instance, populate)
+
+    @tracing.traced("backend.find_binding")
+    def find_binding(self, instance_id, binding_id):
+        """ Find a binding and its instance
+        
+        Both are loaded from the storage at once.
+        
+        Args:
+            instance_id (str): instance id
+            binding_id (str): binding id
+            
+        Returns:
+            AtlasServiceBinding.Binding: A binding (binding.instance is the instance)
+        """
+        return self.service_binding.find_with_instance(binding_id, instance_id)
 
+    @tracing.traced("backend.create")
     def create(self, instance, parameters, existing=True):
         """Create an instance
         
@@ -82,6 +210,7 @@ class AtlasBrokerBackend:
         """
         return self.service_instance.create(instance, parameters, existing)
     
+    @tracing.traced("backend.delete")
     def delete(self, instance):
         """Delete an instance
         
@@ -93,6 +222,7 @@ class AtlasBrokerBackend:
         """
         return self.service_instance.delete(instance)
     
+    @tracing.traced("backend.bind")
     def bind(self, binding, parameters):
         """Binding to an instance
         
@@ -105,6 +235,7 @@ class AtlasBrokerBackend:
         """
         return self.service_binding.bind(binding, parameters)
 
+    @tracing.traced("backend.unbind")
     def unbind(self, binding):
         """Unbinding an instance
         
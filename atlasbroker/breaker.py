@@ -0,0 +1,185 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""breaker module
+
+Circuit breakers of the broker dependencies (Atlas, storage)
+"""
+
+import asyncio
+import functools
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from . import deadline, metrics
+from .errors import ErrDeadlineExceeded, ErrDependencyUnavailable
+
+logger = logging.getLogger("atlasbroker.breaker")
+
+class CircuitBreaker:
+    """Circuit Breaker
+    
+    Calls to a dependency fail fast with ErrDependencyUnavailable while the dependency is down,
+    instead of waiting for its timeout.
+    
+    - closed: calls are done. After failure_threshold consecutive failures, the breaker opens.
+    - open: calls are rejected during open_seconds, then the breaker is half open.
+    - half open: half_open_probes calls are done. A success closes the breaker, a failure opens it again.
+    
+    Constructor
+    
+    Args:
+        name (str): Name of the dependency (atlas, storage)
+    
+    Keyword Arguments:
+        failure_threshold (int): Consecutive failures to open the breaker
+        open_seconds (float): Seconds before a half open probe
+        half_open_probes (int): Calls allowed at once when half open
+    """
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+    
+    def __init__(self, name, failure_threshold=5, open_seconds=30, half_open_probes=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.probes = 0
+        self._lock = threading.Lock()
+        metrics.BREAKER_STATE.labels(name).set(self.CLOSED)
+    
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning("breaker: %s: %s", self.name, ("closed", "open", "half open")[state])
+        self.state = state
+        metrics.BREAKER_STATE.labels(self.name).set(state)
+    
+    def allow(self):
+        """Check a call can be done
+        
+        Raises:
+            ErrDependencyUnavailable: The breaker is open
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            
+            now = time.monotonic()
+            remaining = self.opened + self.open_seconds - now
+            if remaining <= 0:
+                # Probe again (a probe that never ended is given up after open_seconds too)
+                self._set_state(self.HALF_OPEN)
+                self.opened = now
+                self.probes = 0
+            
+            if self.state == self.HALF_OPEN and self.probes < self.half_open_probes:
+                self.probes += 1
+                return
+        
+        metrics.BREAKER_REJECTED.labels(self.name).inc()
+        raise ErrDependencyUnavailable(self.name, max(math.ceil(remaining), 1))
+    
+    def success(self):
+        """The dependency answered"""
+        with self._lock:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                self._set_state(self.CLOSED)
+    
+    def failure(self):
+        """The dependency did not answer
+        
+        A call cut by the deadline of its request (see deadline) says nothing about the
+        dependency so it is not counted. A half open probe cut this way is given back.
+        """
+        with self._lock:
+            if deadline.remaining() == 0:
+                self._give_back()
+                return
+            
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self._set_state(self.OPEN)
+                self.opened = time.monotonic()
+    
+    def release(self):
+        """The call did not reach the dependency (rate limit, deadline, ...)
+        
+        Nothing is counted and a half open probe is given back.
+        """
+        with self._lock:
+            self._give_back()
+    
+    def _give_back(self):
+        if self.state == self.HALF_OPEN and self.probes > 0:
+            self.probes -= 1
+    
+    @contextmanager
+    def guard(self, failures):
+        """Call the dependency in a block
+        
+        Args:
+            failures (tuple): Exceptions counted as failures. Other exceptions mean the dependency answered,
+                              except ErrDeadlineExceeded (see release).
+        
+        Raises:
+            ErrDependencyUnavailable: The breaker is open
+        """
+        self.allow()
+        try:
+            yield
+        except failures:
+            self.failure()
+            raise
+        except ErrDeadlineExceeded:
+            self.release()
+            raise
+        except Exception:
+            self.success()
+            raise
+        else:
+            self.success()
+
+def guarded(failures):
+    """Decorator to guard a method (or a coroutine) with the breaker of its object (self.breaker)
+    
+    Nothing is done if self.breaker is None.
+    
+    Args:
+        failures (tuple): Exceptions counted as failures
+    """
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(self, *args, **kwargs):
+                if self.breaker is None:
+                    return await fn(self, *args, **kwargs)
+                with self.breaker.guard(failures):
+                    return await fn(self, *args, **kwargs)
+            return async_wrapper
+        
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            if self.breaker is None:
+                return fn(self, *args, **kwargs)
+            with self.breaker.guard(failures):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -14,9 +14,13 @@
 
 """broker module"""
 
-from flask import Flask
+from flask import Flask, request
+from . import deadline, logs
 from .apis.health import getApi as health
 from .apis.broker import getApi as broker
+from .apis.metrics import getApi as metrics
+from .service import AtlasBroker
+from .errors import ErrServerModeUnsupported
 
 class Broker:
     """Broker
@@ -24,16 +28,79 @@ class Broker:
     Service composition with blueprint provided from apis.
     The broker is based on Flask
     
+    The Flask application is created on first use so a pre-forked server can create
+    it in each worker.
+    
     Constructor
     
     Args:
         config (Config): The broker configuration
     """
     def __init__(self, config):
-        self.app = Flask(__name__)
-        self.app.register_blueprint(health())
-        self.app.register_blueprint(broker(config))
+        self.config = config
+        self._app = None
+    
+    @property
+    def app(self):
+        """Flask application"""
+        if self._app is None:
+            self._app = self.create_app(self.config)
+        return self._app
+    
+    @staticmethod
+    def create_app(config):
+        """Create the Flask application
+        
+        Args:
+            config (Config): The broker configuration
+        
+        Returns:
+            Flask: The application
+        """
+        service_broker = AtlasBroker(config)
+        deadline_options = config.options.get("deadline", None)
+        
+        app = Flask(__name__)
+        
+        @app.before_request
+        def start_request():
+            logs.start_request(request.headers.get("X-Request-Id", None))
+            if deadline_options is not None:
+                header = deadline_options.get("header", None)
+                deadline.start(deadline.budget(deadline_options, request.headers.get(header, None) if header else None))
+        
+        @app.after_request
+        def end_request(response):
+            if logs.request_id() is not None:
+                response.headers["X-Request-Id"] = logs.request_id()
+            return response
+        
+        app.register_blueprint(health(service_broker.readiness))
+        app.register_blueprint(metrics())
+        app.register_blueprint(broker(config, service_broker))
+        return app
 
     def run(self):
-        """Start the broker server"""
-        self.app.run(host='0.0.0.0')
+        """Start the broker server
+        
+        The server is selected with the "server" section of the configuration options:
+            - "development" (default): Flask development server
+            - "gunicorn": pre-forked workers with threads (see GunicornServer)
+            - "asgi": asyncio broker served by uvicorn (see asgi module)
+        
+        Raises:
+            ErrServerModeUnsupported: Unknown server mode
+        """
+        options = dict(self.config.options.get("server", {}))
+        mode = options.pop("mode", "development")
+        
+        if mode == "development":
+            self.app.run(host='0.0.0.0')
+        elif mode == "gunicorn":
+            from .server import GunicornServer
+            GunicornServer(self, options).run()
+        elif mode == "asgi":
+            from .asgi import serve
+            serve(self.config, options)
+        else:
+            raise ErrServerModeUnsupported(mode)
@@ -0,0 +1,184 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""brokersteps module
+
+Logic of the broker operations shared by the broker and the asyncio broker
+"""
+
+from openbrokerapi.errors import (
+    ErrBindingDoesNotExist,
+    ErrInstanceDoesNotExist
+)
+from openbrokerapi.service_broker import (
+    ProvisionedServiceSpec,
+    ProvisionState,
+    Binding,
+    BindState,
+    GetBindingSpec,
+    GetInstanceDetailsSpec,
+    UnbindSpec,
+    DeprovisionServiceSpec
+)
+from . import steps
+from .errors import ErrPlanUnsupported
+
+class BrokerSteps:
+    """Broker Steps
+    
+    Operations of AtlasBroker and AsyncAtlasBroker written once as steps (see steps module).
+    
+    The broker has:
+        - _backend: AtlasBrokerBackend (or the AsyncAtlasBroker itself) with the storage, the
+          operations, the configuration, the service instance and the service binding
+        - _leased(instance_id, binding_id, fn, *args): call fn with the lease of the instance or the binding
+        - _run_steps(operation): run steps in a worker of the asynchronous operations (steps.run or steps.run_async)
+    """
+    
+    def _is_async(self, async_allowed):
+        """Check if an operation should be done asynchronously
+        
+        Args:
+            async_allowed (bool): The platform accepts an asynchronous operation
+        
+        Returns:
+            bool: Asynchronous or not
+        """
+        return async_allowed and self._backend.operations is not None
+    
+    def _submit_steps(self, kind, instance_id, binding_id, operation):
+        """Submit the steps of an operation to the workers
+        
+        Args:
+            kind (str): Kind of operation (provision, deprovision, bind, unbind)
+            instance_id (str): UUID of the instance
+            binding_id (str): UUID of the binding or None
+            operation (generator): Steps of the operation
+        
+        Returns:
+            str: The operation id
+        """
+        return (yield steps.call(self._backend.operations.submit, kind, instance_id, binding_id,
+                                 self._leased, instance_id, binding_id, self._run_steps, operation))
+    
+    def _provision_steps(self, instance_id, details, async_allowed):
+        backend = self._backend
+        if details.plan_id != backend.config.UUID_PLANS_EXISTING_CLUSTER:
+            # Plan not supported
+            raise ErrPlanUnsupported(details.plan_id)
+        
+        # Provision the instance on an Existing Atlas Cluster
+        
+        if backend.storage.use_upsert:
+            # The upsert tells if the instance is new, identical or conflicting in one round
+            # trip (the cluster is checked in memory, see ClusterRegistry). Nothing is left
+            # to do for a worker.
+            instance = yield from backend.service_instance.find_steps(instance_id, False)
+            return (yield from backend.service_instance.create_steps(instance, details.parameters, True))
+        
+        # Find the instance first so an identical or conflicting instance is answered without
+        # calling Atlas
+        instance = yield from backend.service_instance.find_steps(instance_id)
+        
+        if self._is_async(async_allowed) and not instance.isProvisioned():
+            # Atlas calls are done by a worker
+            operation = yield from self._submit_steps("provision", instance_id, None,
+                                                      backend.service_instance.create_steps(instance, details.parameters, True))
+            return ProvisionedServiceSpec(ProvisionState.IS_ASYNC, "", operation)
+        
+        # Create the instance if needed
+        return (yield from backend.service_instance.create_steps(instance, details.parameters, True))
+    
+    def _get_instance_steps(self, instance_id):
+        backend = self._backend
+        instance = yield from backend.service_instance.find_steps(instance_id)
+        if not instance.isProvisioned():
+            raise ErrInstanceDoesNotExist()
+        
+        # Instances are only provisioned with this plan (see provision)
+        return GetInstanceDetailsSpec(backend.config.broker["id"],
+                                      backend.config.UUID_PLANS_EXISTING_CLUSTER,
+                                      parameters=instance.parameters)
+    
+    def _deprovision_steps(self, instance_id, async_allowed):
+        backend = self._backend
+        instance = yield from backend.service_instance.find_steps(instance_id)
+        if not instance.isProvisioned():
+            # the instance does not exist
+            raise ErrInstanceDoesNotExist()
+        
+        if self._is_async(async_allowed):
+            operation = yield from self._submit_steps("deprovision", instance_id, None,
+                                                      backend.service_instance.delete_steps(instance))
+            return DeprovisionServiceSpec(True, operation)
+        
+        return (yield from backend.service_instance.delete_steps(instance))
+    
+    def _bind_steps(self, instance_id, binding_id, details, async_allowed):
+        backend = self._backend
+        if backend.storage.use_upsert:
+            # The claim of the binding tells if it exists (see AtlasServiceBinding.bind), only
+            # the instance is looked up (served by the cache if any)
+            instance = yield from backend.service_instance.find_steps(instance_id)
+            binding = yield from backend.service_binding.find_steps(binding_id, instance, False)
+        else:
+            # Find the instance and find or create the binding
+            binding = yield from backend.service_binding.find_with_instance_steps(binding_id, instance_id)
+        
+        if (self._is_async(async_allowed) and not binding.isProvisioned() and
+            backend.config.isGenerateBindingCredentialsPredictible()):
+            # Credentials will be returned by get_binding once the worker is done
+            operation = yield from self._submit_steps("bind", instance_id, binding_id,
+                                                      backend.service_binding.bind_steps(binding, details.parameters))
+            return Binding(BindState.IS_ASYNC, operation=operation)
+        
+        # Create the binding if needed
+        return (yield from backend.service_binding.bind_steps(binding, details.parameters))
+    
+    def _get_binding_steps(self, instance_id, binding_id):
+        backend = self._backend
+        binding = yield from backend.service_binding.find_with_instance_steps(binding_id, instance_id)
+        if not binding.isProvisioned() or binding.pending is not None:
+            # A pending binding is not created yet
+            raise ErrBindingDoesNotExist()
+        
+        if not backend.config.isBindingCredentialsPredictible(binding):
+            # Credentials can't be generated again
+            raise NotImplementedError()
+        
+        return GetBindingSpec(credentials=backend.config.generate_binding_credentials(binding))
+    
+    def _unbind_steps(self, instance_id, binding_id, async_allowed):
+        backend = self._backend
+        # Find the instance and the binding
+        binding = yield from backend.service_binding.find_with_instance_steps(binding_id, instance_id)
+        if not binding.isProvisioned():
+            # The binding does not exist
+            raise ErrBindingDoesNotExist()
+        
+        if self._is_async(async_allowed):
+            operation = yield from self._submit_steps("unbind", instance_id, binding_id,
+                                                      backend.service_binding.unbind_steps(binding))
+            return UnbindSpec(True, operation)
+        
+        # Delete the binding
+        yield from backend.service_binding.unbind_steps(binding)
+        return UnbindSpec(False)
+    
+    def _last_operation_steps(self, instance_id, binding_id, operation_data):
+        if self._backend.operations is None:
+            # Asynchronous operations are disabled
+            raise NotImplementedError()
+        
+        return (yield steps.call(self._backend.operations.last_operation, operation_data, instance_id, binding_id))
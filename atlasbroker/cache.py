@@ -0,0 +1,219 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""cache module
+
+In-process read-through cache used in front of the storage
+"""
+
+import copy
+import threading
+import time
+from collections import OrderedDict
+from . import metrics
+
+class StorageCache:
+    """Storage Cache
+    
+    LRU cache bounded in size with a TTL per entry.
+    
+    Unknown ids are cached too (negative caching) with their own TTL, so repeated
+    lookups of objects that do not exist yet don't reach the storage.
+    
+    Every invalidation bumps the version of the cache. A lookup reads the version before
+    querying the storage and gives it to set, so a value read before a concurrent write
+    (eg: NOT_FOUND before a store) is not cached once the write invalidated its key.
+    
+    Entries can be set with the storage id of their document so a write only known by this
+    id (eg: a delete seen by StorageWatcher) invalidates them (see invalidate_document).
+    
+    Constructor
+    
+    Keyword Arguments:
+        maxsize (int): Maximum number of entries
+        ttl (float): Time to live in seconds of a known object
+        negative_ttl (float): Time to live in seconds of an unknown object
+        clock (callable): Monotonic clock in seconds
+    """
+    
+    # Value returned by get on a miss
+    MISS = object()
+    
+    # Value stored for an unknown object
+    NOT_FOUND = object()
+    
+    def __init__(self, maxsize=1024, ttl=30, negative_ttl=5, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+        # Version of the last invalidations by key (bounded to maxsize) and the version of
+        # the most recent invalidation forgotten
+        self._invalidated = OrderedDict()
+        self._floor = 0
+        # Key of the cached entries by storage id of their document
+        self._keys = {}
+    
+    def version(self):
+        """Current version (to read before querying the storage, see set)
+        
+        Returns:
+            int: The version
+        """
+        with self._lock:
+            return self._version
+    
+    def get(self, key):
+        """Get an entry
+        
+        Args:
+            key (tuple): Key of the entry
+        
+        Returns:
+            StorageCache.MISS, StorageCache.NOT_FOUND or the cached value
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    # Expired
+                    self._drop(key)
+                self.misses += 1
+                metrics.CACHE.labels("miss").inc()
+                return StorageCache.MISS
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            metrics.CACHE.labels("hit").inc()
+            value = entry[1]
+        
+        if value is StorageCache.NOT_FOUND:
+            return value
+        
+        # The caller is free to modify what it gets
+        return copy.deepcopy(value)
+    
+    def set(self, key, value, version=None, document_id=None):
+        """Set an entry
+        
+        Args:
+            key (tuple): Key of the entry
+            value: Value to cache or StorageCache.NOT_FOUND
+        
+        Keyword Arguments:
+            version (int): Version read before querying the storage (see version). The value is
+                not cached if the key was invalidated since.
+            document_id: Storage id of the document (see invalidate_document)
+        """
+        if self.maxsize <= 0:
+            return
+        
+        if value is StorageCache.NOT_FOUND:
+            expire = self.clock() + self.negative_ttl
+        else:
+            expire = self.clock() + self.ttl
+            value = copy.deepcopy(value)
+        
+        with self._lock:
+            if version is not None and (version < self._floor or self._invalidated.get(key, 0) > version):
+                # Stale, the storage changed during the lookup
+                return
+            
+            self._drop(key)
+            self._entries[key] = (expire, value, document_id)
+            if document_id is not None:
+                self._keys[document_id] = key
+            
+            while len(self._entries) > self.maxsize:
+                # Evict the least recently used entry
+                self._drop(next(iter(self._entries)))
+    
+    def invalidate(self, key):
+        """Invalidate an entry
+        
+        Args:
+            key (tuple): Key of the entry
+        """
+        with self._lock:
+            self._invalidate(key)
+    
+    def invalidate_document(self, document_id):
+        """Invalidate the entry of a document known by its storage id only
+        
+        Lookups in progress can't be matched with the document so they are not cached.
+        Other entries are kept.
+        
+        Args:
+            document_id: Storage id of the document
+        """
+        with self._lock:
+            key = self._keys.get(document_id, None)
+            if key is not None:
+                self._invalidate(key)
+            else:
+                self._version += 1
+                self._floor = self._version
+    
+    def _invalidate(self, key):
+        """Invalidate an entry (the lock is held)
+        
+        Args:
+            key (tuple): Key of the entry
+        """
+        self._drop(key)
+        
+        self._version += 1
+        self._invalidated[key] = self._version
+        self._invalidated.move_to_end(key)
+        
+        while len(self._invalidated) > max(self.maxsize, 1):
+            _, forgotten = self._invalidated.popitem(last=False)
+            self._floor = max(self._floor, forgotten)
+    
+    def _drop(self, key):
+        """Remove an entry if any (the lock is held)
+        
+        Args:
+            key (tuple): Key of the entry
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[2] is not None:
+            self._keys.pop(entry[2], None)
+    
+    def clear(self):
+        """Invalidate all entries"""
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+            
+            self._version += 1
+            self._invalidated.clear()
+            self._floor = self._version
+    
+    def stats(self):
+        """Statistics
+        
+        Returns:
+            dict: hits, misses and current size of the cache
+        """
+        with self._lock:
+            return {"hits" : self.hits,
+                    "misses" : self.misses,
+                    "size" : len(self._entries)}
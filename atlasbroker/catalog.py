@@ -0,0 +1,94 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""catalog module
+
+Catalog of the broker built and serialized once
+"""
+
+import hashlib
+import json
+from openbrokerapi.helper import _to_dict
+from openbrokerapi.response import CatalogResponse
+from openbrokerapi.service_broker import Service
+
+def create_service(config, bindings_retrievable):
+    """Create the Service of the broker from its configuration
+    
+    Args:
+        config (config): Configuration of the broker
+        bindings_retrievable (bool): Credentials of the bindings are fetched with get_binding
+    
+    Returns:
+        Service: The service
+    """
+    return Service(
+        id=config.broker["id"],
+        name=config.broker["name"],
+        description=config.broker["description"],
+        bindable=config.broker["bindable"],
+        plans=config.broker["plans"],
+        tags=config.broker["tags"],
+        requires=config.broker["requires"],
+        metadata=config.broker["metadata"],
+        dashboard_client=config.broker["dashboard_client"],
+        plan_updateable=config.broker["plan_updateable"],
+        instances_retrievable=True,
+        bindings_retrievable=bindings_retrievable,
+    )
+
+class CatalogCache:
+    """Catalog Cache
+    
+    The catalog only changes with the configuration so the Service is built once and
+    served as bytes with a strong ETag. A platform sending the ETag back in If-None-Match
+    gets a 304 without body.
+    
+    Constructor
+    
+    Args:
+        factory (callable): Create the Service of the broker (see create_service)
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.service = None
+        self.response = None
+        self.refresh()
+    
+    def refresh(self):
+        """Build and serialize the catalog again (call it once the broker configuration changed)"""
+        service = self.factory()
+        body = json.dumps(_to_dict(CatalogResponse([service])), sort_keys=True).encode()
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()
+        
+        # Swap at once
+        self.service, self.response = service, (body, etag)
+    
+    @staticmethod
+    def not_modified(etag, if_none_match):
+        """Check if the platform already has the catalog
+        
+        Args:
+            etag (str): ETag of the catalog
+            if_none_match (str): Value of the If-None-Match header or None
+        
+        Returns:
+            bool: True if the catalog can be answered with a 304
+        """
+        if not if_none_match:
+            return False
+        
+        etags = [ tag.strip() for tag in if_none_match.split(",") ]
+        # If-None-Match uses the weak comparison
+        return "*" in etags or etag in [ tag[2:] if tag.startswith("W/") else tag for tag in etags ]
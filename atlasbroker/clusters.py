@@ -0,0 +1,215 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""clusters module
+
+Atlas clusters known by the broker
+"""
+
+import logging
+import threading
+import time
+from atlasapi.errors import ErrAtlasNotFound
+from . import deadline, steps
+from .errors import ErrClustersRefreshTimeout, ErrDeadlineExceeded
+from .ratelimit import background
+
+logger = logging.getLogger("atlasbroker.clusters")
+
+class ClusterRegistry:
+    """Cluster Registry
+    
+    Serve cluster existence checks from memory instead of calling Atlas on every provision.
+    
+    The list of clusters is refreshed from Atlas in the background. A cluster not found in
+    memory is fetched once from Atlas and added to the registry if it exists (on_refresh is
+    called with it too). A cluster not found on Atlas is not fetched again for negative_ttl
+    seconds or until the next refresh, so retries of the platform don't call Atlas.
+    
+    Clusters are fetched page by page within a bounded time, each request is bounded by the
+    time left. If a refresh fails, the last good list is kept.
+    
+    Constructor
+    
+    Args:
+        atlas (Atlas): Atlas client
+    
+    Keyword Arguments:
+        clusters (iterable): Initial cluster names
+        refresh_interval (float): Seconds between two refreshes (0 disables the background refresh)
+        timeout (float): Maximum seconds for a refresh
+        items_per_page (int): Number of clusters fetched per page
+        on_refresh (callable): Called with the list of Atlas clusters after each successful refresh
+        negative_ttl (float): Seconds a cluster not found on Atlas is not fetched again (0 disables it)
+        clock (callable): Monotonic clock in seconds
+    """
+    def __init__(self, atlas, clusters=None, refresh_interval=300, timeout=60, items_per_page=100, on_refresh=None,
+                 negative_ttl=5, clock=time.monotonic):
+        self.atlas = atlas
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        self.items_per_page = items_per_page
+        self.on_refresh = on_refresh
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.names = frozenset(clusters or [])
+        # Atlas clusters of the last refresh and the ones found since
+        self.clusters = []
+        # Expiration time of the clusters not found on Atlas by name
+        self.misses = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        """Start to refresh in a background thread"""
+        if self.refresh_interval <= 0:
+            return
+        
+        self._thread = threading.Thread(target=self.run, name="cluster-registry", daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """Stop to refresh"""
+        self._stop.set()
+    
+    def run(self):
+        """Refresh the registry until stopped"""
+        if not self.names:
+            # Nothing known yet
+            self._refresh()
+        
+        while not self._stop.wait(self.refresh_interval):
+            self._refresh()
+    
+    def _refresh(self):
+        """Refresh with a background priority and never raise"""
+        try:
+            with background():
+                self.refresh()
+        except Exception as e:
+            logger.warning("clusters: refresh: %s", str(e))
+    
+    def refresh(self):
+        """Refresh the list of clusters from Atlas
+        
+        Raises:
+            ErrClustersRefreshTimeout: The refresh took too much time
+        """
+        clusters = self.fetch()
+        
+        # Swap at once
+        with self._lock:
+            self.clusters = clusters
+            self.names = frozenset(cluster["name"] for cluster in clusters)
+            self.misses = {}
+            
+            if self.on_refresh is not None:
+                self.on_refresh(clusters)
+    
+    def add(self, cluster):
+        """Add a cluster found on Atlas since the last refresh
+        
+        Args:
+            cluster (dict): An Atlas cluster
+        """
+        with self._lock:
+            self.clusters = self.clusters + [cluster]
+            self.names = self.names | frozenset([cluster["name"]])
+            self.misses.pop(cluster["name"], None)
+            
+            if self.on_refresh is not None:
+                self.on_refresh(self.clusters)
+    
+    def fetch(self):
+        """Fetch all clusters from Atlas page by page
+        
+        Returns:
+            list: Atlas clusters
+        
+        Raises:
+            ErrClustersRefreshTimeout: The refresh took too much time
+        """
+        clusters = []
+        page = 1
+        
+        # Requests are bounded by the time left (see deadline)
+        with deadline.scope(self.timeout):
+            while True:
+                try:
+                    result = self.atlas.Clusters.get_all_clusters(pageNum=page, itemsPerPage=self.items_per_page)
+                except ErrDeadlineExceeded:
+                    raise ErrClustersRefreshTimeout(self.timeout)
+                
+                results = result.get("results", [])
+                clusters.extend(results)
+                
+                if not results or len(clusters) >= result.get("totalCount", 0):
+                    return clusters
+                
+                page += 1
+    
+    def is_existing_cluster(self, cluster):
+        """Check if the cluster exists
+        
+        Args:
+            cluster (str): The cluster name
+        
+        Returns:
+            bool: The cluster exists or not
+        """
+        return steps.run(self.is_existing_cluster_steps(cluster, self.atlas.Clusters.get_single_cluster))
+    
+    def is_existing_cluster_steps(self, cluster, get_single_cluster):
+        """Steps of is_existing_cluster (see steps module)
+        
+        Args:
+            cluster (str): The cluster name
+            get_single_cluster (callable): Fetch a cluster from Atlas (function or coroutine function)
+        
+        Returns:
+            bool: The cluster exists or not
+        """
+        if cluster in self.names:
+            return True
+        
+        if self.misses.get(cluster, 0) > self.clock():
+            # Not found on Atlas a moment ago
+            return False
+        
+        # Unknown, this is maybe a new cluster
+        try:
+            found = yield steps.call(get_single_cluster, cluster)
+        except ErrAtlasNotFound:
+            self._missed(cluster)
+            return False
+        
+        self.add(found)
+        return True
+    
+    def _missed(self, cluster):
+        """Remember a cluster not found on Atlas for negative_ttl seconds
+        
+        Args:
+            cluster (str): The cluster name
+        """
+        if self.negative_ttl <= 0:
+            return
+        
+        with self._lock:
+            now = self.clock()
+            # Expired misses are dropped so unknown names don't pile up
+            misses = { name : expire for name, expire in self.misses.items() if expire > now }
+            misses[cluster] = now + self.negative_ttl
+            self.misses = misses
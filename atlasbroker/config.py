@@ -19,11 +19,13 @@ Permit to manage global configurations
 """
 
 from pwgen import pwgen
-from atlasapi.atlas import Atlas
 from atlasapi.specs import RoleSpecs
 from openbrokerapi.catalog import ServiceMetadata, ServicePlan
+import base64
+import hashlib
+import hmac
 import json
-from .errors import ErrClusterConfig
+from .errors import ErrClusterConfig, ErrCredentialsKeyNotFound
 
 class Config:
     """Configuration for AtlasBroker and sub-modules
@@ -35,16 +37,23 @@ class Config:
         generate_instance_dbname
         generate_binding_credentials
         generate_binding_username
+        generate_binding_password
         generate_binding_permissions
         
     Constructor
     
     Args:
         atlas_credentials (dict): Atlas credentials eg: {"userame" : "", "password": "", "group": ""}
+            Optional key: "client" (AtlasNetwork options)
         mongo_credentials (dict): Mongo credentials eg: {"uri": "", "db": "", "timeoutms": 5000, "collection": ""}
+            Optional keys: "client" (pymongo.MongoClient options), "cache", "upsert", "watch", "lease" and "breaker" (see AtlasBrokerStorage)
         
     Keyword Arguments:
-        clusters (list): List of cluster with uri associated. If not provided, it will be populate from Atlas.
+        clusters (list): List of cluster with uri associated. If not provided, it will be populate from Atlas by the backend.
+        options (dict): Optional sections to tune the broker eg: {"storage": {"driver": "sqlite", "path": "broker.db"}}
+    
+    Raises:
+        ErrCredentialsKeyNotFound: The current key of the "credentials" section is not in its keys
     """
     
     # Common keys used by the broker
@@ -56,9 +65,10 @@ class Config:
     UUID_SERVICES_CLUSTER = "2a04f349-4aab-4fcb-af6d-8e1749a77c13"
     UUID_PLANS_EXISTING_CLUSTER = "8db474d1-3cc0-4f4d-b864-24e3bd49b874"
     
-    def __init__(self, atlas_credentials, mongo_credentials, clusters=None):
+    def __init__(self, atlas_credentials, mongo_credentials, clusters=None, options=None):
         self.atlas = atlas_credentials
         self.mongo = mongo_credentials
+        self.options = options or {}
         
         # Broker Service configuration
         self.broker = {
@@ -89,18 +99,62 @@ class Config:
         }
             
         # Clusters configuration
-        if clusters:
-            self.clusters = clusters
-        else:
-            # load from Atlas
-            atlas = Atlas(self.atlas["user"],
-                        self.atlas["password"],
-                        self.atlas["group"])
-            self.clusters = {}
-            for cluster in atlas.Clusters.get_all_clusters(iterable=True):
-                uri = cluster["mongoURIWithOptions"].replace('mongodb://', 'mongodb://%s:%s@').replace('/?','/%s?')
-                self.clusters[cluster["name"]] = uri
+        # (loaded from Atlas by the backend if not provided)
+        self.clusters_from_atlas = not clusters
+        self.clusters = clusters if clusters else {}
+        
+        # Derived binding credentials (see generate_binding_password)
+        # Keys by id and id of the key used by new bindings
+        credentials = self.options.get("credentials", {})
+        self.credentials_keys = credentials.get("keys", {})
+        self.credentials_key = credentials.get("current", None) if self.credentials_keys else None
+        
+        if self.credentials_keys and self.credentials_key not in self.credentials_keys:
+            raise ErrCredentialsKeyNotFound(self.credentials_key)
+    
+    def storage_options(self):
+        """Options of the storage driver
+        
+        The driver is selected with the "storage" section of the options. Its "cache" and "upsert"
+        keys apply to all drivers. With the mongo driver, the keys not set in the "storage" section
+        are read from the mongo section.
+        
+        Returns:
+            dict: The "storage" section with "driver", "cache" and "upsert" set
+        """
+        options = dict(self.options.get("storage", {}))
+        options.setdefault("driver", "mongo")
+        
+        legacy = self.mongo if options["driver"] == "mongo" and self.mongo else {}
+        for key, default in (("cache", None), ("upsert", False)):
+            if key not in options:
+                options[key] = legacy.get(key, default)
+        
+        return options
+    
+    def update_clusters(self, clusters):
+        """Update the clusters configuration
+        
+        The new configuration replaces the current one at once.
+        
+        Args:
+            clusters (iterable): Atlas clusters
+        """
+        self.clusters = { cluster["name"] : self.generate_cluster_uri(cluster) for cluster in clusters }
+    
+    def generate_cluster_uri(self, cluster):
+        """Generate the connection string template of a cluster
+        
+        The template is completed with the username, password and database during the binding.
+        
+        Args:
+            cluster (dict): An Atlas cluster
             
+        Returns:
+            str: The connection string template
+        """
+        return cluster["mongoURIWithOptions"].replace('mongodb://', 'mongodb://%s:%s@').replace('/?','/%s?')
+    
     def load_json(json_file):
         """Load JSON file
         
@@ -167,7 +221,7 @@ class Config:
         
         # partial credentials
         creds = {"username" : self.generate_binding_username(binding),
-                "password" : pwgen(32, symbols=False),
+                "password" : self.generate_binding_password(binding),
                 "database" : binding.instance.get_dbname()}
         
         # uri
@@ -199,8 +253,26 @@ class Config:
         or to workaround the answer to avoid the service catalog to inject inaccurate credentials.
         
         In the best world, it should be good to be able to generate "static" credentials and set the return to True on this function.
+        
+        Credentials are predictible when keys are set in the "credentials" section of the options (see generate_binding_password).
         """
-        return False
+        return len(self.credentials_keys) > 0
+    
+    def isBindingCredentialsPredictible(self, binding):
+        """Are the credentials of an existing binding predictible ?
+        
+        Bindings created before the keys were set in the "credentials" section of the options
+        have random passwords, so their credentials can not be generated again.
+        
+        Args:
+            binding (AtlasServiceBinding.Binding): An existing binding
+        
+        Returns:
+            bool: True if generate_binding_credentials returns the credentials of the binding
+        """
+        if self.credentials_keys and binding.credentials_key is None:
+            return False
+        return self.isGenerateBindingCredentialsPredictible()
     
     def generate_binding_username(self, binding):
         """Generate binding username
@@ -217,6 +289,37 @@ class Config:
         """
         return binding.binding_id
     
+    def generate_binding_password(self, binding):
+        """Generate binding password
+        
+        Without keys in the "credentials" section of the options, the password is random.
+        
+        With keys, the password is derived from the binding id with HMAC-SHA256 and the key of the
+        binding (binding.credentials_key, the current key when the binding was created). The same
+        binding always gets the same password without storing it, and rotating the current key only
+        changes the passwords of new bindings.
+        
+        Args:
+            binding (AtlasServiceBinding.Binding): A binding
+        
+        Returns:
+            str: The password
+        
+        Raises:
+            ErrCredentialsKeyNotFound: The key of the binding is not configured anymore.
+        """
+        if not self.credentials_keys:
+            return pwgen(32, symbols=False)
+        
+        key = self.credentials_keys.get(binding.credentials_key, None)
+        if key is None:
+            raise ErrCredentialsKeyNotFound(binding.credentials_key)
+        
+        digest = hmac.new(key.encode(), ("binding:" + binding.binding_id).encode(), hashlib.sha256).digest()
+        
+        # 32 alphanumeric characters (160 bits)
+        return base64.b32encode(digest[:20]).decode()
+    
     def generate_binding_permissions(self, binding, permissions):
         """Generate Users pemissions on the database
         
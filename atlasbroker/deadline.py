@@ -0,0 +1,123 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""deadline module
+
+Deadline of the current request.
+
+The platform gives up on a request after its client timeout (60 seconds for Service Catalog)
+and sends it again. The deadline of a request is kept in a context variable: storage and Atlas
+calls done for the request are bounded by the remaining time and are not started once it is
+over, so the broker does not keep working for a request already abandoned.
+"""
+
+import contextvars
+import time
+from contextlib import contextmanager
+from .errors import ErrDeadlineExceeded
+
+_deadline = contextvars.ContextVar("atlasbroker_deadline", default=None)
+
+def budget(options, requested=None):
+    """Seconds given to a request
+    
+    Args:
+        options (dict): The "deadline" section of the configuration options eg: {"seconds": 50, "header": "X-Request-Timeout"}
+    
+    Keyword Arguments:
+        requested (str): Value of the request header (seconds) or None
+    
+    Returns:
+        float: Seconds or None for no deadline
+    """
+    seconds = options.get("seconds", None)
+    
+    if requested:
+        try:
+            requested = float(requested)
+        except ValueError:
+            return seconds
+        # The configuration is a maximum
+        seconds = requested if seconds is None else min(seconds, requested)
+    
+    return seconds
+
+def start(seconds):
+    """Set the deadline of the current request
+    
+    Args:
+        seconds (float): Seconds from now or None for no deadline
+    """
+    _deadline.set(time.monotonic() + seconds if seconds is not None else None)
+
+@contextmanager
+def suspended():
+    """Calls done in this block have no deadline (cleanups, background operations, ...)"""
+    token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+@contextmanager
+def scope(seconds):
+    """Calls done in this block are bounded by seconds (and by the deadline of the request if any)
+    
+    Args:
+        seconds (float): Seconds from now
+    """
+    end = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(end if current is None else min(current, end))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def remaining():
+    """Remaining time of the current request
+    
+    Returns:
+        float: Seconds before the deadline (0 once over) or None without deadline
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+def timeout(default):
+    """Timeout of a call
+    
+    Args:
+        default (float): Timeout of the call without deadline (None for no timeout)
+    
+    Returns:
+        float: The default timeout bounded by the remaining time
+    """
+    left = remaining()
+    if left is None:
+        return default
+    return left if default is None else min(default, left)
+
+def check(what):
+    """Check that a call can be started
+    
+    Args:
+        what (str): The call (storage, atlas)
+    
+    Raises:
+        ErrDeadlineExceeded: The deadline is over
+    """
+    if remaining() == 0:
+        raise ErrDeadlineExceeded(what)
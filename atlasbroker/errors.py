@@ -17,6 +17,8 @@
 All Specific Exceptions
 """
 
+from openbrokerapi.errors import ErrConcurrentInstanceAccess
+
 class ErrClusterNotFound(Exception):
     """Cluster not found
     
@@ -41,7 +43,29 @@ class ErrClusterConfig(Exception):
     def __init__(self, cluster):
         super().__init__("The cluster configuration for %s is not available." % cluster)
 
-class ErrStorageMongoConnection(Exception):
+class ErrClustersRefreshTimeout(Exception):
+    """Clusters refresh timeout
+    
+    Constructor
+    
+    Args:
+        timeout (float): Maximum seconds for a refresh
+    """
+    def __init__(self, timeout):
+        super().__init__("The clusters refresh from Atlas took more than %s seconds." % timeout)
+
+class ErrStorageConnection(Exception):
+    """The storage is not able to communicate with its backend
+    
+    Constructor
+    
+    Args:
+        during (str): When the issue occurs
+    """
+    def __init__(self, during):
+        super().__init__("The storage is not able to communicate with its backend [%s]" % during)
+
+class ErrStorageMongoConnection(ErrStorageConnection):
     """The storage is not able to communicate with MongoDB
     
     Constructor
@@ -50,7 +74,31 @@ class ErrStorageMongoConnection(Exception):
         during (str): When the issue occurs
     """
     def __init__(self, during):
-        super().__init__("The storage is not able to communicate with MongoDB [%s]" % during)
+        Exception.__init__(self, "The storage is not able to communicate with MongoDB [%s]" % during)
+
+class ErrStorageLeaseTimeout(ErrConcurrentInstanceAccess):
+    """The lease of an instance or a binding is held by another broker for too long
+    
+    This is a concurrency error for the platform (422 Unprocessable Entity).
+    
+    Constructor
+    
+    Args:
+        key (str): Key of the lease
+    """
+    def __init__(self, key):
+        Exception.__init__(self, "The lease [%s] is held by another broker" % key)
+
+class ErrStorageDriverUnsupported(Exception):
+    """Storage driver unsupported
+    
+    Constructor
+    
+    Args:
+        driver (str): Name of the storage driver
+    """
+    def __init__(self, driver):
+        super().__init__("Storage driver [%s] unsupported" % driver)
 
 class ErrStorageTypeUnsupported(Exception):
     """Type unsupported
@@ -111,3 +159,123 @@ class ErrPlanUnsupported(Exception):
     """
     def __init__(self, plan_id):
         super().__init__("Plan [%s] not supported." % plan_id)
+
+class ErrServerModeUnsupported(Exception):
+    """Server mode not supported
+    
+    Constructor
+    
+    Args:
+        mode (str): Server mode
+    """
+    def __init__(self, mode):
+        super().__init__("Server mode [%s] not supported." % mode)
+
+class ErrTracingExporterUnsupported(Exception):
+    """Tracing exporter not supported
+    
+    Constructor
+    
+    Args:
+        kind (str): Type of exporter
+    """
+    def __init__(self, kind):
+        super().__init__("Tracing exporter [%s] not supported." % kind)
+
+class ErrAtlasRateLimited(Exception):
+    """No token to call Atlas in time (client side rate limit)
+    
+    Constructor
+    
+    Args:
+        timeout (float): Seconds waited
+    
+    Keyword Arguments:
+        retry_after (int): Seconds before a token is available
+    """
+    def __init__(self, timeout, retry_after=1):
+        super().__init__("Atlas rate limit reached, no call possible within %s seconds." % timeout)
+        self.retry_after = retry_after
+
+class ErrDependencyUnavailable(Exception):
+    """A dependency of the broker is unavailable (open circuit breaker)
+    
+    Constructor
+    
+    Args:
+        dependency (str): Name of the dependency (atlas, storage)
+        retry_after (float): Seconds before the dependency is tried again
+    """
+    def __init__(self, dependency, retry_after):
+        super().__init__("The dependency [%s] is unavailable, retry later." % dependency)
+        self.dependency = dependency
+        self.retry_after = retry_after
+
+class ErrCredentialsKeyNotFound(Exception):
+    """Key to derive binding credentials not found
+    
+    Constructor
+    
+    Args:
+        key_id (str): Id of the key
+    """
+    def __init__(self, key_id):
+        super().__init__("The key [%s] to derive binding credentials is not configured." % key_id)
+
+class ErrDeadlineExceeded(Exception):
+    """The deadline of the request is over
+    
+    Constructor
+    
+    Args:
+        what (str): Call not done (storage, atlas)
+    """
+    def __init__(self, what):
+        super().__init__("The deadline of the request is over, [%s] not called." % what)
+
+class ErrBrokerOverloaded(Exception):
+    """Too many broker operations in progress (admission control)
+    
+    Constructor
+    
+    Args:
+        lane (str): Lane of the operation (write, read)
+        retry_after (int): Seconds before trying again
+    """
+    def __init__(self, lane, retry_after):
+        super().__init__("Too many [%s] operations in progress, retry later." % lane)
+        self.lane = lane
+        self.retry_after = retry_after
+
+class ErrOperationsQueueFull(ErrBrokerOverloaded):
+    """Too many asynchronous operations in progress
+    
+    The broker is overloaded for the platform (503 Service Unavailable with Retry-After).
+    
+    Constructor
+    
+    Args:
+        retry_after (int): Seconds before trying again
+    """
+    def __init__(self, retry_after):
+        Exception.__init__(self, "Too many asynchronous operations in progress, retry later.")
+        self.lane = "async"
+        self.retry_after = retry_after
+
+class ErrBindingClaimed(ErrConcurrentInstanceAccess):
+    """The binding is being created by another call
+    
+    This is a concurrency error for the platform (422 Unprocessable Entity).
+    
+    Constructor
+    
+    Args:
+        binding_id (str): UUID of the binding
+    """
+    def __init__(self, binding_id):
+        Exception.__init__(self, "The binding [%s] is being created by another call" % binding_id)
+
+class ErrWatchUnsupported(Exception):
+    """The change stream of the storage (watch) is not supported by the asyncio broker"""
+    def __init__(self):
+        Exception.__init__(self, "The change stream of the storage (watch) is not supported by the asyncio broker.")
@@ -0,0 +1,49 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""httperrors module
+
+HTTP answers of the broker errors, the same for the Flask (see apis.broker) and the ASGI
+(see asgi) servers
+"""
+
+from http import HTTPStatus
+from openbrokerapi.errors import ErrConcurrentInstanceAccess
+from openbrokerapi.response import ErrorResponse
+from .errors import ErrAtlasRateLimited, ErrBrokerOverloaded, ErrDeadlineExceeded, ErrDependencyUnavailable
+
+# Exception, HTTP status, error code, description (str(e) if None), answered with Retry-After (e.retry_after)
+ERRORS = [
+    (ErrConcurrentInstanceAccess, HTTPStatus.UNPROCESSABLE_ENTITY, "ConcurrencyError",
+     "The Service Broker does not support concurrent requests that mutate the same resource.", False),
+    (ErrDependencyUnavailable, HTTPStatus.SERVICE_UNAVAILABLE, None, None, True),
+    (ErrBrokerOverloaded, HTTPStatus.SERVICE_UNAVAILABLE, None, None, True),
+    (ErrAtlasRateLimited, HTTPStatus.SERVICE_UNAVAILABLE, None, None, True),
+    (ErrDeadlineExceeded, HTTPStatus.GATEWAY_TIMEOUT, None, None, False),
+    ]
+
+def answer(e):
+    """HTTP answer of an error
+    
+    Args:
+        e (Exception): The error
+    
+    Returns:
+        tuple: The status, the ErrorResponse and the headers or None if the error is not in ERRORS
+    """
+    for cls, status, error, description, retry_after in ERRORS:
+        if isinstance(e, cls):
+            headers = { "Retry-After" : str(e.retry_after) } if retry_after else {}
+            return status, ErrorResponse(error=error, description=description or str(e)), headers
+    return None
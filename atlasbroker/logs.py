@@ -0,0 +1,168 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""logs module
+
+Logging of the broker.
+
+Modules log with the standard logging module on a logger per subsystem
+("atlasbroker.storage", "atlasbroker.atlas", ...). Records are put in a queue by the
+calling thread and written by a background thread, so requests never wait on stdout.
+
+The request id and the operation of the current request are kept in context variables
+and added to every record.
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+
+_request_id = contextvars.ContextVar("atlasbroker_request_id", default=None)
+_operation = contextvars.ContextVar("atlasbroker_operation", default=None)
+
+# Operations polled by the platform are logged at debug level
+POLLED_OPERATIONS = ("catalog", "last_operation", "last_binding_operation")
+
+# Record attributes that are not extra fields
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | frozenset(["message", "asctime"])
+
+logger = logging.getLogger("atlasbroker.service")
+
+_listener = None
+
+class ContextFilter(logging.Filter):
+    """Add the request id and the operation of the current request to records"""
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        record.operation = getattr(record, "operation", None) or _operation.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """Format a record as one JSON object per line
+    
+    Extra fields of the record (eg: logger.info("...", extra={"duration_ms": 12})) are
+    added to the object.
+    """
+    def format(self, record):
+        document = { "time" : self.formatTime(record),
+                     "level" : record.levelname,
+                     "logger" : record.name,
+                     "message" : record.getMessage() }
+        
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                document[key] = value
+        
+        if record.exc_info:
+            document["exception"] = self.formatException(record.exc_info)
+        
+        return json.dumps(document, default=str)
+
+def configure(options=None):
+    """Configure the loggers of the broker from the "logging" section of the configuration options
+    
+    Records of "atlasbroker" loggers are written on stdout by a background thread. Calling it
+    again replaces the previous configuration.
+    
+    Args:
+        options (dict): eg: {"format": "json", "level": "INFO", "levels": {"storage": "DEBUG"}}
+            - format: "json" (default) or "text"
+            - level: Level of all subsystems
+            - levels: Level per subsystem (storage, atlas, clusters, operations, readiness, service, tracing, asgi, api)
+    """
+    global _listener
+    options = options or {}
+    
+    if _listener is not None:
+        _listener.stop()
+    
+    handler = logging.StreamHandler(sys.stdout)
+    if options.get("format", "json") == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+    
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(ContextFilter())
+    
+    root = logging.getLogger("atlasbroker")
+    for previous in list(root.handlers):
+        root.removeHandler(previous)
+    root.addHandler(queue_handler)
+    root.setLevel(options.get("level", "INFO"))
+    root.propagate = False
+    
+    for subsystem, level in options.get("levels", {}).items():
+        logging.getLogger("atlasbroker." + subsystem).setLevel(level)
+    
+    _listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+
+@atexit.register
+def _flush():
+    """Write the records still in the queue"""
+    if _listener is not None:
+        _listener.stop()
+
+def start_request(request_id=None):
+    """Set the id of the current request
+    
+    Keyword Arguments:
+        request_id (str): Request id sent by the client (a new one is generated if None)
+    
+    Returns:
+        str: The request id
+    """
+    request_id = request_id or uuid.uuid4().hex
+    _request_id.set(request_id)
+    return request_id
+
+def request_id():
+    """Id of the current request
+    
+    Returns:
+        str: The request id or None
+    """
+    return _request_id.get()
+
+@contextmanager
+def operation(name):
+    """Log an operation of the broker with its duration
+    
+    Args:
+        name (str): Name of the operation (provision, bind, ...)
+    """
+    token = _operation.set(name)
+    start = time.perf_counter()
+    level = logging.DEBUG if name in POLLED_OPERATIONS else logging.INFO
+    try:
+        yield
+    except Exception as e:
+        logger.warning("%s failed: %s", name, str(e),
+                       extra={ "duration_ms" : round((time.perf_counter() - start) * 1000, 3),
+                               "error_type" : type(e).__name__ })
+        raise
+    else:
+        logger.log(level, "%s done", name,
+                   extra={ "duration_ms" : round((time.perf_counter() - start) * 1000, 3) })
+    finally:
+        _operation.reset(token)
@@ -0,0 +1,110 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""memorystorage module
+
+In-memory storage driver
+"""
+
+import copy
+import threading
+import time
+import uuid
+from openbrokerapi.service_broker import OperationState
+from .storage import AtlasBrokerStorageBase
+
+class AtlasBrokerMemoryStorage(AtlasBrokerStorageBase):
+    """ Memory Storage
+    
+    Permit to store ServiceInstance and ServiceBinding into a dict.
+    
+    Nothing is persisted and nothing is shared between processes. This is intended for
+    benchmarks and for a single replica used for development.
+    
+    Constructor
+    
+    Keyword Arguments:
+        cache (dict): Enable the read-through cache eg: {"maxsize": 1024, "ttl": 30, "negative_ttl": 5}
+        upsert (bool): Create instances and bindings with an atomic upsert (see upsert)
+    """
+    def __init__(self, cache=None, upsert=False):
+        super().__init__(cache=cache, upsert=upsert)
+        self.documents = {}
+        self.operations = {}
+        self._lock = threading.Lock()
+    
+    def _find_one(self, instance_id, binding_id=None):
+        with self._lock:
+            return copy.deepcopy(self.documents.get((instance_id, binding_id), None))
+    
+    def _find_pair(self, instance_id, binding_id):
+        with self._lock:
+            return (copy.deepcopy(self.documents.get((instance_id, None), None)),
+                    copy.deepcopy(self.documents.get((instance_id, binding_id), None)))
+    
+    def _insert_one(self, document):
+        result, created = self._insert_if_absent(document)
+        
+        if not created:
+            # Same behavior than a unique index
+            return None
+        return result["_id"]
+    
+    def _insert_if_absent(self, document):
+        key = (document["instance_id"], document.get("binding_id", None))
+        
+        with self._lock:
+            existing = self.documents.get(key, None)
+            if existing is not None:
+                return copy.deepcopy(existing), False
+            
+            document = copy.deepcopy(document)
+            document["_id"] = uuid.uuid4().hex
+            self.documents[key] = document
+            return copy.deepcopy(document), True
+    
+    def _complete_one(self, instance_id, binding_id):
+        with self._lock:
+            document = self.documents.get((instance_id, binding_id), None)
+            if document is None:
+                return 0
+            document.pop("pending", None)
+            return 1
+    
+    def _delete_one(self, instance_id, binding_id=None):
+        with self._lock:
+            if self.documents.pop((instance_id, binding_id), None) is None:
+                return 0
+            return 1
+    
+    def save_operation(self, operation):
+        now = time.time()
+        with self._lock:
+            # Records of old operations are pruned
+            for operation_id in [ operation_id for operation_id, record in self.operations.items() if record.get("expires", now) < now ]:
+                del self.operations[operation_id]
+            self.operations[operation["_id"]] = copy.deepcopy(operation)
+    
+    def find_operation(self, operation_id):
+        with self._lock:
+            return copy.deepcopy(self.operations.get(operation_id, None))
+    
+    def find_pending_operation(self, kind, instance_id, binding_id=None):
+        with self._lock:
+            pending = [ operation for operation in self.operations.values()
+                        if operation["state"] == OperationState.IN_PROGRESS.value and
+                           (operation["kind"], operation["instance_id"], operation["binding_id"]) == (kind, instance_id, binding_id) ]
+            if not pending:
+                return None
+            return copy.deepcopy(max(pending, key=lambda operation: operation["updated"]))
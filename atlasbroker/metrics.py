@@ -0,0 +1,202 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""metrics module
+
+Prometheus metrics of the broker (needs prometheus_client: pip3 install atlasbroker[metrics])
+
+Without prometheus_client, metrics are not collected.
+"""
+
+import asyncio
+import functools
+import os
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from openbrokerapi.errors import ErrInstanceAlreadyExists, ErrBindingAlreadyExists
+from . import logs
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram
+    AVAILABLE = True
+except ImportError:
+    AVAILABLE = False
+
+class NoopMetric:
+    """Metric used when prometheus_client is not available"""
+    def labels(self, *args, **kwargs):
+        return self
+    
+    def inc(self, amount=1):
+        pass
+    
+    def dec(self, amount=1):
+        pass
+    
+    def observe(self, amount):
+        pass
+    
+    def set(self, value):
+        pass
+    
+    @contextmanager
+    def time(self):
+        yield
+
+def _histogram(name, documentation, labels):
+    return Histogram(name, documentation, labels) if AVAILABLE else NoopMetric()
+
+def _counter(name, documentation, labels):
+    return Counter(name, documentation, labels) if AVAILABLE else NoopMetric()
+
+def _gauge(name, documentation, labels):
+    return Gauge(name, documentation, labels) if AVAILABLE else NoopMetric()
+
+OPERATION_SECONDS = _histogram("atlasbroker_operation_seconds",
+                               "Time spent to serve a broker operation",
+                               ["operation"])
+
+STORAGE_SECONDS = _histogram("atlasbroker_storage_seconds",
+                             "Time spent in the storage",
+                             ["call"])
+
+ATLAS_SECONDS = _histogram("atlasbroker_atlas_seconds",
+                           "Time spent in Atlas API calls",
+                           ["method", "endpoint"])
+
+CACHE = _counter("atlasbroker_cache",
+                 "Storage cache lookups",
+                 ["result"])
+
+CONFLICTS = _counter("atlasbroker_conflicts",
+                     "Instances or bindings already existing with different parameters",
+                     ["operation"])
+
+ATLAS_RETRIES = _counter("atlasbroker_atlas_retries",
+                         "Atlas calls retried after a 429 or 5xx answer",
+                         ["endpoint", "status"])
+
+BREAKER_STATE = _gauge("atlasbroker_breaker_state",
+                       "State of the circuit breaker of a dependency (0 closed, 1 open, 2 half open)",
+                       ["dependency"])
+
+BREAKER_REJECTED = _counter("atlasbroker_breaker_rejected",
+                            "Calls rejected by an open circuit breaker",
+                            ["dependency"])
+
+ADMISSION_IN_FLIGHT = _gauge("atlasbroker_admission_in_flight",
+                             "Broker operations admitted and not done yet",
+                             ["lane"])
+
+ADMISSION_REJECTED = _counter("atlasbroker_admission_rejected",
+                              "Broker operations rejected by the admission control",
+                              ["lane"])
+
+ERRORS = _counter("atlasbroker_errors",
+                  "Failed broker operations by exception",
+                  ["operation", "exception"])
+
+@contextmanager
+def observe_operation(operation):
+    """Observe a broker operation
+    
+    Record the time spent, conflicts and errors by exception type. The operation is
+    logged with its duration too (see logs.operation).
+    
+    Args:
+        operation (str): provision, deprovision, bind, unbind, catalog, ...
+    """
+    start = time.monotonic()
+    try:
+        with logs.operation(operation):
+            yield
+    except (ErrInstanceAlreadyExists, ErrBindingAlreadyExists):
+        CONFLICTS.labels(operation).inc()
+        raise
+    except Exception as e:
+        ERRORS.labels(operation, type(e).__name__).inc()
+        raise
+    finally:
+        OPERATION_SECONDS.labels(operation).observe(time.monotonic() - start)
+
+def timed(histogram, *labels):
+    """Decorator to record the time spent in a function or a coroutine
+    
+    Args:
+        histogram (Histogram): The histogram
+        *labels: Labels of the histogram
+    """
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with histogram.labels(*labels).time():
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+        
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with histogram.labels(*labels).time():
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Segments followed by an id or a name in Atlas URIs
+ATLAS_PLACEHOLDERS = {
+    "groups" : "{group}",
+    "clusters" : "{cluster}",
+    "admin" : "{user}",
+    "processes" : "{process}",
+    "alerts" : "{alert}",
+    "whitelist" : "{entry}",
+    }
+
+def atlas_endpoint(uri):
+    """Endpoint of an Atlas URI without ids and names
+    
+    eg: https://cloud.mongodb.com/api/atlas/v1.0/groups/123/clusters/c1 => /groups/{group}/clusters/{cluster}
+    
+    Args:
+        uri (str): The URI
+    
+    Returns:
+        str: The endpoint
+    """
+    segments = urlparse(uri).path.replace("/api/atlas/v1.0", "", 1).strip("/").split("/")
+    
+    for i in range(1, len(segments)):
+        placeholder = ATLAS_PLACEHOLDERS.get(segments[i - 1], None)
+        if placeholder is not None:
+            segments[i] = placeholder
+    
+    return "/" + "/".join(segments)
+
+def export():
+    """Export the metrics with the Prometheus text format
+    
+    With several worker processes (eg: gunicorn), set PROMETHEUS_MULTIPROC_DIR to
+    export metrics of all workers.
+    
+    Returns:
+        bytes, str: The metrics and the content type
+    """
+    from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
+    
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    
+    return generate_latest(registry), CONTENT_TYPE_LATEST
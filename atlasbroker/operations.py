@@ -0,0 +1,346 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""operations module
+
+Asynchronous operations of the broker
+"""
+
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from openbrokerapi.errors import ErrBindingDoesNotExist, ErrInstanceDoesNotExist
+from openbrokerapi.service_broker import LastOperation, OperationState
+from . import deadline
+from .errors import ErrOperationsQueueFull
+
+logger = logging.getLogger("atlasbroker.operations")
+
+class OperationsBase:
+    """Asynchronous Operations interface
+    
+    Records of the operations are shared by the thread pool (see AsyncOperations) and the
+    event loop (see EventLoopOperations) implementations.
+    
+    Constructor
+    
+    Keyword Arguments:
+        stale_after (int): Seconds after which an operation still in progress is considered lost
+        keep (int): Seconds a record is kept after its last update (pruned by the storage)
+        retry_after (int): Seconds before the platform retries when the queue is full
+    """
+    def __init__(self, stale_after=600, keep=86400, retry_after=5):
+        self.stale_after = stale_after
+        self.keep = keep
+        self.retry_after = retry_after
+    
+    def _pending(self, operation):
+        """Check if an operation is still in progress
+        
+        The record of an operation is saved before its worker starts, so a retry of the platform
+        gets the same operation instead of starting a second worker. An operation in progress for
+        too long was lost by a broker (eg: restarted) and does not prevent a new one.
+        
+        Args:
+            operation (dict): The operation record or None
+        
+        Returns:
+            bool: In progress or not
+        """
+        return (operation is not None and
+                operation["state"] == OperationState.IN_PROGRESS.value and
+                time.time() - operation["updated"] < self.stale_after)
+    
+    def _record(self, kind, instance_id, binding_id):
+        """Record of a new operation
+        
+        Args:
+            kind (str): Kind of operation (provision, deprovision, bind, unbind)
+            instance_id (str): UUID of the instance
+            binding_id (str): UUID of the binding or None
+        
+        Returns:
+            dict: The operation record (the operation id is "_id")
+        """
+        now = time.time()
+        return { "_id" : uuid.uuid4().hex,
+                 "kind" : kind,
+                 "instance_id" : instance_id,
+                 "binding_id" : binding_id,
+                 "state" : OperationState.IN_PROGRESS.value,
+                 "description" : kind + " in progress",
+                 "updated" : now,
+                 # The storage removes the record after this time
+                 "expires" : now + self.keep }
+    
+    def _done(self, operation, error=None):
+        """Update the record of a finished operation
+        
+        Args:
+            operation (dict): The operation record
+        
+        Keyword Arguments:
+            error (Exception): Error of the operation or None if it succeeded
+        """
+        if error is None:
+            operation["state"] = OperationState.SUCCEEDED.value
+            operation["description"] = operation["kind"] + " done"
+        else:
+            logger.warning("operations: %s %s: %s", operation["kind"], operation["_id"], str(error))
+            operation["state"] = OperationState.FAILED.value
+            operation["description"] = "%s failed: %s" % (operation["kind"], str(error))
+        operation["updated"] = time.time()
+        operation["expires"] = operation["updated"] + self.keep
+    
+    def _last_operation(self, operation, instance_id, binding_id=None):
+        """State of an operation record
+        
+        Args:
+            operation (dict): The operation record or None
+            instance_id (str): UUID of the instance
+        
+        Keyword Arguments:
+            binding_id (str): UUID of the binding
+        
+        Returns:
+            LastOperation: State of the operation
+        
+        Raises:
+            ErrInstanceDoesNotExist: Unknown operation of an instance (410 Gone)
+            ErrBindingDoesNotExist: Unknown operation of a binding (410 Gone)
+        """
+        if operation is None or operation["instance_id"] != instance_id or operation["binding_id"] != binding_id:
+            if binding_id is None:
+                raise ErrInstanceDoesNotExist()
+            raise ErrBindingDoesNotExist()
+        
+        return LastOperation(OperationState(operation["state"]), operation["description"])
+
+class AsyncOperations(OperationsBase):
+    """Asynchronous Operations
+    
+    Run broker operations on a bounded pool of workers instead of the request thread.
+    
+    Every operation is recorded into the storage so any replica of the broker is able
+    to answer the last operation requests.
+    
+    Constructor
+    
+    Args:
+        storage (AtlasBrokerStorageBase): The storage
+    
+    Keyword Arguments:
+        workers (int): Number of workers
+        queue_size (int): Number of operations waiting for a worker
+        stale_after (int): Seconds after which an operation still in progress is considered lost
+        keep (int): Seconds a record is kept after its last update
+        retry_after (int): Seconds before the platform retries when the queue is full
+    """
+    def __init__(self, storage, workers=4, queue_size=64, stale_after=600, keep=86400, retry_after=5):
+        super().__init__(stale_after, keep, retry_after)
+        self.storage = storage
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+    
+    def submit(self, kind, instance_id, binding_id, fn, *args):
+        """Submit an operation
+        
+        Args:
+            kind (str): Kind of operation (provision, deprovision, bind, unbind)
+            instance_id (str): UUID of the instance
+            binding_id (str): UUID of the binding or None
+            fn (callable): The operation
+            *args: Arguments of the operation
+        
+        Returns:
+            str: The operation id (the one in progress if any)
+        
+        Raises:
+            ErrOperationsQueueFull: Too many operations in progress
+        """
+        pending = self.storage.find_pending_operation(kind, instance_id, binding_id)
+        if self._pending(pending):
+            return pending["_id"]
+        
+        if not self._slots.acquire(blocking=False):
+            raise ErrOperationsQueueFull(self.retry_after)
+        
+        operation = self._record(kind, instance_id, binding_id)
+        
+        try:
+            self.storage.save_operation(operation)
+            # Spans of the operation are children of the request span
+            self.executor.submit(contextvars.copy_context().run, self._run, operation, fn, *args)
+        except:
+            self._slots.release()
+            raise
+        
+        return operation["_id"]
+    
+    def _run(self, operation, fn, *args):
+        """Run an operation and record its result
+        
+        Args:
+            operation (dict): The operation record
+            fn (callable): The operation
+            *args: Arguments of the operation
+        """
+        try:
+            # The request is already answered so its deadline does not apply
+            with deadline.suspended():
+                fn(*args)
+            self._done(operation)
+        except Exception as e:
+            self._done(operation, e)
+        finally:
+            self._slots.release()
+        
+        try:
+            self.storage.save_operation(operation)
+        except Exception as e:
+            logger.warning("operations: %s %s: %s", operation["kind"], operation["_id"], str(e))
+    
+    def last_operation(self, operation_id, instance_id, binding_id=None):
+        """Last operation
+        
+        Args:
+            operation_id (str): The operation id
+            instance_id (str): UUID of the instance
+        
+        Keyword Arguments:
+            binding_id (str): UUID of the binding
+        
+        Returns:
+            LastOperation: State of the operation
+        
+        Raises:
+            ErrInstanceDoesNotExist: Unknown operation of an instance
+            ErrBindingDoesNotExist: Unknown operation of a binding
+        """
+        operation = self.storage.find_operation(operation_id) if operation_id else None
+        return self._last_operation(operation, instance_id, binding_id)
+
+class EventLoopOperations(OperationsBase):
+    """Asynchronous Operations of the asyncio broker
+    
+    Same than AsyncOperations with tasks of the event loop instead of threads. The operations
+    and the storage calls are coroutines.
+    
+    Constructor
+    
+    Args:
+        storage (AsyncAtlasBrokerStorageBase): The storage
+    
+    Keyword Arguments:
+        workers (int): Number of operations running at once
+        queue_size (int): Number of operations waiting for a worker
+        stale_after (int): Seconds after which an operation still in progress is considered lost
+        keep (int): Seconds a record is kept after its last update
+        retry_after (int): Seconds before the platform retries when the queue is full
+    """
+    def __init__(self, storage, workers=4, queue_size=64, stale_after=600, keep=86400, retry_after=5):
+        super().__init__(stale_after, keep, retry_after)
+        self.storage = storage
+        self.workers = workers
+        self.queue_size = queue_size
+        # Created on the event loop (see submit)
+        self._running = None
+        self._tasks = set()
+    
+    async def submit(self, kind, instance_id, binding_id, fn, *args):
+        """Submit an operation
+        
+        Args:
+            kind (str): Kind of operation (provision, deprovision, bind, unbind)
+            instance_id (str): UUID of the instance
+            binding_id (str): UUID of the binding or None
+            fn (callable): The operation (coroutine function)
+            *args: Arguments of the operation
+        
+        Returns:
+            str: The operation id (the one in progress if any)
+        
+        Raises:
+            ErrOperationsQueueFull: Too many operations in progress
+        """
+        pending = await self.storage.find_pending_operation(kind, instance_id, binding_id)
+        if self._pending(pending):
+            return pending["_id"]
+        
+        if len(self._tasks) >= self.workers + self.queue_size:
+            raise ErrOperationsQueueFull(self.retry_after)
+        
+        if self._running is None:
+            self._running = asyncio.Semaphore(self.workers)
+        
+        operation = self._record(kind, instance_id, binding_id)
+        await self.storage.save_operation(operation)
+        
+        # The task gets a copy of the context so spans of the operation are children of the request span
+        task = asyncio.ensure_future(self._run(operation, fn, *args))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        
+        return operation["_id"]
+    
+    async def _run(self, operation, fn, *args):
+        """Run an operation and record its result
+        
+        Args:
+            operation (dict): The operation record
+            fn (callable): The operation (coroutine function)
+            *args: Arguments of the operation
+        """
+        try:
+            async with self._running:
+                # The request is already answered so its deadline does not apply
+                with deadline.suspended():
+                    await fn(*args)
+            self._done(operation)
+        except Exception as e:
+            self._done(operation, e)
+        
+        try:
+            await self.storage.save_operation(operation)
+        except Exception as e:
+            logger.warning("operations: %s %s: %s", operation["kind"], operation["_id"], str(e))
+    
+    async def last_operation(self, operation_id, instance_id, binding_id=None):
+        """Last operation
+        
+        Args:
+            operation_id (str): The operation id
+            instance_id (str): UUID of the instance
+        
+        Keyword Arguments:
+            binding_id (str): UUID of the binding
+        
+        Returns:
+            LastOperation: State of the operation
+        
+        Raises:
+            ErrInstanceDoesNotExist: Unknown operation of an instance
+            ErrBindingDoesNotExist: Unknown operation of a binding
+        """
+        operation = await self.storage.find_operation(operation_id) if operation_id else None
+        return self._last_operation(operation, instance_id, binding_id)
+    
+    async def close(self):
+        """Wait for the operations in progress"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,209 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""ratelimit module
+
+Client side rate limit of the Atlas calls
+"""
+
+import asyncio
+import contextvars
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from . import deadline
+from .errors import ErrAtlasRateLimited
+
+# Calls are interactive (requests of the platform) unless done in background()
+_background = contextvars.ContextVar("atlasbroker_background", default=False)
+
+@contextmanager
+def background():
+    """Atlas calls done in this block have a lower priority (cluster refresh, probes, ...)"""
+    token = _background.set(True)
+    try:
+        yield
+    finally:
+        _background.reset(token)
+
+def is_background():
+    """Check the priority of the current Atlas calls
+    
+    Returns:
+        bool: True for background calls
+    """
+    return _background.get()
+
+class TokenBucket:
+    """Token Bucket
+    
+    Atlas calls of the process take a token. Tokens are added at a steady rate up to a burst.
+    There are two lanes:
+        - interactive calls can take all tokens
+        - background calls leave "reserve" tokens and wait while interactive calls are waiting
+    
+    Constructor
+    
+    Keyword Arguments:
+        rate (float): Tokens added per second (eg: quota per minute / 60 / number of processes)
+        burst (int): Maximum number of tokens
+        reserve (int): Tokens kept for interactive calls
+        timeout (float): Maximum seconds to wait for a token
+    """
+    def __init__(self, rate=1.5, burst=10, reserve=2, timeout=30):
+        self.rate = rate
+        self.burst = burst
+        self.reserve = min(reserve, burst - 1)
+        self.timeout = timeout
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.interactive_waiting = 0
+        self._lock = threading.Lock()
+    
+    def _take(self, interactive):
+        """Take a token if possible
+        
+        Returns:
+            float: 0 if a token is taken or seconds to wait before trying again
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            
+            floor = 0 if interactive else self.reserve
+            if self.tokens - floor >= 1 and (interactive or self.interactive_waiting == 0):
+                self.tokens -= 1
+                return 0
+            
+            return max(1 - (self.tokens - floor), 0.01) / self.rate
+    
+    def _waiting(self, interactive, delta):
+        if interactive:
+            with self._lock:
+                self.interactive_waiting += delta
+    
+    def acquire(self):
+        """Wait for a token (priority of the current context)
+        
+        Raises:
+            ErrAtlasRateLimited: No token in time
+            ErrDeadlineExceeded: No token before the deadline of the request
+        """
+        interactive = not is_background()
+        # Never wait after the deadline of the request
+        wait_until = time.monotonic() + deadline.timeout(self.timeout)
+        
+        wait = self._take(interactive)
+        if wait == 0:
+            return
+        
+        self._waiting(interactive, 1)
+        try:
+            while wait > 0:
+                remaining = wait_until - time.monotonic()
+                if remaining <= 0:
+                    deadline.check("atlas")
+                    raise ErrAtlasRateLimited(self.timeout, max(math.ceil(wait), 1))
+                time.sleep(min(wait, remaining))
+                wait = self._take(interactive)
+        finally:
+            self._waiting(interactive, -1)
+    
+    async def acquire_async(self):
+        """Wait for a token without blocking the event loop (see acquire)
+        
+        Raises:
+            ErrAtlasRateLimited: No token in time
+            ErrDeadlineExceeded: No token before the deadline of the request
+        """
+        interactive = not is_background()
+        # Never wait after the deadline of the request
+        wait_until = time.monotonic() + deadline.timeout(self.timeout)
+        
+        wait = self._take(interactive)
+        if wait == 0:
+            return
+        
+        self._waiting(interactive, 1)
+        try:
+            while wait > 0:
+                remaining = wait_until - time.monotonic()
+                if remaining <= 0:
+                    deadline.check("atlas")
+                    raise ErrAtlasRateLimited(self.timeout, max(math.ceil(wait), 1))
+                await asyncio.sleep(min(wait, remaining))
+                wait = self._take(interactive)
+        finally:
+            self._waiting(interactive, -1)
+
+class RetryPolicy:
+    """Retry Policy
+    
+    Atlas answers throttled (429) or unavailable (5xx) calls are retried with a jittered
+    exponential backoff. Retry-After is honored when Atlas sends it.
+    
+    Constructor
+    
+    Keyword Arguments:
+        max_retries (int): Maximum number of retries of a call (0 disables retries)
+        backoff (float): Base delay in seconds
+        max_backoff (float): Maximum delay in seconds. A longer Retry-After is not waited.
+        statuses (iterable): HTTP status codes to retry
+    """
+    def __init__(self, max_retries=3, backoff=0.5, max_backoff=30, statuses=(429, 500, 502, 503, 504)):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = frozenset(statuses)
+    
+    def delay(self, attempt, status_code, retry_after=None):
+        """Delay before the next retry
+        
+        Args:
+            attempt (int): Number of retries already done
+            status_code (int): HTTP status code of the answer
+            retry_after (str): Value of the Retry-After header or None
+        
+        Returns:
+            float: Seconds to wait or None to not retry
+        """
+        if status_code not in self.statuses or attempt >= self.max_retries:
+            return None
+        
+        delay = self._retry_after(retry_after)
+        if delay is None:
+            # Full jitter
+            return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+        
+        return delay if delay <= self.max_backoff else None
+    
+    @staticmethod
+    def _retry_after(value):
+        """Seconds to wait from a Retry-After header (seconds or HTTP date)"""
+        if not value:
+            return None
+        
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
@@ -0,0 +1,148 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""readiness module
+
+Readiness of the broker dependencies
+"""
+
+import asyncio
+import logging
+import threading
+import time
+
+logger = logging.getLogger("atlasbroker.readiness")
+
+class ReadinessProbe:
+    """Readiness Probe
+    
+    Check the dependencies of the broker (storage, Atlas) in the background and serve the
+    last result from memory, so readiness requests never call the dependencies.
+    
+    The broker is not ready until the first checks are done, if a check failed or if the
+    last result is too old (the probe is stuck on a dependency).
+    
+    Constructor
+    
+    Args:
+        checks (dict): Name and check of each dependency. A check raises if the dependency is not usable.
+    
+    Keyword Arguments:
+        interval (float): Seconds between two checks (0 checks once at start, the result never expires)
+    """
+    def __init__(self, checks, interval=10):
+        self.checks = checks
+        self.interval = interval
+        self.results = {}
+        self.updated = None
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        """Start to check in a background thread"""
+        if self.interval <= 0:
+            # No background checks, the broker is ready once checked
+            self.refresh()
+            return
+        
+        self._thread = threading.Thread(target=self.run, name="readiness", daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """Stop to check"""
+        self._stop.set()
+    
+    def run(self):
+        """Check until stopped"""
+        self.refresh()
+        while not self._stop.wait(self.interval):
+            self.refresh()
+    
+    def refresh(self):
+        """Check all dependencies"""
+        results = {}
+        for name, check in self.checks.items():
+            try:
+                check()
+                results[name] = True
+            except Exception as e:
+                logger.warning("readiness: %s: %s", name, str(e))
+                results[name] = False
+        self._record(results)
+    
+    def _record(self, results):
+        # Swap at once
+        self.results = results
+        self.updated = time.monotonic()
+    
+    def status(self):
+        """Last known readiness
+        
+        Returns:
+            dict: eg: {"status": True, "checks": {"storage": True, "atlas": True}}
+        """
+        results = self.results
+        fresh = self.updated is not None and (self.interval <= 0 or time.monotonic() - self.updated < 3 * self.interval)
+        
+        return { "status" : fresh and len(results) == len(self.checks) and all(results.values()),
+                 "checks" : dict(results) }
+
+class AsyncReadinessProbe(ReadinessProbe):
+    """Async Readiness Probe
+    
+    Same than ReadinessProbe with coroutines as checks. Checks run in a task of the event loop.
+    
+    Constructor
+    
+    Args:
+        checks (dict): Name and coroutine function of each dependency
+    
+    Keyword Arguments:
+        interval (float): Seconds between two checks (0 checks once at start, the result never expires)
+    """
+    def __init__(self, checks, interval=10):
+        super().__init__(checks, interval)
+        self._task = None
+    
+    def start(self):
+        """Start to check in a task (called once the event loop is running)"""
+        if self.interval <= 0:
+            # No background checks, the broker is ready once checked
+            self._task = asyncio.get_event_loop().create_task(self.refresh())
+            return
+        
+        self._task = asyncio.get_event_loop().create_task(self.run())
+    
+    def stop(self):
+        """Stop to check"""
+        if self._task is not None:
+            self._task.cancel()
+    
+    async def run(self):
+        """Check until stopped"""
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.interval)
+    
+    async def refresh(self):
+        """Check all dependencies"""
+        results = {}
+        for name, check in self.checks.items():
+            try:
+                await check()
+                results[name] = True
+            except Exception as e:
+                logger.warning("readiness: %s: %s", name, str(e))
+                results[name] = False
+        self._record(results)
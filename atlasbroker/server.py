@@ -0,0 +1,75 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""server module
+
+Production server of the broker (needs gunicorn: pip3 install atlasbroker[server])
+"""
+
+import os
+from gunicorn.app.base import BaseApplication
+
+class GunicornServer(BaseApplication):
+    """Gunicorn Server
+    
+    Serve the broker with pre-forked workers and threads per worker.
+    
+    The Flask application is created by each worker after the fork, so every worker
+    has its own MongoDB and Atlas clients and its own background threads.
+    
+    The number of workers is explicit (2 by default) rather than derived from the CPUs of the
+    host, a container only gets a share of them.
+    
+    Constructor
+    
+    Args:
+        broker (Broker): The broker
+    
+    Keyword Arguments:
+        options (dict): Gunicorn settings eg: {"workers": 4, "threads": 8, "keepalive": 5}
+    """
+    
+    # Defaults used when not set in options
+    DEFAULTS = {
+        "bind" : "0.0.0.0:5000",
+        "worker_class" : "gthread",
+        "workers" : 2,
+        "threads" : 4,
+        "keepalive" : 5,
+        "backlog" : 2048,
+        "timeout" : 30,
+        }
+    
+    def __init__(self, broker, options=None):
+        self.broker = broker
+        self.options = dict(self.DEFAULTS)
+        self.options.update(options or {})
+        super().__init__()
+    
+    def load_config(self):
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            # Metrics of a dead worker are removed
+            self.cfg.set("child_exit", self.child_exit)
+        
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+    
+    @staticmethod
+    def child_exit(server, worker):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+    
+    def load(self):
+        # Called in the worker after the fork (unless preload_app is set)
+        return self.broker.app
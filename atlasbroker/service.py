@@ -22,10 +22,14 @@ from openbrokerapi.catalog import (
 )
 from openbrokerapi.service_broker import (
     ServiceBroker,
-    Service,
     ProvisionedServiceSpec,
     UpdateServiceSpec,
+    ProvisionState,
     Binding,
+    BindState,
+    GetBindingSpec,
+    GetInstanceDetailsSpec,
+    UnbindSpec,
     DeprovisionServiceSpec,
     LastOperation,
     UnbindDetails,
@@ -34,18 +38,18 @@ from openbrokerapi.service_broker import (
     BindDetails,
     DeprovisionDetails
 )
-from openbrokerapi.errors import (
-    ErrBindingDoesNotExist,
-    ErrInstanceDoesNotExist
-)
 
+from . import metrics, steps, tracing
 from .backend import AtlasBrokerBackend
-from .errors import ErrPlanUnsupported
+from .brokersteps import BrokerSteps
+from .catalog import CatalogCache, create_service
+from .singleflight import SingleFlight, request_key
 
-class AtlasBroker(ServiceBroker):
+class AtlasBroker(BrokerSteps, ServiceBroker):
     """Atlas Broker
     
-    Implement a service broker by overriding methods of Service
+    Implement a service broker by overriding methods of Service. The logic of the operations
+    is shared with AsyncAtlasBroker (see BrokerSteps).
     
     Constructor
     
@@ -56,22 +60,41 @@ class AtlasBroker(ServiceBroker):
         # Create the AtlasBrokerBackend
         self._backend = AtlasBrokerBackend(config)
         self._config = config
+        
+        # Retries of the platform for the same request are served once
+        self._flights = SingleFlight()
+        
+        # Catalog built and serialized once (see apis.broker). Credentials of an asynchronous
+        # binding are fetched with get_binding
+        self.catalog_cache = CatalogCache(lambda: create_service(config, self._backend.operations is not None))
+    
+    @property
+    def readiness(self):
+        """ReadinessProbe of the broker dependencies"""
+        return self._backend.readiness
 
     def catalog(self):
-        return Service(
-            id=self._config.broker["id"],
-            name=self._config.broker["name"],
-            description=self._config.broker["description"],
-            bindable=self._config.broker["bindable"],
-            plans=self._config.broker["plans"],
-            tags=self._config.broker["tags"],
-            requires=self._config.broker["requires"],
-            metadata=self._config.broker["metadata"],
-            dashboard_client=self._config.broker["dashboard_client"],
-            plan_updateable=self._config.broker["plan_updateable"],
-        )
-
-    def provision(self, instance_id: str, service_details: ProvisionDetails, async_allowed: bool) -> ProvisionedServiceSpec:
+        # Called by openbrokerapi to check the plan of every request, the Service is built once
+        return self.catalog_cache.service
+
+    def _leased(self, instance_id, binding_id, fn, *args):
+        """Call fn with the lease of the instance or the binding (see AtlasBrokerStorageBase.lease)
+        
+        Args:
+            instance_id (str): UUID of the instance
+            binding_id (str): UUID of the binding or None
+            fn (callable): The call
+            *args: Arguments of the call
+        """
+        with self._backend.storage.lease(instance_id, binding_id):
+            return fn(*args)
+
+    # Workers of the asynchronous operations run the steps with blocking calls
+    _run_steps = staticmethod(steps.run)
+
+    @metrics.observe_operation("provision")
+    @tracing.traced("service.provision")
+    def provision(self, instance_id: str, details: ProvisionDetails, async_allowed: bool, **kwargs) -> ProvisionedServiceSpec:
         """Provision the new instance
         
         see openbrokerapi documentation
@@ -79,39 +102,36 @@ class AtlasBroker(ServiceBroker):
         Returns:
             ProvisionedServiceSpec
         """
+        return self._flights.do(request_key("provision", instance_id, None, details.parameters, async_allowed, details.plan_id),
+                                self._leased, instance_id, None, steps.run, self._provision_steps(instance_id, details, async_allowed))
+
+    @metrics.observe_operation("get_instance")
+    @tracing.traced("service.get_instance")
+    def get_instance(self, instance_id: str, **kwargs) -> GetInstanceDetailsSpec:
+        """Fetch an instance
         
-        if service_details.plan_id == self._backend.config.UUID_PLANS_EXISTING_CLUSTER:
-            # Provision the instance on an Existing Atlas Cluster
-            
-            # Find or create the instance
-            instance = self._backend.find(instance_id)
-            
-            # Create the instance if needed
-            return self._backend.create(instance, service_details.parameters, existing=True)
+        see openbrokerapi documentation
         
-        # Plan not supported
-        raise ErrPlanUnsupported(service_details.plan_id)
+        Raises:
+            ErrInstanceDoesNotExist: Instance does not exist.
+        """
+        return steps.run(self._get_instance_steps(instance_id))
 
-    def unbind(self, instance_id: str, binding_id: str, details: UnbindDetails):
+    @metrics.observe_operation("unbind")
+    @tracing.traced("service.unbind")
+    def unbind(self, instance_id: str, binding_id: str, details: UnbindDetails, async_allowed: bool, **kwargs) -> UnbindSpec:
         """Unbinding the instance
         
         see openbrokerapi documentation
         
+        Returns:
+            UnbindSpec
+        
         Raises:
             ErrBindingDoesNotExist: Binding does not exist.
         """
-        
-        # Find the instance
-        instance = self._backend.find(instance_id)
-        
-        # Find the binding
-        binding = self._backend.find(binding_id, instance)
-        if not binding.isProvisioned():
-            # The binding does not exist
-            raise ErrBindingDoesNotExist()
-        
-        # Delete the binding
-        self._backend.unbind(binding)
+        return self._flights.do(request_key("unbind", instance_id, binding_id, None, async_allowed),
+                                self._leased, instance_id, binding_id, steps.run, self._unbind_steps(instance_id, binding_id, async_allowed))
 
     def update(self, instance_id: str, details: UpdateDetails, async_allowed: bool) -> UpdateServiceSpec:
         """Update
@@ -123,22 +143,34 @@ class AtlasBroker(ServiceBroker):
         """
         raise NotImplementedError()
 
-    def bind(self, instance_id: str, binding_id: str, details: BindDetails) -> Binding:
+    @metrics.observe_operation("bind")
+    @tracing.traced("service.bind")
+    def bind(self, instance_id: str, binding_id: str, details: BindDetails, async_allowed: bool, **kwargs) -> Binding:
         """Binding the instance
         
         see openbrokerapi documentation
         """
+        return self._flights.do(request_key("bind", instance_id, binding_id, details.parameters, async_allowed),
+                                self._leased, instance_id, binding_id, steps.run, self._bind_steps(instance_id, binding_id, details, async_allowed))
+
+    @metrics.observe_operation("get_binding")
+    @tracing.traced("service.get_binding")
+    def get_binding(self, instance_id: str, binding_id: str, **kwargs) -> GetBindingSpec:
+        """Fetch a binding
         
-        # Find the instance
-        instance = self._backend.find(instance_id)
+        Used to get the credentials of a binding created asynchronously.
         
-        # Find or create the binding
-        binding = self._backend.find(binding_id, instance)
+        see openbrokerapi documentation
         
-        # Create the binding if needed
-        return self._backend.bind(binding, details.parameters)
+        Raises:
+            ErrBindingDoesNotExist: Binding does not exist.
+            NotImplementedError: Credentials generation is not predictible
+        """
+        return steps.run(self._get_binding_steps(instance_id, binding_id))
 
-    def deprovision(self, instance_id: str, details: DeprovisionDetails, async_allowed: bool) -> DeprovisionServiceSpec:
+    @metrics.observe_operation("deprovision")
+    @tracing.traced("service.deprovision")
+    def deprovision(self, instance_id: str, details: DeprovisionDetails, async_allowed: bool, **kwargs) -> DeprovisionServiceSpec:
         """Deprovision an instance
         
         see openbrokerapi documentation
@@ -146,22 +178,31 @@ class AtlasBroker(ServiceBroker):
         Raises:
             ErrInstanceDoesNotExist: Instance does not exist.
         """
-        
-        # Find the instance
-        instance = self._backend.find(instance_id)
-        if not instance.isProvisioned():
-            # the instance does not exist
-            raise ErrInstanceDoesNotExist()
-        
-        return self._backend.delete(instance)
+        return self._flights.do(request_key("deprovision", instance_id, None, None, async_allowed),
+                                self._leased, instance_id, None, steps.run, self._deprovision_steps(instance_id, async_allowed))
 
-    def last_operation(self, instance_id: str, operation_data: str) -> LastOperation:
+    @metrics.observe_operation("last_operation")
+    @tracing.traced("service.last_operation")
+    def last_operation(self, instance_id: str, operation_data: str, **kwargs) -> LastOperation:
         """Last Operation
         
-        Not implemented. We are not using asynchronous operation on Atlas Broker.
+        State of an asynchronous provision or deprovision
         
         Raises:
-            NotImplementedError
+            NotImplementedError: Asynchronous operations are disabled
+            ErrInstanceDoesNotExist: Unknown operation (410 Gone)
         """
-        raise NotImplementedError()
+        return steps.run(self._last_operation_steps(instance_id, None, operation_data))
 
+    @metrics.observe_operation("last_binding_operation")
+    @tracing.traced("service.last_binding_operation")
+    def last_binding_operation(self, instance_id: str, binding_id: str, operation_data: str, **kwargs) -> LastOperation:
+        """Last Binding Operation
+        
+        State of an asynchronous bind or unbind
+        
+        Raises:
+            NotImplementedError: Asynchronous operations are disabled
+            ErrBindingDoesNotExist: Unknown operation (410 Gone)
+        """
+        return steps.run(self._last_operation_steps(instance_id, binding_id, operation_data))
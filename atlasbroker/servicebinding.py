@@ -17,10 +17,14 @@
 Used to manage binding requests
 """
 
+import time
 from openbrokerapi.errors import ErrBindingAlreadyExists
 from openbrokerapi.service_broker import Binding, BindState
 from atlasapi.specs import DatabaseUsersPermissionsSpecs
 from atlasapi.errors import ErrAtlasNotFound, ErrAtlasConflict
+from .serviceinstance import AtlasServiceInstance
+from .errors import ErrBindingClaimed
+from . import deadline, steps, tracing
 
 class AtlasServiceBinding():
     """Service Catalog : Atlas Service Binding
@@ -30,10 +34,14 @@ class AtlasServiceBinding():
     Args:
         backend (AtlasBrokerBackend): Atlas Broker Backend
     """
+    
+    # Seconds after which a pending claim of a binding is taken over (its broker stopped during the creation)
+    CLAIM_TIMEOUT = 120
+    
     def __init__(self, backend):
         self.backend = backend
     
-    def find(self, binding_id, instance):
+    def find(self, binding_id, instance, populate=True):
         """find an instance
         
         Create a new instance and populate it with data stored if it exists.
@@ -42,11 +50,43 @@ class AtlasServiceBinding():
             binding_id (string): UUID of the binding
             instance (AtlasServiceInstance.Instance): instance
             
+        Keyword Arguments:
+            populate (bool): Populate from the storage. If False, a new binding is returned.
+            
         Returns:
             AtlasServiceBinding: A binding
         """
+        return steps.run(self.find_steps(binding_id, instance, populate))
+    
+    def find_steps(self, binding_id, instance, populate=True):
+        """ Steps of find (see steps module) """
+        binding = AtlasServiceBinding.Binding(binding_id, instance)
+        if populate:
+            yield steps.call(self.backend.storage.populate, binding)
+        else:
+            binding.provisioned = False
+        return binding
+    
+    def find_with_instance(self, binding_id, instance_id):
+        """find a binding and its instance
+        
+        Create a new instance and a new binding and populate both with data stored
+        if they exist. This is done with a single storage lookup.
+        
+        Args:
+            binding_id (string): UUID of the binding
+            instance_id (string): UUID of the instance
+            
+        Returns:
+            AtlasServiceBinding: A binding (binding.instance is the instance)
+        """
+        return steps.run(self.find_with_instance_steps(binding_id, instance_id))
+    
+    def find_with_instance_steps(self, binding_id, instance_id):
+        """ Steps of find_with_instance (see steps module) """
+        instance = AtlasServiceInstance.Instance(instance_id, self.backend)
         binding = AtlasServiceBinding.Binding(binding_id, instance)
-        self.backend.storage.populate(binding)
+        yield steps.call(self.backend.storage.populate_binding, binding)
         return binding
     
     def bind(self, binding, parameters):
@@ -61,50 +101,113 @@ class AtlasServiceBinding():
             
         Raises:
             ErrBindingAlreadyExists: If binding exists but with different parameters
+            ErrBindingClaimed: If binding is being created by another call
         """
-        
-        if not binding.isProvisioned():
+        return steps.run(self.bind_steps(binding, parameters))
+    
+    def bind_steps(self, binding, parameters):
+        """ Steps of bind (see steps module) """
+        if binding.isProvisioned():
+            if binding.parameters != parameters:
+                # Different parameters ...
+                raise ErrBindingAlreadyExists()
+            
+            if binding.pending is None:
+                return self._identical(binding)
+            
+            # Claimed but not created yet
+            self._take_over(binding)
+        else:
             # Update binding parameters
             binding.parameters = parameters
+            binding.credentials_key = self.backend.config.credentials_key
             
+            if self.backend.storage.use_upsert:
+                # Claim the binding before doing anything on Atlas so concurrent calls
+                # for the same binding will never create the database user twice.
+                # The claim is pending until the database user is created.
+                binding.pending = time.time()
+                state, _ = yield steps.call(self.backend.storage.upsert, binding)
+                
+                if state is self.backend.storage.StoreState.IDENTICAL:
+                    if binding.pending is None:
+                        return self._identical(binding)
+                    self._take_over(binding)
+                elif state is self.backend.storage.StoreState.CONFLICT:
+                    raise ErrBindingAlreadyExists()
+        
+        try:
             #  Credentials
-            creds = self.backend.config.generate_binding_credentials(binding)
+            with tracing.span("config.generate_binding_credentials"):
+                creds = self.backend.config.generate_binding_credentials(binding)
             
             # Binding
-            p = self.backend.config.generate_binding_permissions(
-                binding,
-                DatabaseUsersPermissionsSpecs(creds["username"],creds["password"])
-                )
+            with tracing.span("config.generate_binding_permissions"):
+                p = self.backend.config.generate_binding_permissions(
+                    binding,
+                    DatabaseUsersPermissionsSpecs(creds["username"],creds["password"])
+                    )
             
             try:
-                self.backend.atlas.DatabaseUsers.create_a_database_user(p)
+                yield steps.call(self.backend.create_database_user, p)
             except ErrAtlasConflict:
                 # The user already exists. This is not an issue because this is possible that we
                 # created it in a previous call that failed later on the broker.
                 pass
+        except:
+            if binding.pending is not None:
+                # Release the claim so a retry can create the binding (even after the deadline)
+                with deadline.suspended():
+                    yield steps.call(self.backend.storage.remove, binding)
+            raise
+        
+        if binding.pending is not None:
+            yield steps.call(self.backend.storage.complete_claim, binding)
+        else:
+            yield steps.call(self.backend.storage.store, binding)
+        
+        # Bind done
+        return Binding(BindState.SUCCESSFUL_BOUND,
+                       credentials = creds)
+    
+    def _take_over(self, binding):
+        """ Take over the pending claim of a binding
+        
+        A claim is pending while another call creates the binding. A claim older than
+        CLAIM_TIMEOUT was left by a broker that stopped before completing it.
+        
+        Args:
+            binding (AtlasServiceBinding.Binding): Pending binding
             
-            self.backend.storage.store(binding)
-            
-            # Bind done
-            return Binding(BindState.SUCCESSFUL_BOUND,
-                           credentials = creds)
+        Raises:
+            ErrBindingClaimed: If the claim is recent
+        """
+        if time.time() - binding.pending < self.CLAIM_TIMEOUT:
+            raise ErrBindingClaimed(binding.binding_id)
+    
+    def _identical(self, binding):
+        """ An identical binding already exists
         
-        elif binding.parameters == parameters:
-            if self.backend.config.isGenerateBindingCredentialsPredictible():
-                # Identical and credentials generation is predictible so we can return credentials again.
-                creds = self.backend.config.generate_binding_credentials(binding)
-                
-                return Binding(BindState.IDENTICAL_ALREADY_EXISTS,
-                               credentials = creds)
+        Args:
+            binding (AtlasServiceBinding.Binding): Existing binding
             
-            # Identical but credentials generation is NOT predictible. So we are breaking the spec to avoid
-            # wrong data injection. In this case we trigger a conflicting parameters for the existing binding depsite
-            # this is not the case.
-            raise ErrBindingAlreadyExists()
+        Returns:
+            Binding: Status
+            
+        Raises:
+            ErrBindingAlreadyExists: If credentials generation is not predictible
+        """
+        if self.backend.config.isBindingCredentialsPredictible(binding):
+            # Identical and credentials generation is predictible so we can return credentials again.
+            creds = self.backend.config.generate_binding_credentials(binding)
+            
+            return Binding(BindState.IDENTICAL_ALREADY_EXISTS,
+                           credentials = creds)
         
-        else:
-            # Different parameters ...
-            raise ErrBindingAlreadyExists()
+        # Identical but credentials generation is NOT predictible. So we are breaking the spec to avoid
+        # wrong data injection. In this case we trigger a conflicting parameters for the existing binding depsite
+        # this is not the case.
+        raise ErrBindingAlreadyExists()
     
     def unbind(self, binding):
         """ Unbind the instance
@@ -112,18 +215,21 @@ class AtlasServiceBinding():
         Args:
             binding (AtlasServiceBinding.Binding): Existing or New binding
         """
-        
+        return steps.run(self.unbind_steps(binding))
+    
+    def unbind_steps(self, binding):
+        """ Steps of unbind (see steps module) """
         username = self.backend.config.generate_binding_username(binding)
         
         try:
-            self.backend.atlas.DatabaseUsers.delete_a_database_user(username)
+            yield steps.call(self.backend.delete_database_user, username)
         except ErrAtlasNotFound:
             # The user does not exist. This is not an issue because this is possible that we
             # removed it in a previous call that failed later on the broker.
             # This cover a manually deleted user case too.
             pass
 
-        self.backend.storage.remove(binding)
+        yield steps.call(self.backend.storage.remove, binding)
     
     class Binding:
         """Binding
@@ -138,6 +244,10 @@ class AtlasServiceBinding():
             self.binding_id = binding_id
             self.instance = instance
             self.provisioned = True
+            # Key of the derived credentials (see Config.generate_binding_password)
+            self.credentials_key = None
+            # Time of the claim while the binding is not created on Atlas yet (see AtlasBrokerStorageBase.complete_claim)
+            self.pending = None
         
         def isProvisioned(self):
             """was it populated from the storage ?
@@ -20,6 +20,7 @@ Used to manage instance requests
 from openbrokerapi.errors import ErrInstanceAlreadyExists
 from openbrokerapi.service_broker import ProvisionedServiceSpec, ProvisionState, DeprovisionServiceSpec
 from .errors import ErrClusterNotFound
+from . import steps
     
 class AtlasServiceInstance():
     """Service Catalog : Atlas Service Instance
@@ -32,7 +33,7 @@ class AtlasServiceInstance():
     def __init__(self, backend):
         self.backend = backend
     
-    def find(self, instance_id):
+    def find(self, instance_id, populate=True):
         """ find an instance
         
         Create a new instance and populate it with data stored if it exists.
@@ -40,11 +41,21 @@ class AtlasServiceInstance():
         Args:
             instance_id (str): UUID of the instance
         
+        Keyword Arguments:
+            populate (bool): Populate from the storage. If False, a new instance is returned.
+        
         Returns:
             AtlasServiceInstance.Instance: An instance
         """
+        return steps.run(self.find_steps(instance_id, populate))
+    
+    def find_steps(self, instance_id, populate=True):
+        """ Steps of find (see steps module) """
         instance = AtlasServiceInstance.Instance(instance_id, self.backend)
-        self.backend.storage.populate(instance)
+        if populate:
+            yield steps.call(self.backend.storage.populate, instance)
+        else:
+            instance.provisioned = False
         return instance
     
     def create(self, instance, parameters, existing):
@@ -63,21 +74,38 @@ class AtlasServiceInstance():
             ErrClusterNotFound: Cluster does not exist
         """
         
+        return steps.run(self.create_steps(instance, parameters, existing))
+    
+    def create_steps(self, instance, parameters, existing):
+        """ Steps of create (see steps module) """
         if not instance.isProvisioned():
             # Set parameters
             instance.parameters = parameters
             
             # Existing cluster
-            if existing and not self.backend.atlas.Clusters.is_existing_cluster(instance.parameters[self.backend.config.PARAMETER_CLUSTER]):
-                # We need to use an existing cluster that is not available !
-                raise ErrClusterNotFound(instance.parameters[self.backend.config.PARAMETER_CLUSTER])
-            elif not existing:
+            if existing:
+                cluster = instance.parameters[self.backend.config.PARAMETER_CLUSTER]
+                if not (yield steps.call(self.backend.is_existing_cluster, cluster)):
+                    # We need to use an existing cluster that is not available !
+                    raise ErrClusterNotFound(cluster)
+            else:
                 # We need to create a new cluster
                 # We should not reach this code because the AtlasBroker.provision should
                 # raise an ErrPlanUnsupported before.
                 raise NotImplementedError()
             
-            result = self.backend.storage.store(instance)
+            if self.backend.storage.use_upsert:
+                # Store it only if it does not exist yet
+                state, result = yield steps.call(self.backend.storage.upsert, instance)
+                
+                if state is self.backend.storage.StoreState.IDENTICAL:
+                    return ProvisionedServiceSpec(ProvisionState.IDENTICAL_ALREADY_EXISTS,
+                                                  "",
+                                                  "duplicate")
+                elif state is self.backend.storage.StoreState.CONFLICT:
+                    raise ErrInstanceAlreadyExists()
+            else:
+                result = yield steps.call(self.backend.storage.store, instance)
             
             # Provision done
             return ProvisionedServiceSpec(ProvisionState.SUCCESSFUL_CREATED,
@@ -112,7 +140,11 @@ class AtlasServiceInstance():
         #      - credential on the Atlas cluster `instance.get_cluster()` to drop the database
         #
         
-        self.backend.storage.remove(instance)
+        return steps.run(self.delete_steps(instance))
+    
+    def delete_steps(self, instance):
+        """ Steps of delete (see steps module) """
+        yield steps.call(self.backend.storage.remove, instance)
         
         return DeprovisionServiceSpec(False, "done")
     
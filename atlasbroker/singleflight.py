@@ -0,0 +1,152 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""singleflight module
+
+Coalesce concurrent duplicate requests
+"""
+
+import asyncio
+import json
+import threading
+from . import deadline
+from .errors import ErrDeadlineExceeded
+
+def request_key(operation, instance_id, binding_id=None, parameters=None, async_allowed=False, plan_id=None):
+    """Key of a broker request
+    
+    Parameters (and the plan) are part of the key so a request with different parameters
+    is never answered with the result of another one.
+    
+    Args:
+        operation (str): provision, deprovision, bind or unbind
+        instance_id (str): UUID of the instance
+    
+    Keyword Arguments:
+        binding_id (str): UUID of the binding
+        parameters (dict): Parameters of the request
+        async_allowed (bool): The platform accepts an asynchronous operation
+        plan_id (str): UUID of the plan
+    
+    Returns:
+        tuple: The key
+    """
+    return (operation, instance_id, binding_id, plan_id, json.dumps(parameters, sort_keys=True, default=str), async_allowed)
+
+class SingleFlight:
+    """Single Flight
+    
+    The first call for a key (the leader) runs. Concurrent calls with the same key wait
+    for the result or the exception of the leader instead of doing the same work again.
+    
+    Nothing is cached: once the leader is done, a new call runs again.
+    
+    Waiting calls give up once the deadline of their own request is over (see deadline).
+    """
+    
+    class Call:
+        """A call in flight"""
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+    
+    def do(self, key, fn, *args):
+        """Run fn once for all concurrent calls with the same key
+        
+        Args:
+            key (hashable): The key
+            fn (callable): The call
+            *args: Arguments of the call
+        
+        Returns:
+            The result of the leader
+        
+        Raises:
+            The exception of the leader
+            ErrDeadlineExceeded: The deadline is over before the leader is done
+        """
+        with self._lock:
+            call = self._calls.get(key, None)
+            leader = call is None
+            if leader:
+                call = SingleFlight.Call()
+                self._calls[key] = call
+            else:
+                self.coalesced += 1
+        
+        if not leader:
+            if not call.done.wait(deadline.timeout(None)):
+                raise ErrDeadlineExceeded("singleflight")
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
+        try:
+            call.result = fn(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+    
+    def stats(self):
+        """Statistics
+        
+        Returns:
+            dict: calls in flight and calls coalesced since the start
+        """
+        return { "in_flight" : len(self._calls), "coalesced" : self.coalesced }
+
+class AsyncSingleFlight(SingleFlight):
+    """Async Single Flight
+    
+    Same than SingleFlight for coroutines (one event loop).
+    """
+    
+    async def do(self, key, fn, *args):
+        future = self._calls.get(key, None)
+        if future is not None:
+            self.coalesced += 1
+            # The leader is not cancelled with a waiter
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), deadline.timeout(None))
+            except asyncio.TimeoutError:
+                raise ErrDeadlineExceeded("singleflight")
+        
+        future = asyncio.get_event_loop().create_future()
+        self._calls[key] = future
+        
+        try:
+            result = await fn(*args)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            # Retrieved by waiters if any
+            future.exception()
+            raise
+        finally:
+            del self._calls[key]
+            if not future.done():
+                # The leader was cancelled
+                future.cancel()
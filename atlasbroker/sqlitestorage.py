@@ -0,0 +1,272 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""sqlitestorage module
+
+SQLite storage driver
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from openbrokerapi.service_broker import OperationState
+from .storage import AtlasBrokerStorageBase
+from .errors import ErrStorageConnection
+
+logger = logging.getLogger("atlasbroker.storage")
+
+class AtlasBrokerSQLiteStorage(AtlasBrokerStorageBase):
+    """ SQLite Storage
+    
+    Permit to store ServiceInstance and ServiceBinding into a SQLite database.
+    
+    The database is used in WAL mode so readers never block the writer. Each thread
+    uses its own connection. This is intended for small installations with a single
+    replica of the broker and a local volume.
+    
+    Instances are stored with an empty binding_id so the unique index on
+    (instance_id, binding_id) covers instances and bindings.
+    
+    Constructor
+    
+    Args:
+        path (str): Path of the database file
+    
+    Keyword Arguments:
+        cache (dict): Enable the read-through cache eg: {"maxsize": 1024, "ttl": 30, "negative_ttl": 5}
+        upsert (bool): Create instances and bindings with an atomic upsert (see upsert)
+        timeout (float): Seconds to wait for a lock on the database
+    
+    Raises:
+        ErrStorageConnection: Error during SQLite communication.
+    """
+    
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS broker (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            instance_id TEXT NOT NULL,
+            binding_id TEXT NOT NULL DEFAULT '',
+            database TEXT,
+            cluster TEXT,
+            parameters TEXT NOT NULL,
+            credentials_key TEXT,
+            pending REAL)""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS broker_instance_id_binding_id ON broker (instance_id, binding_id)",
+        """CREATE TABLE IF NOT EXISTS operations (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            instance_id TEXT NOT NULL,
+            binding_id TEXT NOT NULL DEFAULT '',
+            state TEXT NOT NULL,
+            updated REAL NOT NULL,
+            expires REAL,
+            document TEXT NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS operations_pending ON operations (kind, instance_id, binding_id, state)",
+        "CREATE INDEX IF NOT EXISTS operations_expires ON operations (expires)",
+        ]
+    
+    def __init__(self, path, cache=None, upsert=False, timeout=5.0):
+        super().__init__(cache=cache, upsert=upsert)
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        
+        try:
+            connection = self._connection()
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                columns = [ row["name"] for row in connection.execute("PRAGMA table_info(operations)") ]
+                if columns and "kind" not in columns:
+                    # Records of an older schema, they are only used by operations in progress
+                    connection.execute("DROP TABLE operations")
+                
+                for statement in self.SCHEMA:
+                    connection.execute(statement)
+                
+                columns = [ row["name"] for row in connection.execute("PRAGMA table_info(broker)") ]
+                if "credentials_key" not in columns:
+                    # Database created before derived credentials
+                    connection.execute("ALTER TABLE broker ADD COLUMN credentials_key TEXT")
+                if "pending" not in columns:
+                    # Database created before pending claims of bindings
+                    connection.execute("ALTER TABLE broker ADD COLUMN pending REAL")
+        except sqlite3.Error as e:
+            logger.error("sqlite: %s", str(e))
+            raise ErrStorageConnection("Initialization")
+    
+    def _connection(self):
+        """ SQLite connection of the current thread
+        
+        Returns:
+            sqlite3.Connection: The connection
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+    
+    def _to_document(self, row):
+        """ Convert a row to a document
+        
+        Args:
+            row (sqlite3.Row): A row of the broker table
+        
+        Returns:
+            dict: The document or None
+        """
+        if row is None:
+            return None
+        
+        document = { "_id" : row["id"],
+                     "instance_id" : row["instance_id"],
+                     "parameters" : json.loads(row["parameters"]) }
+        if row["binding_id"]:
+            document["binding_id"] = row["binding_id"]
+            if row["credentials_key"] is not None:
+                document["credentials_key"] = row["credentials_key"]
+            if row["pending"] is not None:
+                document["pending"] = row["pending"]
+        else:
+            document["database"] = row["database"]
+            document["cluster"] = row["cluster"]
+        return document
+    
+    def _find_one(self, instance_id, binding_id=None):
+        try:
+            row = self._connection().execute("SELECT * FROM broker WHERE instance_id = ? AND binding_id = ?",
+                                             (instance_id, binding_id or '')).fetchone()
+        except sqlite3.Error:
+            raise ErrStorageConnection("Populate Instance or Binding")
+        
+        return self._to_document(row)
+    
+    def _find_pair(self, instance_id, binding_id):
+        try:
+            rows = self._connection().execute("SELECT * FROM broker WHERE instance_id = ? AND binding_id IN ('', ?)",
+                                              (instance_id, binding_id)).fetchall()
+        except sqlite3.Error:
+            raise ErrStorageConnection("Populate Instance and Binding")
+        
+        instance_result = None
+        binding_result = None
+        for row in rows:
+            if row["binding_id"]:
+                binding_result = self._to_document(row)
+            else:
+                instance_result = self._to_document(row)
+        
+        return instance_result, binding_result
+    
+    def _insert_one(self, document):
+        result, created = self._insert_if_absent(document)
+        
+        if not created:
+            # Same behavior than the unique index on MongoDB
+            return None
+        return result["_id"]
+    
+    def _insert_if_absent(self, document):
+        instance_id = document["instance_id"]
+        binding_id = document.get("binding_id", '')
+        connection = self._connection()
+        
+        try:
+            with connection:
+                cursor = connection.execute("INSERT OR IGNORE INTO broker (instance_id, binding_id, database, cluster, parameters, credentials_key, pending) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                            (instance_id,
+                                             binding_id,
+                                             document.get("database", None),
+                                             document.get("cluster", None),
+                                             json.dumps(document["parameters"]),
+                                             document.get("credentials_key", None),
+                                             document.get("pending", None)))
+                created = cursor.rowcount == 1
+                row = connection.execute("SELECT * FROM broker WHERE instance_id = ? AND binding_id = ?",
+                                         (instance_id, binding_id)).fetchone()
+        except sqlite3.Error:
+            raise ErrStorageConnection("Store Instance or Binding")
+        
+        return self._to_document(row), created
+    
+    def _complete_one(self, instance_id, binding_id):
+        connection = self._connection()
+        
+        try:
+            with connection:
+                cursor = connection.execute("UPDATE broker SET pending = NULL WHERE instance_id = ? AND binding_id = ?",
+                                            (instance_id, binding_id))
+        except sqlite3.Error:
+            raise ErrStorageConnection("Store Binding")
+        
+        return cursor.rowcount
+    
+    def _delete_one(self, instance_id, binding_id=None):
+        connection = self._connection()
+        
+        try:
+            with connection:
+                cursor = connection.execute("DELETE FROM broker WHERE instance_id = ? AND binding_id = ?",
+                                            (instance_id, binding_id or ''))
+        except sqlite3.Error:
+            if binding_id is None:
+                raise ErrStorageConnection("Remove Instance")
+            raise ErrStorageConnection("Remove Binding")
+        
+        return cursor.rowcount
+    
+    def ping(self):
+        try:
+            self._connection().execute("SELECT 1").fetchone()
+        except sqlite3.Error:
+            raise ErrStorageConnection("Ping")
+    
+    def save_operation(self, operation):
+        connection = self._connection()
+        
+        try:
+            with connection:
+                # Records of old operations are pruned
+                connection.execute("DELETE FROM operations WHERE expires < ?", (time.time(),))
+                connection.execute("INSERT OR REPLACE INTO operations (id, kind, instance_id, binding_id, state, updated, expires, document) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (operation["_id"], operation["kind"], operation["instance_id"], operation["binding_id"] or '',
+                                    operation["state"], operation["updated"], operation.get("expires", None), json.dumps(operation)))
+        except sqlite3.Error:
+            raise ErrStorageConnection("Save Operation")
+    
+    def find_operation(self, operation_id):
+        try:
+            row = self._connection().execute("SELECT document FROM operations WHERE id = ?",
+                                             (operation_id,)).fetchone()
+        except sqlite3.Error:
+            raise ErrStorageConnection("Find Operation")
+        
+        if row is None:
+            return None
+        return json.loads(row["document"])
+    
+    def find_pending_operation(self, kind, instance_id, binding_id=None):
+        try:
+            row = self._connection().execute("SELECT document FROM operations WHERE kind = ? AND instance_id = ? AND binding_id = ? AND state = ? ORDER BY updated DESC LIMIT 1",
+                                             (kind, instance_id, binding_id or '', OperationState.IN_PROGRESS.value)).fetchone()
+        except sqlite3.Error:
+            raise ErrStorageConnection("Find Operation")
+        
+        if row is None:
+            return None
+        return json.loads(row["document"])
@@ -0,0 +1,91 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""steps module
+
+Logic shared by the broker and the asyncio broker.
+
+An operation is written once as a generator of steps. A step is a call the operation needs
+(storage, Atlas, ...): the generator yields it with call() and gets its result back, or its
+exception raised at the yield. run() does the calls with blocking I/O and run_async() awaits
+the calls that are coroutines, so the same generator serves both brokers eg:
+    
+    def _find_steps(self, instance_id):
+        document = yield call(self._find_one, instance_id)
+        return document is not None
+    
+    def find(self, instance_id):
+        return run(self._find_steps(instance_id))
+    
+    async def find_async(self, instance_id):
+        return await run_async(self._find_steps(instance_id))
+"""
+
+import inspect
+
+def call(fn, *args):
+    """A step of an operation
+    
+    Args:
+        fn (callable): Function or coroutine function
+        *args: Arguments of the call
+    
+    Returns:
+        tuple: The step to yield
+    """
+    return fn, args
+
+def run(operation):
+    """Run an operation with blocking calls
+    
+    Args:
+        operation (generator): Steps of the operation
+    
+    Returns:
+        The value returned by the operation
+    """
+    result, error = None, None
+    while True:
+        try:
+            fn, args = operation.send(result) if error is None else operation.throw(error)
+        except StopIteration as e:
+            return e.value
+        
+        try:
+            result, error = fn(*args), None
+        except BaseException as e:
+            result, error = None, e
+
+async def run_async(operation):
+    """Run an operation on the event loop (coroutines are awaited)
+    
+    Args:
+        operation (generator): Steps of the operation
+    
+    Returns:
+        The value returned by the operation
+    """
+    result, error = None, None
+    while True:
+        try:
+            fn, args = operation.send(result) if error is None else operation.throw(error)
+        except StopIteration as e:
+            return e.value
+        
+        try:
+            result, error = fn(*args), None
+            if inspect.isawaitable(result):
+                result = await result
+        except BaseException as e:
+            result, error = None, e
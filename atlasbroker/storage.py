@@ -14,91 +14,438 @@
 
 """Storage module"""
 
+import asyncio
+import datetime
+import functools
+import logging
 import pymongo
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from bson.objectid import ObjectId
+from enum import Enum
+from pymongo.errors import DuplicateKeyError
+from openbrokerapi.service_broker import OperationState
+from . import deadline, metrics, steps, tracing
+from .breaker import CircuitBreaker, guarded
+from .cache import StorageCache
+from .watcher import StorageWatcher
 from .servicebinding import AtlasServiceBinding
 from .serviceinstance import AtlasServiceInstance
 from .errors import (
+    ErrStorageConnection,
     ErrStorageMongoConnection,
     ErrStorageTypeUnsupported,
     ErrStorageRemoveInstance,
     ErrStorageRemoveBinding,
     ErrStorageStore,
-    ErrStorageFindInstance
+    ErrStorageFindInstance,
+    ErrStorageLeaseTimeout
     )
 
-class AtlasBrokerStorage:
-    """ Storage
+logger = logging.getLogger("atlasbroker.storage")
+
+def bounded(fn):
+    """Decorator of a storage operation (or coroutine) done for a request
     
-    Permit to store ServiceInstance and ServiceBinding into a MongoDB.
+    The operation is not started once the deadline of the request is over and the calls of the
+    driver are bounded by the remaining time (see AtlasBrokerStorageBase.deadline_scope).
+    """
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(self, *args, **kwargs):
+            deadline.check("storage")
+            with self.deadline_scope():
+                return await fn(self, *args, **kwargs)
+        return async_wrapper
+    
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        deadline.check("storage")
+        with self.deadline_scope():
+            return fn(self, *args, **kwargs)
+    return wrapper
+
+class AtlasBrokerStorageBase:
+    """ Storage interface
+    
+    Permit to store ServiceInstance and ServiceBinding.
     
     This is used for caching and to trace what is done by the broker.
     This is internally used to don't create same instances/bindings and to return appropriate code like AlreadyExists
     That reducing the number of call to Atlas APIs too.
     
+    A storage driver has to implement the documents primitives:
+        _find_one
+        _find_pair
+        _insert_one
+        _insert_if_absent
+        _complete_one
+        _delete_one
+    
+    and the asynchronous operations records:
+        save_operation
+        find_operation
+        find_pending_operation
+    
+    The logic around the primitives is written once as steps (see steps module) so the
+    asyncio storages (see aiostorage module) share it with drivers having coroutines as
+    primitives.
+    
+    An instance document is {"instance_id", "database", "cluster", "parameters"} and
+    a binding document is {"binding_id", "instance_id", "parameters"} with "credentials_key"
+    when its credentials are derived (see Config.generate_binding_password) and "pending"
+    while it is claimed and not created on Atlas yet (see complete_claim).
+    
     Constructor
     
-    Args:
-        uri (str): MongoDB connection string
-        timeoutms (int): MongoDB requests timeout in ms
-        db (str): The DB name
-        collection (str): The collection name
-        
-    Raises:
-        ErrStorageMongoConnection: Error during MongoDB communication.
+    Keyword Arguments:
+        cache (dict): Enable the read-through cache eg: {"maxsize": 1024, "ttl": 30, "negative_ttl": 5}
+        upsert (bool): Create instances and bindings with an atomic upsert (see upsert)
     """
-    def __init__(self, uri, timeoutms, db, collection):
-        self.mongo_client = None
-        
-        # Connect to Mongo
-        try:
-            print("connection to mongo...")
-            # Init Mongo and create DB and collections objects
-            self.mongo_client = pymongo.MongoClient(uri, timeoutms)
-            self.db = self.mongo_client[db]
-            self.broker = self.db.get_collection(collection)
-            
-            if len(self.broker.index_information()) == 0:
-                # collection does not exist
-                # create it and create indexes
-                self.db.create_collection(collection)
-                self.broker.create_index( "instance_id" )
-                self.broker.create_index( "binding_id" )
-
-            print("mongo: connected")
-        except Exception as e:
-            print("mongo: " + str(e))
-            self.mongo_client = None
-            raise ErrStorageMongoConnection("Initialization")
     
+    class StoreState(Enum):
+        """Result of an atomic store"""
+        CREATED = "created"
+        IDENTICAL = "identical"
+        CONFLICT = "conflict"
+    
+    # Pause of the steps that wait (eg: a lease retry), asyncio.sleep for the asyncio storages
+    _sleep = staticmethod(time.sleep)
+    
+    def __init__(self, cache=None, upsert=False):
+        self.cache = StorageCache(**cache) if cache else None
+        self.use_upsert = upsert
+        # Circuit breaker of the backend (see CircuitBreaker), set by drivers
+        self.breaker = None
+    
+    @metrics.timed(metrics.STORAGE_SECONDS, "populate")
+    @tracing.traced("storage.populate")
+    @bounded
+    @guarded((ErrStorageConnection,))
     def populate(self, obj):
         """ Populate
         
-        Query mongo to get information about the obj if it exists
+        Query the storage to get information about the obj if it exists
         
         Args:
             obj (AtlasServiceBinding.Binding or AtlasServiceInstance.Instance): instance or binding
         
         Raises:
             ErrStorageTypeUnsupported: Type unsupported.
-            ErrStorageMongoConnection: Error during MongoDB communication.
+            ErrStorageConnection: Error during the storage communication.
+        """
+        return steps.run(self._populate_steps(obj))
+    
+    @metrics.timed(metrics.STORAGE_SECONDS, "populate_binding")
+    @tracing.traced("storage.populate_binding")
+    @bounded
+    @guarded((ErrStorageConnection,))
+    def populate_binding(self, binding):
+        """ Populate a binding and its instance
+        
+        Query the storage once to get information about the binding and its instance if they exist
+        
+        Args:
+            binding (AtlasServiceBinding.Binding): binding
+        
+        Raises:
+            ErrStorageConnection: Error during the storage communication.
+        """
+        return steps.run(self._populate_binding_steps(binding))
+    
+    @metrics.timed(metrics.STORAGE_SECONDS, "store")
+    @tracing.traced("storage.store")
+    @bounded
+    @guarded((ErrStorageConnection,))
+    def store(self, obj):
+        """ Store
+        
+        Store an object into the storage for caching
+        
+        Args:
+            obj (AtlasServiceBinding.Binding or AtlasServiceInstance.Instance): instance or binding
+        
+        Returns:
+            The storage id
+        
+        Raises:
+            ErrStorageConnection: Error during the storage communication.
+            ErrStorageTypeUnsupported: Type unsupported.
+            ErrStorageStore : Failed to store the binding or instance.
         """
+        return steps.run(self._store_steps(obj))
+    
+    @metrics.timed(metrics.STORAGE_SECONDS, "upsert")
+    @tracing.traced("storage.upsert")
+    @bounded
+    @guarded((ErrStorageConnection,))
+    def upsert(self, obj):
+        """ Upsert
+        
+        Store an object into the storage only if it does not exist yet.
+        
+        This is done in one atomic call so there is no need to populate the obj before and
+        concurrent calls for the same obj will never create it twice.
+        
+        Args:
+            obj (AtlasServiceBinding.Binding or AtlasServiceInstance.Instance): instance or binding
+        
+        Returns:
+            AtlasBrokerStorageBase.StoreState, id: The obj was created, already exists with the same parameters or
+            already exists with different parameters. The storage id of the stored document.
+        
+        Raises:
+            ErrStorageConnection: Error during the storage communication.
+            ErrStorageTypeUnsupported: Type unsupported.
+            ErrStorageStore : Failed to store the binding or instance.
+        """
+        return steps.run(self._upsert_steps(obj))
+    
+    @metrics.timed(metrics.STORAGE_SECONDS, "complete_claim")
+    @tracing.traced("storage.complete_claim")
+    @bounded
+    @guarded((ErrStorageConnection,))
+    def complete_claim(self, binding):
+        """ Complete a claim
+        
+        A binding claimed with upsert is stored as pending (binding.pending) until its
+        database user is created on Atlas. This marks it as created.
+        
+        Args:
+            binding (AtlasServiceBinding.Binding): binding
+        
+        Raises:
+            ErrStorageConnection: Error during the storage communication.
+            ErrStorageStore : The claim does not exist anymore.
+        """
+        return steps.run(self._complete_claim_steps(binding))
+    
+    @metrics.timed(metrics.STORAGE_SECONDS, "remove")
+    @tracing.traced("storage.remove")
+    @bounded
+    @guarded((ErrStorageConnection,))
+    def remove(self, obj):
+        """ Remove
+        
+        Remove an object from the storage
+        
+        Args:
+            obj (AtlasServiceBinding.Binding or AtlasServiceInstance.Instance): instance or binding
+        
+        Raises:
+            ErrStorageConnection: Error during the storage communication.
+            ErrStorageTypeUnsupported: Type unsupported.
+            ErrStorageRemoveInstance: Failed to remove the instance.
+            ErrStorageRemoveBinding: Failed to remove the binding
+        """
+        return steps.run(self._remove_steps(obj))
+    
+    def remove_instance(self, instance):
+        """ Remove an instance
+        
+        Remove an object from the storage
+        
+        Args:
+            instance (AtlasServiceInstance.Instance): instance
+        
+        Raises:
+            ErrStorageConnection: Error during the storage communication.
+            ErrStorageRemoveInstance: Failed to remove the instance.
+        """
+        return steps.run(self._remove_steps(instance))
+    
+    def remove_binding(self, binding):
+        """ Remove a binding
+        
+        Remove an object from the storage
+        
+        Args:
+            binding (AtlasServiceBinding.Binding): binding
+        
+        Raises:
+            ErrStorageConnection: Error during the storage communication.
+            ErrStorageRemoveBinding: Failed to remove the binding
+        """
+        return steps.run(self._remove_steps(binding))
+    
+    def _populate_steps(self, obj):
+        """ Steps of populate (see steps module) """
+        key = self._cache_key(obj)
+        
+        # cache
+        if self.cache is not None:
+            stored = self.cache.get(key)
+            if stored is not StorageCache.MISS:
+                self._populate_from(obj, stored)
+                return
+        
+        # find (writes done meanwhile invalidate the key, see StorageCache.version)
+        version = self.cache.version() if self.cache is not None else None
+        result = yield steps.call(self._find_one, *key[1:])
+        
+        stored = self._stored(result)
+        
+        if self.cache is not None:
+            self.cache.set(key, stored, version, self._document_id(result))
+        
+        self._populate_from(obj, stored)
+    
+    def _populate_binding_steps(self, binding):
+        """ Steps of populate_binding (see steps module) """
+        instance = binding.instance
+        instance_key = self._cache_key(instance)
+        binding_key = self._cache_key(binding)
+        
+        # cache
+        if self.cache is not None:
+            instance_stored = self.cache.get(instance_key)
+            binding_stored = self.cache.get(binding_key)
+            if instance_stored is not StorageCache.MISS and binding_stored is not StorageCache.MISS:
+                self._populate_from(instance, instance_stored)
+                self._populate_from(binding, binding_stored)
+                return
         
-        # query
+        # find (writes done meanwhile invalidate the keys, see StorageCache.version)
+        version = self.cache.version() if self.cache is not None else None
+        instance_result, binding_result = yield steps.call(self._find_pair, instance.instance_id, binding.binding_id)
+        
+        instance_stored = self._stored(instance_result)
+        binding_stored = self._stored(binding_result)
+        
+        if self.cache is not None:
+            self.cache.set(instance_key, instance_stored, version, self._document_id(instance_result))
+            self.cache.set(binding_key, binding_stored, version, self._document_id(binding_result))
+        
+        self._populate_from(instance, instance_stored)
+        self._populate_from(binding, binding_stored)
+    
+    def _store_steps(self, obj):
+        """ Steps of store (see steps module) """
+        document = self._document(obj)
+        
+        # insert
+        try:
+            result = yield steps.call(self._insert_one, document)
+        finally:
+            self._invalidate(obj)
+        
+        if result is not None:
+            # Flags the obj to provisioned
+            obj.provisioned = True
+            return result
+        
+        raise ErrStorageStore()
+    
+    def _upsert_steps(self, obj):
+        """ Steps of upsert (see steps module) """
+        document = self._document(obj)
+        
+        # upsert
+        try:
+            result, created = yield steps.call(self._insert_if_absent, document)
+        finally:
+            self._invalidate(obj)
+        
+        if result is None:
+            raise ErrStorageStore()
+        
+        if created:
+            # Flags the obj to provisioned
+            obj.provisioned = True
+            return AtlasBrokerStorageBase.StoreState.CREATED, result["_id"]
+        elif result["parameters"] == obj.parameters:
+            # Same binding claimed by another call (with its credentials key)
+            self._populate_from(obj, self._stored(result))
+            return AtlasBrokerStorageBase.StoreState.IDENTICAL, result["_id"]
+        
+        return AtlasBrokerStorageBase.StoreState.CONFLICT, result["_id"]
+    
+    def _complete_claim_steps(self, binding):
+        """ Steps of complete_claim (see steps module) """
+        try:
+            matched_count = yield steps.call(self._complete_one, binding.instance.instance_id, binding.binding_id)
+        finally:
+            self._invalidate(binding)
+        
+        if matched_count != 1:
+            raise ErrStorageStore()
+        
+        binding.pending = None
+    
+    def _remove_steps(self, obj):
+        """ Steps of remove (see steps module) """
         if type(obj) is AtlasServiceInstance.Instance:
-            query = { "instance_id" : obj.instance_id, "binding_id" : { "$exists" : False } }
+            instance_id, binding_id = obj.instance_id, None
         elif type(obj) is AtlasServiceBinding.Binding:
-            query = { "binding_id" : obj.binding_id, "instance_id" : obj.instance.instance_id }
+            instance_id, binding_id = obj.instance.instance_id, obj.binding_id
         else:
             raise ErrStorageTypeUnsupported(type(obj))
         
-        # find
+        # delete the document
         try:
-            result = self.broker.find_one(query)
-        except:
-            raise ErrStorageMongoConnection("Populate Instance or Binding")
+            deleted_count = yield steps.call(self._delete_one, instance_id, binding_id)
+        finally:
+            self._invalidate(obj)
         
-        if result is not None:
-            obj.parameters = result["parameters"]
+        # return the result
+        if deleted_count == 1:
+            obj.provisioned = False
+        elif binding_id is None:
+            raise ErrStorageRemoveInstance(instance_id)
+        else:
+            raise ErrStorageRemoveBinding(binding_id)
+    
+    def deadline_scope(self):
+        """ Bound the calls to the backend with the remaining time of the request (see deadline)
+        
+        Drivers with timeouts override it. Nothing is done by default.
+        
+        Returns:
+            A context manager
+        """
+        return nullcontext()
+    
+    def _stored(self, result):
+        """ Stored fields of a document (the value kept by the cache)
+        
+        Args:
+            result (dict): A document or None
+        
+        Returns:
+            tuple: parameters, credentials key, pending claim time or StorageCache.NOT_FOUND
+        """
+        if result is None:
+            return StorageCache.NOT_FOUND
+        return result["parameters"], result.get("credentials_key", None), result.get("pending", None)
+    
+    def _document_id(self, result):
+        """ Storage id of a document (see StorageCache.invalidate_document)
+        
+        Args:
+            result (dict): A document or None
+        
+        Returns:
+            The storage id or None
+        """
+        if result is None:
+            return None
+        return result.get("_id", None)
+    
+    def _populate_from(self, obj, stored):
+        """ Populate the obj with stored fields
+        
+        Args:
+            obj (AtlasServiceBinding.Binding or AtlasServiceInstance.Instance): instance or binding
+            stored (tuple): Stored fields (see _stored) or StorageCache.NOT_FOUND
+        """
+        if stored is not StorageCache.NOT_FOUND:
+            obj.parameters, credentials_key, pending = stored
+            if credentials_key is not None:
+                obj.credentials_key = credentials_key
+            if type(obj) is AtlasServiceBinding.Binding:
+                obj.pending = pending
             
             # Flags the obj to provisioned
             obj.provisioned = True
@@ -106,114 +453,719 @@ class AtlasBrokerStorage:
             # New
             obj.provisioned = False
     
-    def store(self, obj):
-        """ Store 
+    @contextmanager
+    def lease(self, instance_id, binding_id=None):
+        """ Lease
+        
+        Process an instance or a binding in one broker at a time. Storage drivers that are
+        not shared between processes don't need it so this does nothing by default.
+        
+        Args:
+            instance_id (str): UUID of the instance
         
-        Store an object into the MongoDB storage for caching
+        Keyword Arguments:
+            binding_id (str): UUID of the binding
+        """
+        yield
+    
+    def ping(self):
+        """ Check the storage backend is reachable (nothing to check by default)
+        
+        Raises:
+            ErrStorageConnection: The backend is not reachable
+        """
+        pass
+    
+    def cache_stats(self):
+        """ Cache statistics
+        
+        Returns:
+            dict: hits, misses and size of the cache or None if the cache is disabled
+        """
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+    
+    def _document(self, obj):
+        """ Document to store for an instance or a binding
         
         Args:
             obj (AtlasServiceBinding.Binding or AtlasServiceInstance.Instance): instance or binding
-            
+        
         Returns:
-            ObjectId: MongoDB _id
+            dict: The document
         
         Raises:
-            ErrStorageMongoConnection: Error during MongoDB communication.
             ErrStorageTypeUnsupported: Type unsupported.
-            ErrStorageStore : Failed to store the binding or instance.
         """
+        if type(obj) is AtlasServiceInstance.Instance:
+            return { "instance_id" : obj.instance_id, "database" : obj.get_dbname(), "cluster": obj.get_cluster(), "parameters" : obj.parameters }
+        elif type(obj) is AtlasServiceBinding.Binding:
+            document = { "binding_id" : obj.binding_id, "parameters" : obj.parameters, "instance_id": obj.instance.instance_id }
+            if obj.credentials_key is not None:
+                document["credentials_key"] = obj.credentials_key
+            if obj.pending is not None:
+                document["pending"] = obj.pending
+            return document
+        
+        raise ErrStorageTypeUnsupported(type(obj))
+    
+    def _cache_key(self, obj):
+        """ Cache key of an instance or a binding
+        
+        Args:
+            obj (AtlasServiceBinding.Binding or AtlasServiceInstance.Instance): instance or binding
+        
+        Returns:
+            tuple: The key
         
-        # query
+        Raises:
+            ErrStorageTypeUnsupported: Type unsupported.
+        """
         if type(obj) is AtlasServiceInstance.Instance:
-            query = { "instance_id" : obj.instance_id, "database" : obj.get_dbname(), "cluster": obj.get_cluster(), "parameters" : obj.parameters }
+            return ("instance", obj.instance_id)
         elif type(obj) is AtlasServiceBinding.Binding:
-            query = { "binding_id" : obj.binding_id, "parameters" : obj.parameters, "instance_id": obj.instance.instance_id }
-        else:
-            raise ErrStorageTypeUnsupported(type(obj))
+            return ("binding", obj.instance.instance_id, obj.binding_id)
         
-        # insert
+        raise ErrStorageTypeUnsupported(type(obj))
+    
+    def _invalidate(self, obj):
+        """ Invalidate the cache entry of an instance or a binding
+        
+        Args:
+            obj (AtlasServiceBinding.Binding or AtlasServiceInstance.Instance): instance or binding
+        """
+        if self.cache is not None:
+            self.cache.invalidate(self._cache_key(obj))
+    
+    def _find_one(self, instance_id, binding_id=None):
+        """ Find an instance (binding_id is None) or a binding document
+        
+        Args:
+            instance_id (str): UUID of the instance
+        
+        Keyword Arguments:
+            binding_id (str): UUID of the binding
+        
+        Returns:
+            dict: The document or None
+        """
+        raise NotImplementedError()
+    
+    def _find_pair(self, instance_id, binding_id):
+        """ Find an instance document and one of its binding documents
+        
+        Args:
+            instance_id (str): UUID of the instance
+            binding_id (str): UUID of the binding
+        
+        Returns:
+            dict, dict: The instance document or None, the binding document or None
+        """
+        return self._find_one(instance_id), self._find_one(instance_id, binding_id)
+    
+    def _insert_one(self, document):
+        """ Insert a document
+        
+        Args:
+            document (dict): The document
+        
+        Returns:
+            The storage id or None
+        """
+        raise NotImplementedError()
+    
+    def _insert_if_absent(self, document):
+        """ Insert a document if it does not exist yet (atomic)
+        
+        Args:
+            document (dict): The document
+        
+        Returns:
+            dict, bool: The stored document (with its storage id as "_id"), True if inserted by this call
+        """
+        raise NotImplementedError()
+    
+    def _complete_one(self, instance_id, binding_id):
+        """ Remove the pending claim of a binding document
+        
+        Args:
+            instance_id (str): UUID of the instance
+            binding_id (str): UUID of the binding
+        
+        Returns:
+            int: Number of documents matched
+        """
+        raise NotImplementedError()
+    
+    def _delete_one(self, instance_id, binding_id=None):
+        """ Delete an instance (binding_id is None) or a binding document
+        
+        Args:
+            instance_id (str): UUID of the instance
+        
+        Keyword Arguments:
+            binding_id (str): UUID of the binding
+        
+        Returns:
+            int: Number of documents deleted
+        """
+        raise NotImplementedError()
+    
+    def save_operation(self, operation):
+        """ Save an asynchronous operation record
+        
+        The record is removed by the storage once its "expires" time (epoch) is over.
+        
+        Args:
+            operation (dict): The operation record (the operation id is "_id")
+        """
+        raise NotImplementedError()
+    
+    def find_operation(self, operation_id):
+        """ Find an asynchronous operation record
+        
+        Args:
+            operation_id (str): The operation id
+        
+        Returns:
+            dict: The operation record or None
+        """
+        raise NotImplementedError()
+    
+    def find_pending_operation(self, kind, instance_id, binding_id=None):
+        """ Find the last asynchronous operation in progress of an instance or a binding
+        
+        Args:
+            kind (str): Kind of operation (provision, deprovision, bind, unbind)
+            instance_id (str): UUID of the instance
+        
+        Keyword Arguments:
+            binding_id (str): UUID of the binding
+        
+        Returns:
+            dict: The operation record or None
+        """
+        raise NotImplementedError()
+
+class AtlasBrokerStorage(AtlasBrokerStorageBase):
+    """ Storage
+    
+    Permit to store ServiceInstance and ServiceBinding into a MongoDB.
+    
+    Constructor
+    
+    Args:
+        uri (str): MongoDB connection string
+        timeoutms (int): MongoDB requests timeout in ms
+        db (str): The DB name
+        collection (str): The collection name
+    
+    Keyword Arguments:
+        cache (dict): Enable the read-through cache eg: {"maxsize": 1024, "ttl": 30, "negative_ttl": 5}
+        upsert (bool): Create instances and bindings with an atomic upsert (see upsert)
+        client_options (dict): pymongo.MongoClient options eg: {"maxPoolSize": 50, "compressors": "zstd,snappy"}
+        watch (bool): Invalidate the cache with a change stream to see writes of other broker replicas
+        lease (dict): Enable leases (see lease) eg: {"ttl": 30, "wait": 10, "retry_interval": 0.1}
+        breaker (dict): CircuitBreaker options eg: {"failure_threshold": 5, "open_seconds": 30}
+    
+    Raises:
+        ErrStorageMongoConnection: Error during MongoDB communication.
+    """
+    
+    # Indexes of the broker collection
+    #
+    # Instance documents have no binding_id so they are indexed with binding_id: null.
+    # The compound index serves both the instance and the binding queries and prevents
+    # duplicate instances or bindings. A partial index of the instance documents only is not
+    # possible: partialFilterExpression does not accept {"$exists": false}.
+    INDEXES = [
+        { "keys" : [ ("instance_id", pymongo.ASCENDING), ("binding_id", pymongo.ASCENDING) ],
+          "name" : "instance_id_binding_id",
+          "unique" : True },
+        ]
+    
+    # Indexes created by previous versions and superseded by INDEXES
+    LEGACY_INDEXES = [ "instance_id_1", "binding_id_1" ]
+    
+    def __init__(self, uri, timeoutms, db, collection, cache=None, upsert=False, client_options=None, watch=False, lease=None, breaker=None):
+        super().__init__(cache=cache, upsert=upsert)
+        self.breaker = CircuitBreaker("storage", **breaker) if breaker else None
+        self.timeoutms = timeoutms
+        self.mongo_client = None
+        self.watcher = None
+        self.lease_options = lease
+        
+        # Connect to Mongo
         try:
-            result = self.broker.insert_one(query)
+            logger.info("mongo: connection...")
+            # Init Mongo and create DB and collections objects
+            self.mongo_client = pymongo.MongoClient(uri, **self.client_options(timeoutms, client_options))
+            self.db = self.mongo_client[db]
+            self.broker = self.db.get_collection(collection)
+            self.operations = self.db.get_collection(collection + "_operations")
+            self.leases = self.db.get_collection(collection + "_leases")
+            
+            # Indexes are reconciled in the background to not block the broker
+            threading.Thread(target=self.ensure_indexes, name="storage-indexes", daemon=True).start()
+            
+            if watch and self.cache is not None:
+                self.watcher = StorageWatcher(self)
+                self.watcher.start()
+            
+            logger.info("mongo: connected")
+        except Exception as e:
+            logger.error("mongo: %s", str(e))
+            self.mongo_client = None
+            raise ErrStorageMongoConnection("Initialization")
+    
+    def deadline_scope(self):
+        """ Bound the MongoDB calls with the remaining time of the request (see pymongo.timeout)
+        
+        A call never gets more than timeoutms.
+        """
+        if deadline.remaining() is None:
+            return nullcontext()
+        return pymongo.timeout(deadline.timeout(self.timeoutms / 1000 if self.timeoutms else None))
+    
+    @staticmethod
+    def client_options(timeoutms, client_options=None):
+        """ MongoClient options
+        
+        timeoutms is used as default for the server selection, connect and socket timeouts.
+        All client_options are passed as is to pymongo.MongoClient and take precedence.
+        
+        Args:
+            timeoutms (int): MongoDB requests timeout in ms
+        
+        Keyword Arguments:
+            client_options (dict): pymongo.MongoClient options
+        
+        Returns:
+            dict: Options for pymongo.MongoClient
+        """
+        options = {}
+        
+        if timeoutms:
+            options["serverSelectionTimeoutMS"] = timeoutms
+            options["connectTimeoutMS"] = timeoutms
+            options["socketTimeoutMS"] = timeoutms
+        
+        if client_options:
+            options.update(client_options)
+        
+        return options
+    
+    def ensure_indexes(self):
+        """ Ensure indexes
+        
+        Create missing or outdated indexes declared in INDEXES and drop LEGACY_INDEXES.
+        This is idempotent and done at every startup.
+        
+        Returns:
+            bool: True if all declared indexes are available
+        """
+        try:
+            # Operations in progress of an instance or a binding (see find_pending_operation)
+            self.operations.create_index([ ("instance_id", pymongo.ASCENDING), ("binding_id", pymongo.ASCENDING) ],
+                                         name="instance_id_binding_id")
+            # Records of old operations are removed by MongoDB
+            self.operations.create_index("expires", name="expires", expireAfterSeconds=0)
+        except Exception as e:
+            logger.warning("mongo: indexes: operations: %s", str(e))
+        
+        if self.lease_options:
+            try:
+                # Leases of dead brokers are removed by MongoDB
+                self.leases.create_index("expires", name="expires", expireAfterSeconds=0)
+            except Exception as e:
+                logger.warning("mongo: indexes: expires: %s", str(e))
+        
+        try:
+            existing = self.broker.index_information()
+        except Exception as e:
+            logger.warning("mongo: indexes: %s", str(e))
+            return False
+        
+        ready = True
+        for index in self.INDEXES:
+            current = existing.get(index["name"], None)
+            
+            if current is not None and current["key"] == index["keys"] and current.get("unique", False) == index.get("unique", False):
+                # Up to date
+                continue
+            
+            options = { k:v for k,v in index.items() if k != "keys" }
+            try:
+                if current is not None:
+                    logger.info("mongo: indexes: drop outdated %s", index["name"])
+                    self.broker.drop_index(index["name"])
+                
+                logger.info("mongo: indexes: create %s", index["name"])
+                self.broker.create_index(index["keys"], **options)
+            except Exception as e:
+                # eg: duplicate documents prevent a unique index
+                logger.warning("mongo: indexes: %s: %s", index["name"], str(e))
+                ready = False
+        
+        if not ready:
+            # Keep legacy indexes to serve queries
+            return False
+        
+        for name in self.LEGACY_INDEXES:
+            if name in existing:
+                logger.info("mongo: indexes: drop legacy %s", name)
+                try:
+                    self.broker.drop_index(name)
+                except Exception as e:
+                    logger.warning("mongo: indexes: %s: %s", name, str(e))
+        
+        return True
+    
+    def _query(self, instance_id, binding_id=None):
+        """ Query of an instance (binding_id is None) or a binding document
+        
+        Args:
+            instance_id (str): UUID of the instance
+        
+        Keyword Arguments:
+            binding_id (str): UUID of the binding
+        
+        Returns:
+            dict: The query
+        """
+        if binding_id is None:
+            return { "instance_id" : instance_id, "binding_id" : { "$exists" : False } }
+        return { "binding_id" : binding_id, "instance_id" : instance_id }
+    
+    def _pair_query(self, instance_id, binding_id):
+        """ Query of an instance document and one of its binding documents
+        
+        Args:
+            instance_id (str): UUID of the instance
+            binding_id (str): UUID of the binding
+        
+        Returns:
+            dict: The query
+        """
+        return { "instance_id" : instance_id,
+                 "$or" : [ { "binding_id" : { "$exists" : False } },
+                           { "binding_id" : binding_id } ] }
+    
+    def _find_one(self, instance_id, binding_id=None):
+        try:
+            return self.broker.find_one(self._query(instance_id, binding_id))
+        except:
+            raise ErrStorageMongoConnection("Populate Instance or Binding")
+    
+    def _find_pair(self, instance_id, binding_id):
+        query = self._pair_query(instance_id, binding_id)
+        
+        # find
+        try:
+            results = list(self.broker.find(query, projection={ "binding_id" : True, "parameters" : True, "credentials_key" : True, "pending" : True }))
+        except:
+            raise ErrStorageMongoConnection("Populate Instance and Binding")
+        
+        instance_result = None
+        binding_result = None
+        for result in results:
+            if "binding_id" in result:
+                binding_result = result
+            else:
+                instance_result = result
+        
+        return instance_result, binding_result
+    
+    def _insert_one(self, document):
+        try:
+            result = self.broker.insert_one(document)
         except:
             raise ErrStorageMongoConnection("Store Instance or Binding")
         
         if result is not None:
-            # Flags the obj to provisioned
-            obj.provisioned = True
             return result.inserted_id
+        return None
+    
+    def _insert_if_absent(self, document):
+        query = self._query(document["instance_id"], document.get("binding_id", None))
         
-        raise ErrStorageStore()
+        # Fields of the query are set by the upsert itself
+        document = { k:v for k,v in document.items() if k not in ("instance_id", "binding_id") }
+        
+        # Our own _id permits to know if the document returned was inserted by this call
+        _id = ObjectId()
+        document["_id"] = _id
+        
+        try:
+            try:
+                result = self.broker.find_one_and_update(query,
+                                                         { "$setOnInsert" : document },
+                                                         upsert=True,
+                                                         return_document=pymongo.ReturnDocument.AFTER)
+            except DuplicateKeyError:
+                # A concurrent upsert inserted it first
+                result = self.broker.find_one(query)
+        except:
+            raise ErrStorageMongoConnection("Upsert Instance or Binding")
+        
+        return result, result is not None and result["_id"] == _id
     
-    def remove(self, obj):
-        """ Remove 
+    def _complete_one(self, instance_id, binding_id):
+        try:
+            result = self.broker.update_one(self._query(instance_id, binding_id), { "$unset" : { "pending" : "" } })
+        except:
+            raise ErrStorageMongoConnection("Store Binding")
         
-        Remove an object from the MongoDB storage for caching
+        if result is None:
+            return 0
+        return result.matched_count
+    
+    def _delete_one(self, instance_id, binding_id=None):
+        try:
+            result = self.broker.delete_one(self._query(instance_id, binding_id))
+        except:
+            if binding_id is None:
+                raise ErrStorageMongoConnection("Remove Instance")
+            raise ErrStorageMongoConnection("Remove Binding")
+        
+        if result is None:
+            return 0
+        return result.deleted_count
+    
+    def ping(self):
+        try:
+            self.mongo_client.admin.command("ping")
+        except:
+            raise ErrStorageMongoConnection("Ping")
+    
+    def save_operation(self, operation):
+        try:
+            self.operations.replace_one({ "_id" : operation["_id"] }, self._to_operation_document(operation), upsert=True)
+        except:
+            raise ErrStorageMongoConnection("Save Operation")
+    
+    def find_operation(self, operation_id):
+        try:
+            return self._from_operation_document(self.operations.find_one({ "_id" : operation_id }))
+        except:
+            raise ErrStorageMongoConnection("Find Operation")
+    
+    def find_pending_operation(self, kind, instance_id, binding_id=None):
+        try:
+            return self._from_operation_document(self.operations.find_one(self._pending_query(kind, instance_id, binding_id),
+                                                                           sort=[ ("updated", pymongo.DESCENDING) ]))
+        except:
+            raise ErrStorageMongoConnection("Find Operation")
+    
+    @staticmethod
+    def _to_operation_document(operation):
+        """ Document of an operation record
+        
+        The TTL index of MongoDB needs a date, "expires" is stored as a datetime.
         
         Args:
-            obj (AtlasServiceBinding.Binding or AtlasServiceInstance.Instance): instance or binding
-            
-        Raises:
-            ErrStorageTypeUnsupported: Type unsupported.
+            operation (dict): The operation record
+        
+        Returns:
+            dict: The document
         """
-        if type(obj) is AtlasServiceInstance.Instance:
-            self.remove_instance(obj)
-        elif type(obj) is AtlasServiceBinding.Binding:
-            self.remove_binding(obj)
-        else:
-            raise ErrStorageTypeUnsupported(type(obj))
-
-    def remove_instance(self, instance):
-        """ Remove an instance
+        document = dict(operation)
+        if "expires" in document:
+            document["expires"] = datetime.datetime.fromtimestamp(document["expires"], datetime.timezone.utc)
+        return document
+    
+    @staticmethod
+    def _from_operation_document(document):
+        """ Operation record of a document (see _to_operation_document)
         
-        Remove an object from the MongoDB storage for caching
+        Args:
+            document (dict): The document or None
+        
+        Returns:
+            dict: The operation record or None
+        """
+        if document is not None and isinstance(document.get("expires", None), datetime.datetime):
+            expires = document["expires"]
+            if expires.tzinfo is None:
+                # pymongo returns naive UTC datetimes by default
+                expires = expires.replace(tzinfo=datetime.timezone.utc)
+            document["expires"] = expires.timestamp()
+        return document
+    
+    def _pending_query(self, kind, instance_id, binding_id=None):
+        """ Query of the operations in progress of an instance or a binding
         
         Args:
-            instance (AtlasServiceInstance.Instance): instance
+            kind (str): Kind of operation
+            instance_id (str): UUID of the instance
+        
+        Keyword Arguments:
+            binding_id (str): UUID of the binding
+        
+        Returns:
+            dict: The query
+        """
+        return { "instance_id" : instance_id,
+                 "binding_id" : binding_id,
+                 "kind" : kind,
+                 "state" : OperationState.IN_PROGRESS.value }
+    
+    @contextmanager
+    def lease(self, instance_id, binding_id=None):
+        """ Lease
+        
+        Process an instance or a binding in one broker replica at a time.
+        
+        The lease is a document of the leases collection. It is acquired atomically if it does not
+        exist or if it is expired, and it is released once done. While held, it is renewed every
+        third of its ttl in a background thread so it never expires during a long operation.
+        
+        Args:
+            instance_id (str): UUID of the instance
+        
+        Keyword Arguments:
+            binding_id (str): UUID of the binding
         
         Raises:
+            ErrStorageLeaseTimeout: The lease is held by another broker for too long
             ErrStorageMongoConnection: Error during MongoDB communication.
-            ErrStorageRemoveInstance: Failed to remove the instance.
         """
+        if not self.lease_options:
+            yield
+            return
         
-        # query
-        query = { "instance_id" : instance.instance_id, "binding_id" : { "$exists" : False } }
+        key = self._lease_key(instance_id, binding_id)
+        with tracing.span("storage.acquire_lease"):
+            token = steps.run(self._acquire_lease_steps(key))
         
-        # delete the instance
+        released = threading.Event()
+        threading.Thread(target=self._renew_lease_loop, args=(key, token, released), name="storage-lease", daemon=True).start()
         try:
-            result = self.broker.delete_one(query)
-        except:
-            raise ErrStorageMongoConnection("Remove Instance")
-        
-        # return the result
-        if result is not None and result.deleted_count == 1:
-            instance.provisioned = False
-        else:
-            raise ErrStorageRemoveInstance(instance.instance_id)
+            yield
+        finally:
+            released.set()
+            self._release_lease(key, token)
     
-    def remove_binding(self, binding):
-        """ Remove a binding
+    def _lease_key(self, instance_id, binding_id=None):
+        """ Key of the lease of an instance or a binding
+        
+        Args:
+            instance_id (str): UUID of the instance
         
-        Remove an object from the MongoDB storage for caching
+        Keyword Arguments:
+            binding_id (str): UUID of the binding
+        
+        Returns:
+            str: The key
+        """
+        return instance_id if binding_id is None else instance_id + "/" + binding_id
+    
+    def _acquire_lease_steps(self, key):
+        """ Steps to acquire a lease (see steps module)
         
         Args:
-            binding (AtlasServiceBinding.Binding): binding
-            
+            key (str): Key of the lease
+        
+        Returns:
+            str: Token of the owner
+        
         Raises:
+            ErrStorageLeaseTimeout: The lease is held by another broker for too long
             ErrStorageMongoConnection: Error during MongoDB communication.
-            ErrStorageRemoveBinding: Failed to remove the binding
         """
+        token = uuid.uuid4().hex
+        # Never wait after the deadline of the request
+        wait_until = time.monotonic() + deadline.timeout(self.lease_options.get("wait", 10))
         
-        # query
-        query = { "binding_id" : binding.binding_id, "instance_id" : binding.instance.instance_id }
+        while True:
+            deadline.check("storage")
+            if (yield steps.call(self._try_lease, key, token)):
+                return token
+            
+            if time.monotonic() > wait_until:
+                deadline.check("storage")
+                raise ErrStorageLeaseTimeout(key)
+            
+            yield steps.call(self._sleep, self.lease_options.get("retry_interval", 0.1))
+    
+    def _try_lease(self, key, token):
+        """ Try to acquire a lease once
+        
+        Args:
+            key (str): Key of the lease
+            token (str): Token of the owner
         
-        # delete the binding
+        Returns:
+            bool: True if acquired, False if held by another owner
+        
+        Raises:
+            ErrStorageMongoConnection: Error during MongoDB communication.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
         try:
-            result = self.broker.delete_one(query)
+            # Insert the lease or take over an expired one. If the lease is held,
+            # the upsert fails on the _id.
+            with self.deadline_scope():
+                self.leases.find_one_and_update({ "_id" : key, "expires" : { "$lte" : now } },
+                                                { "$set" : { "owner" : token, "expires" : now + self._lease_ttl() } },
+                                                upsert=True)
+            return True
+        except DuplicateKeyError:
+            return False
         except:
-            raise ErrStorageMongoConnection("Remove Binding")
-
-        # return the result
-        if result is not None and result.deleted_count == 1:
-            binding.provisioned = False
-        else:
-            raise ErrStorageRemoveBinding(binding.binding_id)
+            raise ErrStorageMongoConnection("Acquire Lease")
+    
+    def _lease_ttl(self):
+        """ Time to live of a lease
+        
+        Returns:
+            datetime.timedelta: The ttl
+        """
+        return datetime.timedelta(seconds=self.lease_options.get("ttl", 30))
+    
+    def _renew_lease_loop(self, key, token, released):
+        """ Renew a lease until it is released
+        
+        Args:
+            key (str): Key of the lease
+            token (str): Token of the owner
+            released (threading.Event): Set once the lease is released
+        """
+        while not released.wait(self._lease_ttl().total_seconds() / 3):
+            if not self._renew_lease(key, token):
+                logger.warning("mongo: lease: %s: lost", key)
+                return
+    
+    def _renew_lease(self, key, token):
+        """ Push back the expiration of a lease
+        
+        Args:
+            key (str): Key of the lease
+            token (str): Token of the owner
+        
+        Returns:
+            bool: False if the lease is not held by the owner anymore
+        """
+        try:
+            result = self.leases.update_one({ "_id" : key, "owner" : token },
+                                            { "$set" : { "expires" : datetime.datetime.now(datetime.timezone.utc) + self._lease_ttl() } })
+        except Exception as e:
+            # Retried at the next renewal
+            logger.warning("mongo: lease: %s: %s", key, str(e))
+            return True
+        
+        return result.matched_count == 1
+    
+    def _release_lease(self, key, token):
+        """ Release a lease
+        
+        Args:
+            key (str): Key of the lease
+            token (str): Token of the owner
+        """
+        try:
+            self.leases.delete_one({ "_id" : key, "owner" : token })
+        except Exception as e:
+            # The lease will expire
+            logger.warning("mongo: lease: %s: %s", key, str(e))
@@ -0,0 +1,317 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""tracing module
+
+Spans around the service, backend, storage and Atlas calls of the broker.
+
+Tracing is off until an exporter is set (see configure). When it is off, a traced
+function only checks the list of exporters before being called.
+
+The current span is kept in a context variable so spans of a request are nested
+in threads and asyncio tasks.
+"""
+
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+import requests
+from .errors import ErrTracingExporterUnsupported
+
+logger = logging.getLogger("atlasbroker.tracing")
+
+# Exporters, swapped at once (see set_exporters)
+_exporters = []
+
+_current = contextvars.ContextVar("atlasbroker_span", default=None)
+
+class Span:
+    """Span
+    
+    Constructor
+    
+    Args:
+        name (str): Name of the span eg: "storage.populate"
+        parent (Span): Parent span or None
+        attributes (dict): Attributes of the span
+    """
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "attributes", "start", "end", "error")
+    
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+    
+    def set_attribute(self, key, value):
+        """Set an attribute
+        
+        Args:
+            key (str): Attribute name
+            value: Attribute value (str, int, float or bool)
+        """
+        self.attributes[key] = value
+
+def enabled():
+    """Check if tracing is on
+    
+    Returns:
+        bool: At least one exporter is set
+    """
+    return len(_exporters) > 0
+
+def current_span():
+    """Current span
+    
+    Returns:
+        Span: The current span or None
+    """
+    return _current.get()
+
+@contextmanager
+def span(name, **attributes):
+    """Trace a block of code
+    
+    Args:
+        name (str): Name of the span
+        **attributes: Attributes of the span
+    
+    Yields:
+        Span: The span or None if tracing is off
+    """
+    if not _exporters:
+        yield None
+        return
+    
+    s = Span(name, _current.get(), attributes)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.error = "%s: %s" % (type(e).__name__, str(e))
+        raise
+    finally:
+        s.end = time.time_ns()
+        _current.reset(token)
+        _export(s)
+
+def traced(name):
+    """Decorator to trace a function or a coroutine
+    
+    Args:
+        name (str): Name of the span
+    """
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                if not _exporters:
+                    return await fn(*args, **kwargs)
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+        
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _exporters:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _export(s):
+    """Send a finished span to all exporters and never raise"""
+    for exporter in _exporters:
+        try:
+            exporter.export(s)
+        except Exception as e:
+            logger.warning("tracing: %s: %s", type(exporter).__name__, str(e))
+
+def set_exporters(exporters):
+    """Set the exporters (an empty list turns tracing off)
+    
+    An exporter is any object with an export(span) method called once per finished span.
+    
+    Args:
+        exporters (list): The exporters
+    """
+    global _exporters
+    _exporters = list(exporters)
+
+def configure(options=None):
+    """Set the exporters from the "tracing" section of the configuration options
+    
+    Args:
+        options (dict): eg: {"exporters": [{"type": "log"}, {"type": "otlp_file", "path": "spans.json"}]}
+    
+    Raises:
+        ErrTracingExporterUnsupported: Unknown exporter type
+    """
+    exporters = []
+    for exporter_options in (options or {}).get("exporters", []):
+        exporter_options = dict(exporter_options)
+        kind = exporter_options.pop("type", None)
+        
+        if kind == "log":
+            exporters.append(LogExporter())
+        elif kind == "otlp_file":
+            exporters.append(OTLPFileExporter(**exporter_options))
+        elif kind == "otlp_http":
+            exporters.append(OTLPHttpExporter(**exporter_options))
+        else:
+            raise ErrTracingExporterUnsupported(kind)
+    
+    set_exporters(exporters)
+
+def _attribute(key, value):
+    """OTLP attribute"""
+    if isinstance(value, bool):
+        return { "key" : key, "value" : { "boolValue" : value } }
+    if isinstance(value, int):
+        return { "key" : key, "value" : { "intValue" : str(value) } }
+    if isinstance(value, float):
+        return { "key" : key, "value" : { "doubleValue" : value } }
+    return { "key" : key, "value" : { "stringValue" : str(value) } }
+
+def to_otlp(spans, service_name="atlasbroker"):
+    """Convert spans to an OTLP/JSON export request
+    
+    Args:
+        spans (list): Finished spans
+    
+    Keyword Arguments:
+        service_name (str): Name of the service in the resource
+    
+    Returns:
+        dict: ExportTraceServiceRequest as JSON
+    """
+    otlp_spans = []
+    for s in spans:
+        otlp_span = { "traceId" : s.trace_id,
+                      "spanId" : s.span_id,
+                      "name" : s.name,
+                      "kind" : 1,
+                      "startTimeUnixNano" : str(s.start),
+                      "endTimeUnixNano" : str(s.end),
+                      "attributes" : [ _attribute(k, v) for k, v in s.attributes.items() ],
+                      "status" : { "code" : 2, "message" : s.error } if s.error else { "code" : 1 } }
+        if s.parent_id is not None:
+            otlp_span["parentSpanId"] = s.parent_id
+        otlp_spans.append(otlp_span)
+    
+    return { "resourceSpans" : [
+                { "resource" : { "attributes" : [ _attribute("service.name", service_name) ] },
+                  "scopeSpans" : [ { "scope" : { "name" : "atlasbroker" },
+                                     "spans" : otlp_spans } ] } ] }
+
+class LogExporter:
+    """Log Exporter
+    
+    Log one line per span on the "atlasbroker.tracing" logger.
+    """
+    def export(self, s):
+        logger.info("trace: %s", s.name,
+                    extra={ "trace_id" : s.trace_id,
+                            "span_id" : s.span_id,
+                            "parent_id" : s.parent_id,
+                            "duration_ms" : round((s.end - s.start) / 1e6, 3),
+                            "error" : s.error })
+
+class OTLPFileExporter:
+    """OTLP File Exporter
+    
+    Append one OTLP/JSON export request per span to a file (one per line), like the file
+    exporter of the OpenTelemetry collector. The file can be replayed to a collector.
+    
+    Constructor
+    
+    Args:
+        path (str): Path of the file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+    
+    def export(self, s):
+        line = json.dumps(to_otlp([s]))
+        with self._lock:
+            self._file.write(line + "\n")
+
+class OTLPHttpExporter:
+    """OTLP HTTP Exporter
+    
+    Send spans by batch to an OTLP/HTTP collector (JSON encoding) from a background thread.
+    Spans are dropped if the collector is too slow, so the broker is never blocked.
+    
+    Constructor
+    
+    Args:
+        endpoint (str): Collector traces endpoint eg: "http://localhost:4318/v1/traces"
+    
+    Keyword Arguments:
+        batch_size (int): Maximum number of spans per request
+        interval (float): Maximum seconds before sending a batch
+        timeout (float): Requests timeout in seconds
+        max_queue_size (int): Maximum number of spans waiting to be sent
+    """
+    def __init__(self, endpoint, batch_size=512, interval=5, timeout=10, max_queue_size=2048):
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._session = requests.Session()
+        self._thread = threading.Thread(target=self.run, name="tracing-exporter", daemon=True)
+        self._thread.start()
+    
+    def export(self, s):
+        try:
+            self._queue.put_nowait(s)
+        except queue.Full:
+            self.dropped += 1
+    
+    def run(self):
+        """Send batches forever"""
+        while True:
+            batch = [ self._queue.get() ]
+            deadline = time.monotonic() + self.interval
+            
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                r = self._session.post(self.endpoint, json=to_otlp(batch), timeout=self.timeout)
+                r.raise_for_status()
+            except Exception as e:
+                logger.warning("tracing: %s: %s", self.endpoint, str(e))
@@ -0,0 +1,143 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""watcher module
+
+Keep the storage cache of a broker replica up to date with writes done by other replicas
+"""
+
+import logging
+import threading
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger("atlasbroker.storage")
+
+class StorageWatcher:
+    """Storage Watcher
+    
+    Tail a MongoDB change stream on the broker collection and invalidate the
+    storage cache entries of documents written by any broker replica.
+    
+    The cache key of a document is derived from the document of the event (inserts, replaces
+    and updates with their looked up document) or from its pre-image (collections with
+    pre-images). Otherwise (eg: a delete) the entry is found by the storage id of the
+    documentKey (see StorageCache.invalidate_document), the cache is never cleared for it.
+    
+    The resume token is kept across reconnections so no event is lost. If the history
+    is lost, the whole cache is invalidated. If change streams are not available
+    (eg: standalone MongoDB), the watcher stops and the cache relies on its TTL only.
+    
+    Constructor
+    
+    Args:
+        storage (AtlasBrokerStorage): MongoDB storage with a cache
+    
+    Keyword Arguments:
+        retry_interval (float): Seconds to wait before reconnecting
+    """
+    
+    # Error codes: change streams not supported by the deployment
+    UNSUPPORTED = (40573, 40324, 136)
+    
+    # Error codes: the resume token is no longer in the oplog
+    HISTORY_LOST = (280, 286)
+    
+    def __init__(self, storage, retry_interval=5):
+        self.storage = storage
+        self.retry_interval = retry_interval
+        self.resume_token = None
+        self.available = True
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        """Start to watch in a background thread"""
+        self._thread = threading.Thread(target=self.run, name="storage-watcher", daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """Stop to watch"""
+        self._stop.set()
+    
+    def run(self):
+        """Watch the broker collection until stopped"""
+        while not self._stop.is_set():
+            try:
+                with self.storage.broker.watch(resume_after=self.resume_token,
+                                               full_document="updateLookup",
+                                               max_await_time_ms=1000) as stream:
+                    logger.info("mongo: watcher: watching")
+                    
+                    if self.resume_token is None:
+                        # Changes done before the stream was opened are unknown
+                        self.storage.cache.clear()
+                    
+                    while stream.alive and not self._stop.is_set():
+                        change = stream.try_next()
+                        # Saved before the event is applied, an invalidate event resets it
+                        self.resume_token = stream.resume_token
+                        if change is not None:
+                            self.on_change(change)
+            except OperationFailure as e:
+                if e.code in self.UNSUPPORTED:
+                    logger.warning("mongo: watcher: change streams unavailable, fallback to cache TTL: %s", str(e))
+                    self.available = False
+                    return
+                
+                logger.warning("mongo: watcher: %s", str(e))
+                if e.code in self.HISTORY_LOST:
+                    self.resume_token = None
+            except PyMongoError as e:
+                logger.warning("mongo: watcher: %s", str(e))
+            
+            self._stop.wait(self.retry_interval)
+    
+    def on_change(self, change):
+        """Apply a change event to the cache
+        
+        Args:
+            change (dict): A change stream event
+        """
+        operation = change["operationType"]
+        
+        if operation in ("insert", "replace", "update", "delete"):
+            # The looked up document of an update is None if it was deleted since
+            for document in ( change.get("fullDocument", None),
+                              change.get("fullDocumentBeforeChange", None) ):
+                if document is not None:
+                    self.storage.cache.invalidate(self._cache_key(document))
+                    return
+            
+            self.storage.cache.invalidate_document(change["documentKey"]["_id"])
+            return
+        
+        if operation == "invalidate":
+            # The stream is closed (drop, rename, ...) and can't be resumed
+            self.resume_token = None
+        
+        # We don't know which entry is concerned
+        self.storage.cache.clear()
+    
+    def _cache_key(self, document):
+        """ Cache key of a stored document
+        
+        Args:
+            document (dict): An instance or a binding document
+        
+        Returns:
+            tuple: The key
+        """
+        if "binding_id" in document:
+            return ("binding", document["instance_id"], document["binding_id"])
+        return ("instance", document["instance_id"])
@@ -14,12 +14,13 @@ from atlasbroker.config import Config
 #         "user": "",
 #         "password" : "",
 #         "group" : ""
-#     }
+#     },
+#     "options" : {}
 # }
 #
 secrets = Config.load_json("secret.json")
 
-config = Config(secrets["atlas"], secrets["mongo"])
+config = Config(secrets["atlas"], secrets["mongo"], options=secrets.get("options", None))
 
 # OR
 #
@@ -34,6 +35,6 @@ config = Config(secrets["atlas"], secrets["mongo"])
 #     def generate_instance_dbname(self, instance):
 #         return instance.parameters[self.PARAMETER_NAMESPACE]
 #
-# config = CustomConfig(secrets["atlas"], secrets["mongo"])
+# config = CustomConfig(secrets["atlas"], secrets["mongo"], options=secrets.get("options", None))
 
 Broker(config).run()
@@ -4,9 +4,9 @@ from setuptools import setup, find_packages
 setup(
     name='atlasbroker',
     version='2.0.0',
-    python_requires='>=3.5',
+    python_requires='>=3.7',
     packages=find_packages(),
-    install_requires=['flask', 'openbrokerapi>=2.0.0', 'pymongo', 'pwgen', 'atlasapi'],
+    install_requires=['flask', 'openbrokerapi>=4.0.0', 'pymongo>=4.2', 'pwgen', 'atlasapi'],
 
     # Metadata
     author="Yellow Pages Inc.",
@@ -34,10 +34,18 @@ setup(
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
         'Programming Language :: Python :: 3 :: Only',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
     ],
-    extras_require={}
+    extras_require={
+        'compression': ['pymongo[snappy,zstd]'],
+        'server': ['gunicorn'],
+        'asgi': ['uvicorn', 'httpx', 'pymongo>=4.13'],
+        'metrics': ['prometheus_client'],
+    }
 
 )
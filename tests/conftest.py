@@ -0,0 +1,95 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fixtures of the broker tests
+
+The broker is served by the Flask test client with the memory storage driver. Atlas is
+replaced by a mock with one cluster ("cluster-1").
+"""
+
+from unittest import mock
+import pytest
+from atlasbroker.broker import Broker
+from atlasbroker.config import Config
+from atlasbroker.memorystorage import AtlasBrokerMemoryStorage
+from atlasbroker.sqlitestorage import AtlasBrokerSQLiteStorage
+
+SERVICE_ID = Config.UUID_SERVICES_CLUSTER
+PLAN_ID = Config.UUID_PLANS_EXISTING_CLUSTER
+
+HEADERS = { "X-Broker-Api-Version" : "2.14" }
+
+CLUSTER = { "name" : "cluster-1",
+            "mongoURIWithOptions" : "mongodb://cluster-1-shard-00-00.mongodb.net:27017/?ssl=true&replicaSet=cluster-1-shard-0" }
+
+def provision_body(parameters=None):
+    """Body of a provision request"""
+    return { "service_id" : SERVICE_ID,
+             "plan_id" : PLAN_ID,
+             "organization_guid" : "org",
+             "space_guid" : "space",
+             "parameters" : parameters if parameters is not None else { "cluster" : CLUSTER["name"] } }
+
+def bind_body(parameters=None):
+    """Body of a bind request"""
+    return { "service_id" : SERVICE_ID,
+             "plan_id" : PLAN_ID,
+             "parameters" : parameters }
+
+@pytest.fixture
+def atlas():
+    """Atlas client mock"""
+    atlas = mock.MagicMock()
+    atlas.Clusters.get_all_clusters.return_value = { "results" : [ CLUSTER ], "totalCount" : 1 }
+    atlas.Clusters.get_single_cluster.return_value = CLUSTER
+    # Specs of the database users are only read by Atlas
+    with mock.patch("atlasbroker.backend.create_atlas", return_value=atlas), \
+         mock.patch("atlasbroker.servicebinding.DatabaseUsersPermissionsSpecs"):
+        yield atlas
+
+# Storage class of each driver run by the tests
+STORAGES = { "memory" : AtlasBrokerMemoryStorage,
+             "sqlite" : AtlasBrokerSQLiteStorage }
+
+@pytest.fixture(params=sorted(STORAGES))
+def options(request, tmp_path):
+    """Configuration options (tests can update them before using the broker)
+    
+    Tests using the options run with each storage driver of STORAGES.
+    """
+    storage = { "driver" : request.param }
+    if request.param == "sqlite":
+        storage["path"] = str(tmp_path / "broker.db")
+    
+    return { "storage" : storage,
+             "clusters" : { "refresh_interval" : 0 },
+             "readiness" : { "interval" : 0 },
+             "logging" : { "level" : "WARNING" } }
+
+@pytest.fixture
+def storage_class(options):
+    """Storage class of the driver of the options"""
+    return STORAGES[options["storage"]["driver"]]
+
+@pytest.fixture
+def config(options):
+    return Config({ "user" : "user", "password" : "password", "group" : "group" }, None, options=options)
+
+@pytest.fixture
+def app(atlas, config):
+    return Broker.create_app(config)
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,178 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Open Service Broker API served by the ASGI application"""
+
+import asyncio
+import json
+from unittest import mock
+import pytest
+from atlasbroker import metrics
+from atlasbroker.aioservice import AsyncAtlasBroker
+from atlasbroker.asgi import AsgiBroker
+from atlasbroker.config import Config
+from atlasbroker.errors import ErrWatchUnsupported
+from .conftest import CLUSTER, HEADERS, PLAN_ID, SERVICE_ID, bind_body, provision_body
+
+@pytest.fixture
+def aioatlas():
+    """Asynchronous Atlas client mock"""
+    aioatlas = mock.MagicMock()
+    aioatlas.get_single_cluster = mock.AsyncMock(return_value=CLUSTER)
+    aioatlas.create_a_database_user = mock.AsyncMock()
+    aioatlas.delete_a_database_user = mock.AsyncMock()
+    aioatlas.ping = mock.AsyncMock()
+    aioatlas.close = mock.AsyncMock()
+    with mock.patch("atlasbroker.aioservice.AsyncAtlas", return_value=aioatlas):
+        yield aioatlas
+
+@pytest.fixture
+def asgi(atlas, aioatlas, config):
+    with mock.patch("atlasbroker.aioservice.create_atlas", return_value=atlas):
+        asgi = AsgiBroker(config)
+    # Bindings need the clusters configuration
+    asgi.broker.cluster_registry.refresh()
+    return asgi
+
+def request(asgi, method, path, body=None, query="", headers=None):
+    """Send a request to the ASGI application
+    
+    Args:
+        headers (dict): Headers of the request (default: HEADERS and a JSON content type with a body)
+    
+    Returns:
+        int, object: The status and the JSON payload (bytes if not JSON)
+    """
+    messages = [ { "type" : "http.request", "body" : json.dumps(body).encode() if body is not None else b"" } ]
+    response = {}
+    if headers is None:
+        headers = dict(HEADERS)
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+    
+    async def receive():
+        return messages.pop(0)
+    
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = dict(message["headers"])
+        else:
+            response["body"] = message["body"]
+    
+    scope = { "type" : "http",
+              "method" : method,
+              "path" : path,
+              "query_string" : query.encode(),
+              "headers" : [ (k.lower().encode(), v.encode()) for k,v in headers.items() ] }
+    
+    async def call():
+        await asgi(scope, receive, send)
+        if asgi.broker.operations is not None:
+            # Wait for the asynchronous operations
+            await asgi.broker.operations.close()
+    
+    asyncio.run(call())
+    if not response["body"] or not response["headers"][b"content-type"].startswith(b"application/json"):
+        return response["status"], response["body"] or None
+    return response["status"], json.loads(response["body"])
+
+def test_provision_bind(asgi, aioatlas):
+    query = "service_id=%s&plan_id=%s" % (SERVICE_ID, PLAN_ID)
+    
+    # Fields unknown by openbrokerapi are ignored
+    body = provision_body()
+    body["maintenance_info"] = { "version" : "1.0.0" }
+    status, _ = request(asgi, "PUT", "/v2/service_instances/i1", body)
+    assert status == 201
+    
+    status, _ = request(asgi, "PUT", "/v2/service_instances/i1", provision_body())
+    assert status == 200
+    
+    status, payload = request(asgi, "GET", "/v2/service_instances/i1")
+    assert status == 200
+    assert payload["parameters"] == { "cluster" : CLUSTER["name"] }
+    
+    status, payload = request(asgi, "PUT", "/v2/service_instances/i1/service_bindings/b1", bind_body())
+    assert status == 201
+    assert payload["credentials"]["username"]
+    aioatlas.create_a_database_user.assert_called_once()
+    
+    status, _ = request(asgi, "DELETE", "/v2/service_instances/i1/service_bindings/b1", query=query)
+    assert status == 200
+    aioatlas.delete_a_database_user.assert_called_once()
+    
+    status, _ = request(asgi, "GET", "/v2/service_instances/i1/service_bindings/b1")
+    assert status == 404
+    
+    status, _ = request(asgi, "DELETE", "/v2/service_instances/i1", query=query)
+    assert status == 200
+    
+    status, _ = request(asgi, "GET", "/v2/service_instances/i1")
+    assert status == 404
+
+def test_provision_async(options, atlas, aioatlas, config):
+    options["async"] = { "enabled" : True }
+    with mock.patch("atlasbroker.aioservice.create_atlas", return_value=atlas):
+        asgi = AsgiBroker(config)
+    
+    status, payload = request(asgi, "PUT", "/v2/service_instances/i1", provision_body(), query="accepts_incomplete=true")
+    assert status == 202
+    
+    status, last_operation = request(asgi, "GET", "/v2/service_instances/i1/last_operation", query="operation=" + payload["operation"])
+    assert status == 200
+    assert last_operation["state"] == "succeeded"
+    
+    status, _ = request(asgi, "GET", "/v2/service_instances/i1")
+    assert status == 200
+
+def test_content_type(asgi):
+    status, payload = request(asgi, "PUT", "/v2/service_instances/i1", provision_body(), headers=HEADERS)
+    assert status == 400
+    assert "application/json" in payload["description"]
+
+def test_unknown_plan(asgi):
+    query = "service_id=%s&plan_id=unknown" % SERVICE_ID
+    
+    status, _ = request(asgi, "PUT", "/v2/service_instances/i1", provision_body())
+    assert status == 201
+    
+    status, _ = request(asgi, "DELETE", "/v2/service_instances/i1/service_bindings/b1", query=query)
+    assert status == 400
+    
+    status, _ = request(asgi, "DELETE", "/v2/service_instances/i1", query=query)
+    assert status == 400
+
+def test_internal_error(asgi):
+    # Only the parsing of the request answers 400
+    with mock.patch.object(asgi.broker.storage, "_find_one", side_effect=KeyError("_id")):
+        status, _ = request(asgi, "GET", "/v2/service_instances/i1")
+    assert status == 500
+
+def test_watch_unsupported(options):
+    options["storage"]["driver"] = "mongo"
+    config = Config({ "user" : "user", "password" : "password", "group" : "group" },
+                    { "uri" : "mongodb://localhost", "db" : "broker", "watch" : True }, options=options)
+    with pytest.raises(ErrWatchUnsupported):
+        AsyncAtlasBroker(config)
+
+def test_metrics(asgi):
+    status, body = request(asgi, "GET", "/metrics")
+    assert status == 200
+    assert b"atlasbroker_operation_seconds" in body
+    
+    with mock.patch.object(metrics, "AVAILABLE", False):
+        status, body = request(asgi, "GET", "/metrics")
+    assert status == 501
+    assert b"prometheus_client" in body
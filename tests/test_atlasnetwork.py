@@ -0,0 +1,66 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent HTTP session of the Atlas calls"""
+
+from unittest import mock
+import pytest
+from requests.auth import HTTPDigestAuth
+from atlasbroker.atlasclient import AtlasNetwork, create_atlas
+
+URI = "https://cloud.mongodb.com/api/atlas/v1.0/groups/group/clusters"
+
+def response(status_code, payload=None, headers=None):
+    r = mock.MagicMock(status_code=status_code, headers=headers or {})
+    r.json.return_value = payload if payload is not None else {}
+    return r
+
+@pytest.fixture
+def network():
+    network = AtlasNetwork("user", "password", pool_maxsize=4, timeout=7, retry={ "backoff" : 0 })
+    with mock.patch.object(network.session, "request"):
+        yield network
+
+def test_session(network):
+    # Connections are pooled and the digest authentication is kept by the session
+    adapter = network.session.get_adapter(URI)
+    assert adapter._pool_maxsize == 4
+    assert isinstance(network.session.auth, HTTPDigestAuth)
+    
+    network.session.request.return_value = response(200, { "name" : "c1" })
+    assert network.get(URI) == { "name" : "c1" }
+    assert network.post(URI, { "name" : "c2" }) == { "name" : "c1" }
+    assert network.session.request.call_args_list == [
+        mock.call("GET", URI, allow_redirects=True, timeout=7),
+        mock.call("POST", URI, allow_redirects=True, timeout=7, json={ "name" : "c2" }) ]
+
+def test_retry(network):
+    network.session.request.side_effect = [ response(429, headers={ "Retry-After" : "0" }),
+                                            response(503),
+                                            response(200, { "results" : [] }) ]
+    assert network.get(URI) == { "results" : [] }
+    assert network.session.request.call_count == 3
+
+def test_not_json(network):
+    r = response(204)
+    r.json.side_effect = ValueError("No JSON")
+    network.session.request.return_value = r
+    assert network.delete(URI) == {}
+
+def test_create_atlas():
+    atlas = create_atlas({ "user" : "user", "password" : "password", "group" : "group" }, { "pool_maxsize" : 2 })
+    
+    # One session shared by all the calls of the client
+    assert isinstance(atlas.network, AtlasNetwork)
+    assert atlas.network.session.get_adapter(URI)._pool_maxsize == 2
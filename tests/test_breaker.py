@@ -0,0 +1,66 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Circuit breakers of the dependencies"""
+
+from unittest import mock
+import pytest
+from atlasbroker import deadline
+from atlasbroker.atlasclient import AtlasNetwork
+from atlasbroker.breaker import CircuitBreaker
+from atlasbroker.errors import ErrAtlasRateLimited, ErrDeadlineExceeded
+from atlasbroker.ratelimit import TokenBucket
+
+def test_deadline_not_a_failure():
+    breaker = CircuitBreaker("atlas", failure_threshold=1, open_seconds=0)
+    
+    # Timeout of a request with no time left
+    deadline.start(0)
+    try:
+        breaker.allow()
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+    finally:
+        deadline.start(None)
+    
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    
+    # The half open probe is given back
+    breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    deadline.start(0)
+    try:
+        breaker.failure()
+    finally:
+        deadline.start(None)
+    assert breaker.state == CircuitBreaker.HALF_OPEN and breaker.probes == 0
+
+def test_probe_released():
+    network = AtlasNetwork("user", "password", limiter=TokenBucket(rate=0.001, burst=1, timeout=0),
+                           breaker={ "failure_threshold" : 1, "open_seconds" : 0 })
+    network.limiter.tokens = 0
+    network.breaker.failure()
+    
+    # Rate limited, Atlas is not called
+    with pytest.raises(ErrAtlasRateLimited):
+        network.request("GET", "https://cloud.mongodb.com/api/atlas/v1.0/groups")
+    assert network.breaker.state == CircuitBreaker.HALF_OPEN and network.breaker.probes == 0
+    
+    # Cut by the deadline
+    network.limiter = None
+    with mock.patch.object(AtlasNetwork, "_send", side_effect=ErrDeadlineExceeded("atlas")):
+        with pytest.raises(ErrDeadlineExceeded):
+            network.request("GET", "https://cloud.mongodb.com/api/atlas/v1.0/groups")
+    assert network.breaker.state == CircuitBreaker.HALF_OPEN and network.breaker.probes == 0
@@ -0,0 +1,282 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Open Service Broker API served by Flask"""
+
+import threading
+import time
+from unittest import mock
+from atlasapi.errors import ErrAtlasNotFound
+from atlasbroker.broker import Broker
+from atlasbroker.clusters import ClusterRegistry
+from atlasbroker.errors import ErrStorageLeaseTimeout
+from atlasbroker.servicebinding import AtlasServiceBinding
+from atlasbroker.storage import AtlasBrokerStorage
+from .conftest import HEADERS, PLAN_ID, SERVICE_ID, bind_body, provision_body
+
+def test_provision(client, atlas):
+    r = client.put("/v2/service_instances/i1", json=provision_body(), headers=HEADERS)
+    assert r.status_code == 201
+    
+    # Retry of the platform
+    r = client.put("/v2/service_instances/i1", json=provision_body(), headers=HEADERS)
+    assert r.status_code == 200
+    
+    # Same instance with other parameters
+    r = client.put("/v2/service_instances/i1", json=provision_body({ "cluster" : "cluster-1", "database" : "other" }), headers=HEADERS)
+    assert r.status_code == 409
+    
+    r = client.delete("/v2/service_instances/i1", query_string={ "service_id" : SERVICE_ID, "plan_id" : PLAN_ID }, headers=HEADERS)
+    assert r.status_code == 200
+    
+    r = client.delete("/v2/service_instances/i1", query_string={ "service_id" : SERVICE_ID, "plan_id" : PLAN_ID }, headers=HEADERS)
+    assert r.status_code == 410
+
+def test_bind(client, atlas):
+    r = client.put("/v2/service_instances/i1", json=provision_body(), headers=HEADERS)
+    assert r.status_code == 201
+    
+    r = client.put("/v2/service_instances/i1/service_bindings/b1", json=bind_body(), headers=HEADERS)
+    assert r.status_code == 201
+    assert r.get_json()["credentials"]["username"]
+    atlas.DatabaseUsers.create_a_database_user.assert_called_once()
+    
+    # Same binding with other parameters
+    r = client.put("/v2/service_instances/i1/service_bindings/b1", json=bind_body({ "role" : "read" }), headers=HEADERS)
+    assert r.status_code == 409
+    
+    r = client.delete("/v2/service_instances/i1/service_bindings/b1", query_string={ "service_id" : SERVICE_ID, "plan_id" : PLAN_ID }, headers=HEADERS)
+    assert r.status_code == 200
+    atlas.DatabaseUsers.delete_a_database_user.assert_called_once()
+    
+    r = client.delete("/v2/service_instances/i1/service_bindings/b1", query_string={ "service_id" : SERVICE_ID, "plan_id" : PLAN_ID }, headers=HEADERS)
+    assert r.status_code == 410
+
+def test_get_instance(client, atlas):
+    r = client.get("/v2/service_instances/i1", headers=HEADERS)
+    assert r.status_code == 404
+    
+    client.put("/v2/service_instances/i1", json=provision_body(), headers=HEADERS)
+    
+    r = client.get("/v2/service_instances/i1", headers=HEADERS)
+    assert r.status_code == 200
+    assert r.get_json()["parameters"] == provision_body()["parameters"]
+
+def test_last_operation(options, config, atlas, storage_class):
+    options["async"] = { "enabled" : True }
+    client = Broker.create_app(config).test_client()
+    
+    started = threading.Event()
+    release = threading.Event()
+    store = storage_class.store
+    
+    def slow_store(self, obj):
+        started.set()
+        release.wait(5)
+        return store(self, obj)
+    
+    with mock.patch.object(storage_class, "store", slow_store):
+        r = client.put("/v2/service_instances/i1", json=provision_body(), headers=HEADERS, query_string={ "accepts_incomplete" : "true" })
+        assert r.status_code == 202
+        operation = r.get_json()["operation"]
+        assert started.wait(5)
+        
+        # Retry of the platform while the operation is in progress
+        r = client.put("/v2/service_instances/i1", json=provision_body(), headers=HEADERS, query_string={ "accepts_incomplete" : "true" })
+        assert r.status_code == 202
+        assert r.get_json()["operation"] == operation
+        
+        r = client.get("/v2/service_instances/i1/last_operation", headers=HEADERS, query_string={ "operation" : operation })
+        assert r.status_code == 200
+        assert r.get_json()["state"] == "in progress"
+        
+        release.set()
+        for _ in range(50):
+            r = client.get("/v2/service_instances/i1/last_operation", headers=HEADERS, query_string={ "operation" : operation })
+            if r.get_json()["state"] != "in progress":
+                break
+            time.sleep(0.1)
+    
+    assert r.status_code == 200
+    assert r.get_json()["state"] == "succeeded"
+    
+    r = client.put("/v2/service_instances/i1", json=provision_body(), headers=HEADERS, query_string={ "accepts_incomplete" : "true" })
+    assert r.status_code == 200
+    
+    # Unknown operations
+    r = client.get("/v2/service_instances/i1/last_operation", headers=HEADERS, query_string={ "operation" : "unknown" })
+    assert r.status_code == 410
+    
+    r = client.get("/v2/service_instances/i1/service_bindings/b1/last_operation", headers=HEADERS, query_string={ "operation" : operation })
+    assert r.status_code == 410
+
+def test_upsert_round_trips(options, config, atlas, storage_class):
+    options["storage"]["upsert"] = True
+    options["storage"]["cache"] = { "maxsize" : 16 }
+    client = Broker.create_app(config).test_client()
+    
+    # Calls done on the storage driver
+    calls = []
+    primitives = ("_find_one", "_find_pair", "_insert_one", "_insert_if_absent", "_complete_one", "_delete_one")
+    
+    def counted(name):
+        primitive = getattr(storage_class, name)
+        def call(self, *args):
+            calls.append(name)
+            return primitive(self, *args)
+        return call
+    
+    def count(method, path, body):
+        calls.clear()
+        r = client.open(path, method=method, json=body, headers=HEADERS)
+        return r.status_code, list(calls)
+    
+    with mock.patch.multiple(storage_class, **{ name : counted(name) for name in primitives }):
+        assert count("PUT", "/v2/service_instances/i1", provision_body()) == (201, [ "_insert_if_absent" ])
+        assert count("PUT", "/v2/service_instances/i1", provision_body()) == (200, [ "_insert_if_absent" ])
+        assert count("PUT", "/v2/service_instances/i1", provision_body({ "cluster" : "cluster-1", "database" : "other" })) == (409, [ "_insert_if_absent" ])
+        
+        # Lookup of the instance, claim and its completion
+        assert count("PUT", "/v2/service_instances/i1/service_bindings/b1", bind_body()) == (201, [ "_find_one", "_insert_if_absent", "_complete_one" ])
+        # The instance is cached
+        assert count("PUT", "/v2/service_instances/i1/service_bindings/b2", bind_body()) == (201, [ "_insert_if_absent", "_complete_one" ])
+
+def test_bind_pending_claim(options, config, atlas, storage_class):
+    options["storage"]["upsert"] = True
+    client = Broker.create_app(config).test_client()
+    
+    r = client.put("/v2/service_instances/i1", json=provision_body(), headers=HEADERS)
+    assert r.status_code == 201
+    
+    # The broker fails once the database user is created, the claim stays pending
+    with mock.patch.object(storage_class, "_complete_one", return_value=0):
+        r = client.put("/v2/service_instances/i1/service_bindings/b1", json=bind_body(), headers=HEADERS)
+        assert r.status_code == 500
+    
+    r = client.put("/v2/service_instances/i1/service_bindings/b1", json=bind_body(), headers=HEADERS)
+    assert r.status_code == 422
+    
+    r = client.get("/v2/service_instances/i1/service_bindings/b1", headers=HEADERS)
+    assert r.status_code == 404
+    
+    # A stale claim is taken over
+    with mock.patch("atlasbroker.servicebinding.time.time", return_value=time.time() + AtlasServiceBinding.CLAIM_TIMEOUT):
+        r = client.put("/v2/service_instances/i1/service_bindings/b1", json=bind_body(), headers=HEADERS)
+        assert r.status_code == 201
+    assert atlas.DatabaseUsers.create_a_database_user.call_count == 2
+    
+    # Completed (credentials are not predictible so an identical binding is a conflict)
+    r = client.put("/v2/service_instances/i1/service_bindings/b1", json=bind_body(), headers=HEADERS)
+    assert r.status_code == 409
+
+def test_provision_unknown_cluster(client, config, atlas):
+    # Created on Atlas since the last refresh of the clusters
+    cluster = { "name" : "cluster-2",
+                "mongoURIWithOptions" : "mongodb://cluster-2-shard-00-00.mongodb.net:27017/?ssl=true&replicaSet=cluster-2-shard-0" }
+    atlas.Clusters.get_single_cluster.return_value = cluster
+    
+    r = client.put("/v2/service_instances/i1", json=provision_body({ "cluster" : "cluster-2" }), headers=HEADERS)
+    assert r.status_code == 201
+    atlas.Clusters.get_single_cluster.assert_called_once_with("cluster-2")
+    # Bindings have its connection string
+    assert "cluster-2" in config.clusters and "cluster-1" in config.clusters
+    
+    atlas.Clusters.get_single_cluster.side_effect = ErrAtlasNotFound(404, {})
+    r = client.put("/v2/service_instances/i2", json=provision_body({ "cluster" : "cluster-3" }), headers=HEADERS)
+    assert r.status_code != 201
+    assert "cluster-3" not in config.clusters
+
+def test_lease_timeout(client, atlas, storage_class):
+    with mock.patch.object(storage_class, "populate_binding", side_effect=ErrStorageLeaseTimeout("i1/b1")):
+        r = client.put("/v2/service_instances/i1/service_bindings/b1", json=bind_body(), headers=HEADERS)
+        assert r.status_code == 422
+        assert r.get_json()["error"] == "ConcurrencyError"
+        
+        r = client.get("/v2/service_instances/i1/service_bindings/b1", headers=HEADERS)
+        assert r.status_code == 422
+
+def test_lease_renewal():
+    storage = AtlasBrokerStorage.__new__(AtlasBrokerStorage)
+    storage.lease_options = { "ttl" : 0.03 }
+    released = threading.Event()
+    
+    # Renewed until lost
+    with mock.patch.object(AtlasBrokerStorage, "_renew_lease", side_effect=[ True, False ]) as renew:
+        storage._renew_lease_loop("i1", "token", released)
+    assert renew.call_count == 2
+    
+    # Not renewed once released
+    released.set()
+    with mock.patch.object(AtlasBrokerStorage, "_renew_lease") as renew:
+        storage._renew_lease_loop("i1", "token", released)
+    renew.assert_not_called()
+
+def test_ready(client, atlas):
+    # Checked once at start (interval 0)
+    r = client.get("/ready")
+    assert r.status_code == 200
+    assert r.get_json()["checks"] == { "storage" : True, "atlas" : True }
+
+def test_catalog_etag(client):
+    r = client.get("/v2/catalog", headers=HEADERS)
+    assert r.status_code == 200
+    etag = r.headers["ETag"]
+    
+    r = client.get("/v2/catalog", headers=dict(HEADERS, **{ "If-None-Match" : etag }))
+    assert r.status_code == 304
+    assert r.headers["ETag"] == etag
+    
+    r = client.get("/v2/catalog", headers=dict(HEADERS, **{ "If-None-Match" : '"other"' }))
+    assert r.status_code == 200
+
+def test_catalog_built_once(client):
+    # openbrokerapi checks the plan of the requests with the catalog
+    with mock.patch("atlasbroker.service.create_service") as create_service:
+        r = client.put("/v2/service_instances/i1", json=provision_body(), headers=HEADERS)
+        assert r.status_code == 201
+        r = client.get("/v2/catalog", headers=HEADERS)
+        assert r.status_code == 200
+    create_service.assert_not_called()
+
+def test_admission_rejected(options, config, atlas):
+    options["admission"] = { "write" : { "limit" : 1, "queue" : 0, "retry_after" : 3 } }
+    app = Broker.create_app(config)
+    started = threading.Event()
+    release = threading.Event()
+    
+    def is_existing_cluster(registry, cluster):
+        started.set()
+        release.wait()
+        return True
+    
+    with mock.patch.object(ClusterRegistry, "is_existing_cluster", is_existing_cluster):
+        # The only slot of the write lane is taken
+        thread = threading.Thread(target=app.test_client().put, args=("/v2/service_instances/i1",),
+                                  kwargs={ "json" : provision_body(), "headers" : HEADERS })
+        thread.start()
+        started.wait()
+        
+        r = app.test_client().put("/v2/service_instances/i2", json=provision_body(), headers=HEADERS)
+        assert r.status_code == 503
+        assert r.headers["Retry-After"] == "3"
+        
+        # Other lanes are not concerned
+        r = app.test_client().get("/v2/catalog", headers=HEADERS)
+        assert r.status_code == 200
+        
+        release.set()
+        thread.join()
+    
+    r = app.test_client().put("/v2/service_instances/i2", json=provision_body(), headers=HEADERS)
+    assert r.status_code == 201
@@ -0,0 +1,192 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Read-through cache of the storage"""
+
+from types import SimpleNamespace
+from unittest import mock
+from pymongo.errors import OperationFailure, PyMongoError
+from atlasbroker.backend import AtlasBrokerBackend
+from atlasbroker.config import Config
+from atlasbroker.cache import StorageCache
+from atlasbroker.serviceinstance import AtlasServiceInstance
+from atlasbroker.sqlitestorage import AtlasBrokerSQLiteStorage
+from atlasbroker.watcher import StorageWatcher
+
+def test_stale_set():
+    cache = StorageCache(maxsize=2)
+    
+    version = cache.version()
+    cache.invalidate(("instance", "i1"))
+    cache.set(("instance", "i1"), StorageCache.NOT_FOUND, version)
+    assert cache.get(("instance", "i1")) is StorageCache.MISS
+    
+    # Other keys are not concerned
+    cache.set(("instance", "i2"), StorageCache.NOT_FOUND, version)
+    assert cache.get(("instance", "i2")) is StorageCache.NOT_FOUND
+    
+    # Invalidations forgotten (maxsize) make older lookups stale
+    cache.invalidate(("instance", "i3"))
+    cache.invalidate(("instance", "i4"))
+    cache.set(("instance", "i1"), StorageCache.NOT_FOUND, version)
+    assert cache.get(("instance", "i1")) is StorageCache.MISS
+    
+    version = cache.version()
+    cache.clear()
+    cache.set(("instance", "i2"), StorageCache.NOT_FOUND, version)
+    assert cache.get(("instance", "i2")) is StorageCache.MISS
+
+def test_populate_during_store(tmp_path, config):
+    storage = AtlasBrokerSQLiteStorage(str(tmp_path / "broker.db"), cache={ "maxsize" : 16 })
+    backend = SimpleNamespace(config=config)
+    find_one = storage._find_one
+    
+    def concurrent_store(instance_id, binding_id=None):
+        # The instance is stored by another request once the lookup is done
+        result = find_one(instance_id, binding_id)
+        storage.store(AtlasServiceInstance.Instance("i1", backend, { "cluster" : "cluster-1" }))
+        return result
+    
+    storage._find_one = concurrent_store
+    instance = AtlasServiceInstance.Instance("i1", backend)
+    storage.populate(instance)
+    assert not instance.isProvisioned()
+    
+    # NOT_FOUND was not cached
+    storage._find_one = find_one
+    instance = AtlasServiceInstance.Instance("i1", backend)
+    storage.populate(instance)
+    assert instance.isProvisioned()
+
+def test_storage_options(options, atlas):
+    # Keys of the mongo section apply to the mongo driver only
+    mongo = { "uri" : "mongodb://localhost", "db" : "db", "timeoutms" : 5000, "collection" : "broker",
+              "cache" : { "maxsize" : 16 }, "upsert" : True }
+    config = Config({}, mongo, options={ "storage" : { "upsert" : False } })
+    assert config.storage_options() == { "driver" : "mongo", "cache" : { "maxsize" : 16 }, "upsert" : False }
+    
+    config = Config({}, mongo, options={ "storage" : { "driver" : "memory" } })
+    assert config.storage_options() == { "driver" : "memory", "cache" : None, "upsert" : False }
+    
+    # The memory driver has the cache too
+    options["storage"]["cache"] = { "maxsize" : 16 }
+    config = Config({ "user" : "user", "password" : "password", "group" : "group" }, None, options=options)
+    assert AtlasBrokerBackend(config).storage.cache is not None
+
+def test_watcher_events():
+    storage = SimpleNamespace(cache=StorageCache(maxsize=16))
+    watcher = StorageWatcher(storage)
+    storage.cache.set(("instance", "i1"), ({}, None, None), document_id=1)
+    storage.cache.set(("binding", "i1", "b1"), ({}, None, None), document_id=2)
+    
+    # Update with its looked up document
+    watcher.on_change({ "operationType" : "update",
+                        "documentKey" : { "_id" : 2 },
+                        "fullDocument" : { "_id" : 2, "instance_id" : "i1", "binding_id" : "b1" } })
+    assert storage.cache.get(("binding", "i1", "b1")) is StorageCache.MISS
+    assert storage.cache.get(("instance", "i1")) is not StorageCache.MISS
+    
+    # Delete known by its id only, other entries are kept
+    storage.cache.set(("binding", "i1", "b1"), ({}, None, None), document_id=2)
+    watcher.on_change({ "operationType" : "delete", "documentKey" : { "_id" : 1 } })
+    assert storage.cache.get(("instance", "i1")) is StorageCache.MISS
+    assert storage.cache.get(("binding", "i1", "b1")) is not StorageCache.MISS
+    
+    # Delete of a document not cached, the lookups in progress are not cached
+    version = storage.cache.version()
+    watcher.on_change({ "operationType" : "delete", "documentKey" : { "_id" : 3 } })
+    storage.cache.set(("instance", "i3"), ({}, None, None), version, document_id=3)
+    assert storage.cache.get(("instance", "i3")) is StorageCache.MISS
+    assert storage.cache.get(("binding", "i1", "b1")) is not StorageCache.MISS
+
+class ChangeStream:
+    """Change stream mock returning events then failing with error (None: the stream is closed)"""
+    def __init__(self, events, error=None):
+        self.events = list(events)
+        self.error = error
+        self.resume_token = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        return False
+    
+    @property
+    def alive(self):
+        return bool(self.events) or self.error is not None
+    
+    def try_next(self):
+        if not self.events:
+            raise self.error
+        token, change = self.events.pop(0)
+        self.resume_token = token
+        return change
+
+def watch(streams):
+    """Watcher of a storage mock opening the streams (or raising the errors) until it is stopped"""
+    storage = SimpleNamespace(cache=mock.MagicMock(), broker=mock.MagicMock())
+    watcher = StorageWatcher(storage, retry_interval=0)
+    
+    def open_stream(**kwargs):
+        if not streams:
+            watcher.stop()
+            raise PyMongoError("stopped")
+        stream = streams.pop(0)
+        if isinstance(stream, Exception):
+            raise stream
+        return stream
+    
+    storage.broker.watch.side_effect = open_stream
+    watcher.run()
+    return watcher, storage
+
+def resumed_after(storage):
+    return [ call.kwargs["resume_after"] for call in storage.broker.watch.call_args_list ]
+
+def test_watcher_resume():
+    change = { "operationType" : "delete", "documentKey" : { "_id" : 1 } }
+    watcher, storage = watch([ ChangeStream([ ("t1", change), ("t2", None) ], PyMongoError("connection lost")),
+                               ChangeStream([ ("t3", change) ], PyMongoError("connection lost")) ])
+    
+    # No event is lost after a reconnection
+    assert resumed_after(storage) == [ None, "t2", "t3" ]
+    assert watcher.resume_token == "t3"
+    assert storage.cache.clear.call_count == 1
+    assert storage.cache.invalidate_document.call_count == 2
+
+def test_watcher_history_lost():
+    watcher, storage = watch([ ChangeStream([ ("t1", None) ], PyMongoError("connection lost")),
+                               OperationFailure("resume token not found", code=286),
+                               ChangeStream([], PyMongoError("connection lost")) ])
+    
+    # Watched again from now, the cache is cleared
+    assert resumed_after(storage) == [ None, "t1", None, None ]
+    assert storage.cache.clear.call_count == 2
+
+def test_watcher_unsupported():
+    watcher, storage = watch([ OperationFailure("The $changeStream stage is only supported on replica sets", code=40573) ])
+    
+    # The cache relies on its TTL
+    assert not watcher.available
+    assert storage.broker.watch.call_count == 1
+    storage.cache.clear.assert_not_called()
+
+def test_watcher_invalidate():
+    watcher, storage = watch([ ChangeStream([ ("t1", None), ("t2", { "operationType" : "invalidate" }) ]),
+                               ChangeStream([], PyMongoError("connection lost")) ])
+    
+    # The invalidated stream can't be resumed
+    assert resumed_after(storage) == [ None, None, None ]
+    assert storage.cache.clear.call_count == 3
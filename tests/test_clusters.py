@@ -0,0 +1,109 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Atlas clusters known by the broker"""
+
+import asyncio
+from unittest import mock
+import pytest
+from atlasapi.errors import ErrAtlasNotFound
+from atlasbroker import steps
+from atlasbroker.clusters import ClusterRegistry
+from atlasbroker.errors import ErrClustersRefreshTimeout, ErrDeadlineExceeded
+
+def page(names, total):
+    return { "results" : [ { "name" : name } for name in names ], "totalCount" : total }
+
+def test_fetch_pages():
+    atlas = mock.MagicMock()
+    atlas.Clusters.get_all_clusters.side_effect = [ page([ "c1", "c2" ], 3), page([ "c3" ], 3) ]
+    registry = ClusterRegistry(atlas, items_per_page=2)
+    
+    assert [ cluster["name"] for cluster in registry.fetch() ] == [ "c1", "c2", "c3" ]
+    assert atlas.Clusters.get_all_clusters.call_args_list == [ mock.call(pageNum=1, itemsPerPage=2),
+                                                               mock.call(pageNum=2, itemsPerPage=2) ]
+
+def test_refresh_swap():
+    atlas = mock.MagicMock()
+    on_refresh = mock.MagicMock()
+    registry = ClusterRegistry(atlas, on_refresh=on_refresh)
+    atlas.Clusters.get_all_clusters.return_value = page([ "c1" ], 1)
+    registry.refresh()
+    assert registry.names == frozenset([ "c1" ])
+    on_refresh.assert_called_once_with([ { "name" : "c1" } ])
+    
+    # A failed refresh keeps the last good list
+    atlas.Clusters.get_all_clusters.side_effect = [ page([ "c2" ], 2), ErrDeadlineExceeded("atlas") ]
+    with pytest.raises(ErrClustersRefreshTimeout):
+        registry.refresh()
+    assert registry.names == frozenset([ "c1" ])
+    assert registry.clusters == [ { "name" : "c1" } ]
+    assert on_refresh.call_count == 1
+
+def test_found_cluster():
+    atlas = mock.MagicMock()
+    atlas.Clusters.get_single_cluster.return_value = { "name" : "c2" }
+    registry = ClusterRegistry(atlas, clusters=[ "c1" ])
+    
+    assert registry.is_existing_cluster("c1")
+    atlas.Clusters.get_single_cluster.assert_not_called()
+    
+    # Fetched once
+    assert registry.is_existing_cluster("c2")
+    assert registry.is_existing_cluster("c2")
+    atlas.Clusters.get_single_cluster.assert_called_once_with("c2")
+
+def test_missing_cluster():
+    now = [ 0 ]
+    atlas = mock.MagicMock()
+    atlas.Clusters.get_single_cluster.side_effect = ErrAtlasNotFound(404, {})
+    registry = ClusterRegistry(atlas, negative_ttl=5, clock=lambda: now[0])
+    
+    # Not fetched again before negative_ttl
+    assert not registry.is_existing_cluster("c1")
+    assert not registry.is_existing_cluster("c1")
+    assert atlas.Clusters.get_single_cluster.call_count == 1
+    
+    now[0] = 6
+    assert not registry.is_existing_cluster("c1")
+    assert atlas.Clusters.get_single_cluster.call_count == 2
+    
+    # A refresh forgets the misses
+    atlas.Clusters.get_all_clusters.return_value = page([ "c2" ], 1)
+    registry.refresh()
+    assert registry.misses == {}
+    
+    # Expired misses are dropped
+    registry.misses = { "c3" : 1, "c4" : 100 }
+    assert not registry.is_existing_cluster("c1")
+    assert registry.misses == { "c4" : 100, "c1" : 11 }
+
+def test_missing_cluster_async():
+    registry = ClusterRegistry(mock.MagicMock())
+    get_single_cluster = mock.AsyncMock(side_effect=ErrAtlasNotFound(404, {}))
+    
+    async def check():
+        return [ await steps.run_async(registry.is_existing_cluster_steps("c1", get_single_cluster)) for _ in range(2) ]
+    
+    assert asyncio.run(check()) == [ False, False ]
+    get_single_cluster.assert_awaited_once_with("c1")
+
+def test_negative_ttl_disabled():
+    atlas = mock.MagicMock()
+    atlas.Clusters.get_single_cluster.side_effect = ErrAtlasNotFound(404, {})
+    registry = ClusterRegistry(atlas, negative_ttl=0)
+    
+    assert not registry.is_existing_cluster("c1")
+    assert not registry.is_existing_cluster("c1")
+    assert atlas.Clusters.get_single_cluster.call_count == 2
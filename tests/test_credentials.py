@@ -0,0 +1,80 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Binding passwords derived from the credentials keys"""
+
+from types import SimpleNamespace
+import pytest
+from atlasbroker.config import Config
+from atlasbroker.errors import ErrCredentialsKeyNotFound
+from .conftest import HEADERS, bind_body, provision_body
+
+KEYS = { "2026-04" : "old-secret", "2026-10" : "new-secret" }
+
+def keyed_config(current):
+    return Config({ "user" : "user", "password" : "password", "group" : "group" }, None,
+                  options={ "credentials" : { "keys" : dict(KEYS), "current" : current } })
+
+def binding(binding_id, credentials_key):
+    return SimpleNamespace(binding_id=binding_id, credentials_key=credentials_key)
+
+def test_same_key_same_password():
+    assert keyed_config("2026-04").generate_binding_password(binding("b1", "2026-04")) == \
+           keyed_config("2026-04").generate_binding_password(binding("b1", "2026-04"))
+    assert keyed_config("2026-04").generate_binding_password(binding("b1", "2026-04")) != \
+           keyed_config("2026-04").generate_binding_password(binding("b2", "2026-04"))
+
+def test_rotated_key():
+    before = keyed_config("2026-04")
+    after = keyed_config("2026-10")
+    
+    # The key of a binding is kept after the rotation
+    assert after.generate_binding_password(binding("b1", "2026-04")) == before.generate_binding_password(binding("b1", "2026-04"))
+    assert after.generate_binding_password(binding("b1", "2026-10")) != before.generate_binding_password(binding("b1", "2026-04"))
+
+def test_removed_key():
+    with pytest.raises(ErrCredentialsKeyNotFound):
+        keyed_config("2026-10").generate_binding_password(binding("b1", "2025-10"))
+    
+    with pytest.raises(ErrCredentialsKeyNotFound):
+        keyed_config("2025-10")
+
+def test_binding_keeps_key(config, client, atlas):
+    # Keys set after the creation of the broker (the client fixture)
+    config.credentials_keys = dict(KEYS)
+    config.credentials_key = "2026-04"
+    path = "/v2/service_instances/i1/service_bindings/"
+    
+    response = client.put("/v2/service_instances/i1", headers=HEADERS, json=provision_body())
+    assert response.status_code == 201
+    response = client.put(path + "b1", headers=HEADERS, json=bind_body())
+    assert response.status_code == 201
+    old = response.get_json()["credentials"]
+    
+    # Rotation of the current key
+    config.credentials_key = "2026-10"
+    
+    response = client.put(path + "b1", headers=HEADERS, json=bind_body())
+    assert response.status_code == 200
+    assert response.get_json()["credentials"] == old
+    
+    response = client.get(path + "b1", headers=HEADERS)
+    assert response.status_code == 200
+    assert response.get_json()["credentials"] == old
+    
+    response = client.put(path + "b2", headers=HEADERS, json=bind_body())
+    assert response.status_code == 201
+    new = response.get_json()["credentials"]
+    assert new["password"] != config.generate_binding_password(binding("b2", "2026-04"))
+    assert new["password"] == config.generate_binding_password(binding("b2", "2026-10"))
@@ -0,0 +1,98 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deadline of the requests served by the Flask broker"""
+
+import time
+import pytest
+from atlasbroker import deadline
+from atlasbroker.broker import Broker
+from atlasbroker.errors import ErrDeadlineExceeded
+from .conftest import HEADERS, bind_body, provision_body
+
+BINDING = "/v2/service_instances/i1/service_bindings/b1"
+
+@pytest.fixture(autouse=True)
+def no_deadline():
+    """The test client serves the requests in the thread of the test"""
+    yield
+    deadline.start(None)
+
+def create_client(options, config):
+    options["storage"]["upsert"] = True
+    options["deadline"] = { "seconds" : 30, "header" : "X-Request-Timeout" }
+    client = Broker.create_app(config).test_client()
+    
+    r = client.put("/v2/service_instances/i1", json=provision_body(), headers=HEADERS)
+    assert r.status_code == 201
+    return client
+
+def test_budget(options, config, atlas):
+    client = create_client(options, config)
+    budgets = []
+    atlas.DatabaseUsers.create_a_database_user.side_effect = lambda permissions: budgets.append(deadline.remaining())
+    
+    # The header asks for a shorter deadline, the configuration is a maximum
+    r = client.put(BINDING, json=bind_body(), headers=dict(HEADERS, **{ "X-Request-Timeout" : "2" }))
+    assert r.status_code == 201
+    assert 0 < budgets[0] <= 2
+    
+    r = client.put(BINDING.replace("b1", "b2"), json=bind_body(), headers=dict(HEADERS, **{ "X-Request-Timeout" : "120" }))
+    assert r.status_code == 201
+    assert 2 < budgets[1] <= 30
+
+def test_slow_atlas_call(options, config, atlas):
+    client = create_client(options, config)
+    headers = dict(HEADERS, **{ "X-Request-Timeout" : "0.1" })
+    
+    def slow(permissions):
+        time.sleep(0.2)
+    
+    # The storage is not called once the deadline is over
+    atlas.DatabaseUsers.create_a_database_user.side_effect = slow
+    r = client.put(BINDING, json=bind_body(), headers=headers)
+    assert r.status_code == 504
+    assert "storage" in r.get_json()["description"]
+
+def test_claim_released(options, config, atlas):
+    client = create_client(options, config)
+    headers = dict(HEADERS, **{ "X-Request-Timeout" : "0.1" })
+    
+    def cut(permissions):
+        time.sleep(0.2)
+        raise ErrDeadlineExceeded("atlas")
+    
+    # The claim is released after the deadline (suspended) so a retry creates the binding
+    atlas.DatabaseUsers.create_a_database_user.side_effect = cut
+    r = client.put(BINDING, json=bind_body(), headers=headers)
+    assert r.status_code == 504
+    
+    atlas.DatabaseUsers.create_a_database_user.side_effect = None
+    r = client.put(BINDING, json=bind_body(), headers=HEADERS)
+    assert r.status_code == 201
+
+def test_scopes():
+    deadline.start(None)
+    assert deadline.remaining() is None
+    assert deadline.timeout(5) == 5
+    
+    with deadline.scope(1):
+        assert 0 < deadline.remaining() <= 1
+        with deadline.suspended():
+            assert deadline.remaining() is None
+        with deadline.scope(10):
+            assert deadline.remaining() <= 1
+    
+    assert deadline.budget({ "seconds" : 30 }, "nan-seconds") == 30
+    assert deadline.budget({}, "5") == 5
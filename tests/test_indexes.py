@@ -0,0 +1,121 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Queries of the MongoDB storage are served by the declared indexes
+
+The query plans are checked on a real MongoDB set with ATLASBROKER_TEST_MONGO_URI
+(eg: mongodb://localhost:27017), these tests are skipped otherwise.
+"""
+
+import asyncio
+import os
+import uuid
+from unittest import mock
+import pytest
+from atlasbroker.aiostorage import AsyncAtlasBrokerStorage
+from atlasbroker.storage import AtlasBrokerStorage
+
+MONGO_URI = os.environ.get("ATLASBROKER_TEST_MONGO_URI", None)
+
+INDEX = AtlasBrokerStorage.INDEXES[0]
+
+def stages(plan):
+    """All stages of a query plan"""
+    yield plan
+    for child in [ plan.get("inputStage", None) ] + plan.get("inputStages", []):
+        if child is not None:
+            yield from stages(child)
+
+def index_scans(explain):
+    """Names of the indexes scanned by the winning plan of an explain output"""
+    planner = explain["queryPlanner"]
+    plan = planner["winningPlan"]
+    # Plans of the slot based engine
+    plan = plan.get("queryPlan", plan)
+    return [ stage["indexName"] for stage in stages(plan) if stage["stage"] == "IXSCAN" ]
+
+def test_queries_match_index():
+    """Equality fields of the queries are a prefix of the declared index (no MongoDB needed)"""
+    keys = [ key for key, _ in INDEX["keys"] ]
+    storage = AtlasBrokerStorage.__new__(AtlasBrokerStorage)
+    
+    assert list(storage._query("i1").keys()) == keys
+    assert sorted(storage._query("i1", "b1").keys()) == sorted(keys)
+    assert list(storage._pair_query("i1", "b1").keys())[0] == keys[0]
+
+def test_ensure_indexes():
+    """Indexes created on empty collections (no MongoDB needed)"""
+    storage = AtlasBrokerStorage.__new__(AtlasBrokerStorage)
+    storage.broker, storage.operations, storage.leases = mock.MagicMock(), mock.MagicMock(), mock.MagicMock()
+    storage.broker.index_information.return_value = { "_id_" : { "key" : [ ("_id", 1) ] }, "instance_id_1" : { "key" : [ ("instance_id", 1) ] } }
+    storage.lease_options = { "ttl" : 30 }
+    
+    assert storage.ensure_indexes()
+    storage.broker.create_index.assert_called_once_with([ ("instance_id", 1), ("binding_id", 1) ], name="instance_id_binding_id", unique=True)
+    storage.broker.drop_index.assert_called_once_with("instance_id_1")
+    storage.operations.create_index.assert_any_call([ ("instance_id", 1), ("binding_id", 1) ], name="instance_id_binding_id")
+    storage.operations.create_index.assert_any_call("expires", name="expires", expireAfterSeconds=0)
+    storage.leases.create_index.assert_called_once_with("expires", name="expires", expireAfterSeconds=0)
+
+def test_ensure_indexes_up_to_date():
+    storage = AtlasBrokerStorage.__new__(AtlasBrokerStorage)
+    storage.broker, storage.operations, storage.leases = mock.MagicMock(), mock.MagicMock(), mock.MagicMock()
+    storage.broker.index_information.return_value = { INDEX["name"] : { "key" : INDEX["keys"], "unique" : True } }
+    storage.lease_options = None
+    
+    assert storage.ensure_indexes()
+    storage.broker.create_index.assert_not_called()
+    storage.broker.drop_index.assert_not_called()
+    storage.leases.create_index.assert_not_called()
+
+def test_open_async():
+    storage = AsyncAtlasBrokerStorage.__new__(AsyncAtlasBrokerStorage)
+    storage.broker, storage.operations, storage.leases = mock.AsyncMock(), mock.AsyncMock(), mock.AsyncMock()
+    storage.lease_options = { "ttl" : 30 }
+    
+    asyncio.run(storage.open())
+    storage.broker.create_index.assert_awaited_once_with([ ("instance_id", 1), ("binding_id", 1) ], name="instance_id_binding_id", unique=True)
+    storage.operations.create_index.assert_any_await("expires", name="expires", expireAfterSeconds=0)
+    storage.leases.create_index.assert_awaited_once_with("expires", name="expires", expireAfterSeconds=0)
+
+@pytest.fixture
+def storage():
+    if MONGO_URI is None:
+        pytest.skip("ATLASBROKER_TEST_MONGO_URI is not set")
+    
+    storage = AtlasBrokerStorage(MONGO_URI, 5000, "atlasbroker_tests", "broker_" + uuid.uuid4().hex)
+    assert storage.ensure_indexes()
+    storage.broker.insert_many([ { "instance_id" : "i%d" % i, "parameters" : {} } for i in range(100) ] +
+                               [ { "instance_id" : "i%d" % i, "binding_id" : "b%d" % i, "parameters" : {} } for i in range(100) ])
+    yield storage
+    storage.broker.drop()
+    storage.operations.drop()
+    storage.mongo_client.close()
+
+def test_populate(storage):
+    assert index_scans(storage.broker.find(storage._query("i1")).explain()) == [ INDEX["name"] ]
+    assert index_scans(storage.broker.find(storage._query("i1", "b1")).explain()) == [ INDEX["name"] ]
+
+def test_find_pair(storage):
+    query = storage._pair_query("i1", "b1")
+    assert set(index_scans(storage.broker.find(query).explain())) == { INDEX["name"] }
+
+def test_upsert(storage):
+    for query in ( storage._query("i1"), storage._query("i1", "b1") ):
+        explain = storage.db.command("explain", { "findAndModify" : storage.broker.name,
+                                                  "query" : query,
+                                                  "update" : { "$setOnInsert" : { "parameters" : {} } },
+                                                  "upsert" : True },
+                                     verbosity="queryPlanner")
+        assert index_scans(explain) == [ INDEX["name"] ]
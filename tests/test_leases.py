@@ -0,0 +1,75 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Leases of the MongoDB storage (needs mongomock, skipped otherwise)"""
+
+import asyncio
+import datetime
+from unittest import mock
+import pytest
+from pymongo.errors import DuplicateKeyError
+from atlasbroker.aiostorage import AsyncAtlasBrokerStorage
+from atlasbroker.storage import AtlasBrokerStorage
+
+mongomock = pytest.importorskip("mongomock")
+
+@pytest.fixture
+def storage():
+    storage = AtlasBrokerStorage.__new__(AtlasBrokerStorage)
+    storage.leases = mongomock.MongoClient(tz_aware=True).db.leases
+    storage.lease_options = { "ttl" : 30 }
+    storage.timeoutms = None
+    return storage
+
+def test_try_lease(storage):
+    assert storage._try_lease("i1", "owner-1")
+    
+    # Held by its owner until it expires
+    assert not storage._try_lease("i1", "owner-2")
+    assert storage.leases.find_one({ "_id" : "i1" })["owner"] == "owner-1"
+    assert storage._try_lease("i1/b1", "owner-2")
+    
+    lease = storage.leases.find_one({ "_id" : "i1" })
+    assert lease["expires"].tzinfo is not None
+    assert lease["expires"] > datetime.datetime.now(datetime.timezone.utc)
+
+def test_take_over_expired(storage):
+    storage.leases.insert_one({ "_id" : "i1", "owner" : "owner-1",
+                                "expires" : datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=1) })
+    
+    assert storage._try_lease("i1", "owner-2")
+    assert storage.leases.find_one({ "_id" : "i1" })["owner"] == "owner-2"
+    
+    # The previous owner lost it
+    assert not storage._renew_lease("i1", "owner-1")
+    assert storage._renew_lease("i1", "owner-2")
+    
+    storage._release_lease("i1", "owner-1")
+    assert storage.leases.count_documents({}) == 1
+    storage._release_lease("i1", "owner-2")
+    assert storage.leases.count_documents({}) == 0
+
+def test_try_lease_async():
+    storage = AsyncAtlasBrokerStorage.__new__(AsyncAtlasBrokerStorage)
+    storage.leases = mock.MagicMock()
+    storage.leases.find_one_and_update = mock.AsyncMock(side_effect=[ None, DuplicateKeyError("E11000") ])
+    storage.lease_options = { "ttl" : 30 }
+    storage.timeoutms = None
+    
+    assert asyncio.run(storage._try_lease("i1", "owner-1"))
+    assert not asyncio.run(storage._try_lease("i1", "owner-2"))
+    
+    query, update = storage.leases.find_one_and_update.call_args.args
+    assert query["expires"]["$lte"].tzinfo is datetime.timezone.utc
+    assert update["$set"]["expires"] - query["expires"]["$lte"] == datetime.timedelta(seconds=30)
@@ -0,0 +1,46 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Logging of the broker"""
+
+import json
+import logging
+from atlasbroker import logs
+from atlasbroker.apis.broker import getApi
+
+def test_openbrokerapi_logger(atlas, config):
+    root_handlers = list(logging.root.handlers)
+    getApi(config)
+    
+    # The root logger is not configured by the broker
+    assert logging.root.handlers == root_handlers
+    assert logging.getLogger("atlasbroker.api").handlers == []
+
+def test_failed_operation():
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logs.logger.addHandler(handler)
+    try:
+        try:
+            with logs.operation("provision"):
+                raise KeyError("_id")
+        except KeyError:
+            pass
+    finally:
+        logs.logger.removeHandler(handler)
+    
+    document = json.loads(logs.JsonFormatter().format(records[0]))
+    assert document["error_type"] == "KeyError"
+    assert "exception" not in document
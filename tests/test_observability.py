@@ -0,0 +1,106 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tracing exporters and Prometheus metrics"""
+
+import json
+import time
+from unittest import mock
+import pytest
+from atlasbroker import metrics, tracing
+from atlasbroker.broker import Broker
+from atlasbroker.errors import ErrTracingExporterUnsupported
+from .conftest import HEADERS, provision_body
+
+@pytest.fixture(autouse=True)
+def no_exporters():
+    """Tracing is global, turn it off after each test"""
+    yield
+    tracing.set_exporters([])
+
+def test_otlp_file(options, config, atlas, tmp_path):
+    path = tmp_path / "spans.json"
+    options["tracing"] = { "exporters" : [ { "type" : "log" }, { "type" : "otlp_file", "path" : str(path) } ] }
+    client = Broker.create_app(config).test_client()
+    
+    r = client.put("/v2/service_instances/i1", json=provision_body(), headers=HEADERS)
+    assert r.status_code == 201
+    
+    spans = {}
+    for line in path.read_text().splitlines():
+        for span in json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]:
+            spans[span["name"]] = span
+    
+    # Storage calls are nested in the span of the operation
+    provision = spans["service.provision"]
+    assert "parentSpanId" not in provision
+    assert provision["status"] == { "code" : 1 }
+    storage = [ span for name, span in spans.items() if name.startswith("storage.") ]
+    assert storage
+    assert all(span["traceId"] == provision["traceId"] for span in storage)
+
+def test_otlp_http():
+    with mock.patch("atlasbroker.tracing.requests.Session") as session:
+        exporter = tracing.OTLPHttpExporter("http://localhost:4318/v1/traces", interval=0.01)
+        tracing.set_exporters([ exporter ])
+        
+        with tracing.span("service.bind", binding_id="b1"):
+            with pytest.raises(KeyError), tracing.span("storage.populate"):
+                raise KeyError("_id")
+        
+        for _ in range(100):
+            if session.return_value.post.called:
+                break
+            time.sleep(0.01)
+    
+    # Spans are sent by batch
+    args, kwargs = session.return_value.post.call_args
+    assert args == ("http://localhost:4318/v1/traces",)
+    spans = { span["name"] : span for span in kwargs["json"]["resourceSpans"][0]["scopeSpans"][0]["spans"] }
+    assert spans["storage.populate"]["parentSpanId"] == spans["service.bind"]["spanId"]
+    assert spans["storage.populate"]["status"]["code"] == 2
+    assert spans["service.bind"]["attributes"] == [ { "key" : "binding_id", "value" : { "stringValue" : "b1" } } ]
+
+def test_exporter_failure():
+    exporter = mock.MagicMock()
+    exporter.export.side_effect = OSError("disk full")
+    tracing.set_exporters([ exporter ])
+    
+    # The traced call is not affected
+    with tracing.span("storage.store"):
+        pass
+    exporter.export.assert_called_once()
+
+def test_exporter_unsupported():
+    with pytest.raises(ErrTracingExporterUnsupported):
+        tracing.configure({ "exporters" : [ { "type" : "zipkin" } ] })
+    assert not tracing.enabled()
+
+def test_metrics(client):
+    r = client.put("/v2/service_instances/i1", json=provision_body(), headers=HEADERS)
+    assert r.status_code == 201
+    r = client.put("/v2/service_instances/i1", json=provision_body({ "cluster" : "other" }), headers=HEADERS)
+    assert r.status_code == 409
+    
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert r.content_type.startswith("text/plain")
+    body = r.get_data(as_text=True)
+    assert 'atlasbroker_operation_seconds_count{operation="provision"}' in body
+    assert 'atlasbroker_conflicts_total{operation="provision"}' in body
+
+def test_metrics_unavailable(client):
+    with mock.patch.object(metrics, "AVAILABLE", False):
+        r = client.get("/metrics")
+    assert r.status_code == 501
@@ -0,0 +1,76 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Asynchronous operations: admission of the queue and records of the drivers"""
+
+import threading
+import time
+from unittest import mock
+import pytest
+from atlasbroker.broker import Broker
+from atlasbroker.clusters import ClusterRegistry
+from atlasbroker.memorystorage import AtlasBrokerMemoryStorage
+from atlasbroker.operations import OperationsBase
+from atlasbroker.sqlitestorage import AtlasBrokerSQLiteStorage
+from .conftest import HEADERS, provision_body
+
+def test_queue_full(options, config, atlas):
+    options["async"] = { "enabled" : True, "workers" : 1, "queue_size" : 0, "retry_after" : 7 }
+    client = Broker.create_app(config).test_client()
+    started = threading.Event()
+    release = threading.Event()
+    
+    def is_existing_cluster(registry, cluster):
+        started.set()
+        release.wait()
+        return True
+    
+    with mock.patch.object(ClusterRegistry, "is_existing_cluster", is_existing_cluster):
+        # The only worker is busy
+        r = client.put("/v2/service_instances/i1?accepts_incomplete=true", json=provision_body(), headers=HEADERS)
+        assert r.status_code == 202
+        started.wait()
+        
+        r = client.put("/v2/service_instances/i2?accepts_incomplete=true", json=provision_body(), headers=HEADERS)
+        assert r.status_code == 503
+        assert r.headers["Retry-After"] == "7"
+        
+        release.set()
+
+@pytest.fixture(params=[ "memory", "sqlite" ])
+def storage(request, tmp_path):
+    if request.param == "sqlite":
+        return AtlasBrokerSQLiteStorage(str(tmp_path / "broker.db"))
+    return AtlasBrokerMemoryStorage()
+
+def test_operations_pruned(storage):
+    operations = OperationsBase(keep=60)
+    old = operations._record("provision", "i1", None)
+    old["expires"] = time.time() - 1
+    storage.save_operation(old)
+    
+    operation = operations._record("bind", "i1", "b1")
+    storage.save_operation(operation)
+    
+    assert storage.find_operation(old["_id"]) is None
+    assert storage.find_operation(operation["_id"]) == operation
+    assert storage.find_pending_operation("bind", "i1", "b1") == operation
+    assert storage.find_pending_operation("bind", "i1", "b2") is None
+    assert storage.find_pending_operation("provision", "i1") is None
+
+def test_sqlite_pending_index(tmp_path):
+    storage = AtlasBrokerSQLiteStorage(str(tmp_path / "broker.db"))
+    plan = storage._connection().execute("EXPLAIN QUERY PLAN SELECT document FROM operations WHERE kind = ? AND instance_id = ? AND binding_id = ? AND state = ? ORDER BY updated DESC LIMIT 1",
+                                         ("bind", "i1", "b1", "in progress")).fetchall()
+    assert "operations_pending" in " ".join(row["detail"] for row in plan)
@@ -0,0 +1,102 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rate limit and retries of the Atlas calls"""
+
+import time
+from email.utils import formatdate
+from unittest import mock
+import pytest
+from atlasbroker.errors import ErrAtlasRateLimited
+from atlasbroker.ratelimit import RetryPolicy, TokenBucket, background
+from .conftest import HEADERS, provision_body
+
+def test_interactive_takes_all_tokens():
+    bucket = TokenBucket(rate=0.001, burst=3, reserve=2, timeout=0)
+    for _ in range(3):
+        bucket.acquire()
+    
+    with pytest.raises(ErrAtlasRateLimited) as e:
+        bucket.acquire()
+    assert e.value.retry_after >= 1
+
+def test_background_leaves_reserve():
+    bucket = TokenBucket(rate=0.001, burst=3, reserve=2, timeout=0)
+    with background():
+        bucket.acquire()
+        with pytest.raises(ErrAtlasRateLimited):
+            bucket.acquire()
+    
+    # Tokens of the reserve
+    bucket.acquire()
+    bucket.acquire()
+
+def test_background_waits_for_interactive():
+    bucket = TokenBucket(rate=20, burst=5, reserve=0, timeout=2)
+    bucket.tokens = 0
+    
+    # An interactive call is waiting for the next token
+    bucket.interactive_waiting = 1
+    assert bucket._take(False) > 0
+    bucket.interactive_waiting = 0
+    
+    time.sleep(0.1)
+    assert bucket._take(False) == 0
+
+def test_waits_for_token():
+    bucket = TokenBucket(rate=20, burst=1, reserve=0, timeout=2)
+    bucket.acquire()
+    
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.03
+
+def test_retry_jitter():
+    policy = RetryPolicy(max_retries=3, backoff=0.5, max_backoff=1)
+    with mock.patch("atlasbroker.ratelimit.random.uniform", side_effect=lambda low, high: high) as uniform:
+        assert policy.delay(0, 503) == 0.5
+        assert policy.delay(1, 429) == 1
+        # Bounded by max_backoff
+        assert policy.delay(2, 502) == 1
+    assert uniform.call_count == 3
+    
+    for _ in range(20):
+        assert 0 <= policy.delay(0, 503) <= 0.5
+
+def test_retry_statuses():
+    policy = RetryPolicy(max_retries=2)
+    assert policy.delay(0, 404) is None
+    assert policy.delay(0, 200) is None
+    assert policy.delay(2, 503) is None
+
+def test_retry_after():
+    policy = RetryPolicy(max_retries=3, max_backoff=30)
+    assert policy.delay(0, 429, "2") == 2
+    assert policy.delay(0, 429, "-1") == 0
+    # A longer Retry-After is not waited
+    assert policy.delay(0, 429, "60") is None
+    
+    assert 5 <= policy.delay(0, 503, formatdate(time.time() + 10, usegmt=True)) <= 10
+    assert policy.delay(0, 503, formatdate(time.time() - 10, usegmt=True)) == 0
+    
+    # Unreadable, backoff instead
+    with mock.patch("atlasbroker.ratelimit.random.uniform", return_value=0.25):
+        assert policy.delay(0, 503, "soon") == 0.25
+
+def test_rate_limited_answer(client, atlas):
+    atlas.Clusters.get_single_cluster.side_effect = ErrAtlasRateLimited(30, 4)
+    
+    r = client.put("/v2/service_instances/i1", json=provision_body({ "cluster" : "cluster-2" }), headers=HEADERS)
+    assert r.status_code == 503
+    assert r.headers["Retry-After"] == "4"
@@ -0,0 +1,47 @@
+# Copyright (c) 2018 Yellow Pages Inc.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coalescing of concurrent duplicate requests"""
+
+import threading
+import pytest
+from atlasbroker import deadline
+from atlasbroker.errors import ErrDeadlineExceeded
+from atlasbroker.singleflight import SingleFlight, request_key
+
+def test_request_key():
+    assert request_key("provision", "i1", plan_id="p1") != request_key("provision", "i1", plan_id="p2")
+
+def test_follower_deadline():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    
+    def leader():
+        flights.do("key", lambda: started.set() or release.wait())
+    
+    thread = threading.Thread(target=leader)
+    thread.start()
+    started.wait()
+    
+    # The follower gives up with its own deadline, the leader keeps running
+    deadline.start(0.1)
+    try:
+        with pytest.raises(ErrDeadlineExceeded):
+            flights.do("key", lambda: None)
+    finally:
+        deadline.start(None)
+    
+    release.set()
+    thread.join()